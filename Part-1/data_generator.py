@@ -1,11 +1,79 @@
 import psycopg2
 from faker import Faker
 import random
+import io
+import os
+import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, timedelta
+from pymongo.errors import BulkWriteError
+from id_space import discover_id_spaces
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.db import copy_value
+from common.statements import execute_prepared, register_statement
+from common.sensor_data import SENSOR_DATA, timeseries_options, to_timeseries_document
 
 
 fake = Faker()
 
+# Number of rows buffered per table before a chunk is streamed through COPY
+COPY_CHUNK_SIZE = 50000
+
+# Documents buffered per collection before an insert_many, and how many
+# insert_many calls may be running at the same time
+MONGO_BATCH_SIZE = 1000
+MONGO_MAX_IN_FLIGHT = 4
+
+# Entity counts of a generated data set. Every building gets min_floors to
+# max_floors floors and every floor min_rooms_per_floor to max_rooms_per_floor rooms.
+DEFAULT_SCALE = {
+    "buildings": 100,
+    "min_floors": 1,
+    "max_floors": 10,
+    "min_rooms_per_floor": 10,
+    "max_rooms_per_floor": 20,
+    "users": 100,
+    "access_logs": 100,
+    "sensors": 200,
+    "sensor_readings": 200,
+    "device_controls": 200,
+}
+
+BUILDING_COLUMNS = ('building_id', 'building_name', 'address', 'total_floors', 'construction_year',
+                    'building_type', 'emergency_contact', 'maintenance_contact',
+                    'energy_rating', 'building_status')
+FLOOR_COLUMNS = ('floor_id', 'building_id', 'floor_number', 'description', 'total_rooms',
+                 'floor_area', 'fire_escape_plan', 'access_control_level')
+ROOM_COLUMNS = ('room_id', 'floor_id', 'room_name', 'room_type', 'room_size',
+                'occupancy_limit', 'accessibility_features', 'room_status')
+USER_COLUMNS = ('user_id', 'user_name', 'email', 'role', 'password_hash',
+                'date_joined', 'last_login_date', 'phone_number',
+                'emergency_contact', 'access_level')
+ACCESS_LOG_COLUMNS = ('log_id', 'user_id', 'room_id', 'timestamp', 'access_type',
+                      'access_method', 'access_status')
+
+def validate_scale(scale):
+    unknown = set(scale) - set(DEFAULT_SCALE)
+    if unknown:
+        raise ValueError(f"Unknown scale settings: {', '.join(sorted(unknown))}")
+    for key, value in scale.items():
+        if not isinstance(value, int) or value < 0:
+            raise ValueError(f"{key} must be a non-negative integer, got {value!r}")
+    if not 1 <= scale["min_floors"] <= scale["max_floors"]:
+        raise ValueError("Expected 1 <= min_floors <= max_floors")
+    if not 1 <= scale["min_rooms_per_floor"] <= scale["max_rooms_per_floor"]:
+        raise ValueError("Expected 1 <= min_rooms_per_floor <= max_rooms_per_floor")
+    if scale["access_logs"] and not (scale["users"] and scale["buildings"]):
+        raise ValueError("access_logs need at least one user and one building")
+    if (scale["sensors"] or scale["device_controls"]) and not scale["buildings"]:
+        raise ValueError("sensors and device_controls need at least one building")
+    if scale["sensor_readings"] and not scale["sensors"]:
+        raise ValueError("sensor_readings need at least one sensor")
+    return scale
+
+
 # Function to generate a random date within a given range
 def random_date(start_date, end_date):
     return start_date + timedelta(
@@ -13,114 +81,334 @@ def random_date(start_date, end_date):
     )
 
 
-def psql_generate(conn):
+# Row builders shared by the per-row and the COPY loaders.
+# They return the column values without the table's own key.
+def building_row(total_floors):
+    return (
+        fake.company(),
+        fake.address().replace('\n', ', '),
+        total_floors,
+        random.randint(1960, 2023),
+        random.choice(['Office Building', 'Residential Building', 'Commercial Building']),
+        fake.phone_number(),
+        fake.phone_number(),
+        random.choice(['A', 'B', 'C', 'D']),
+        random.choice(['Operational', 'Under Construction']),
+    )
+
+
+def floor_row(building_id, floor_number, total_rooms):
+    return (
+        building_id,
+        floor_number,
+        f'Floor {floor_number}',
+        total_rooms,
+        random.uniform(500.0, 2000.0),
+        fake.text(),
+        random.choice(['High', 'Medium', 'Low']),
+    )
+
+
+def room_row(floor_id):
+    return (
+        floor_id,
+        f'Room {random.randint(1, 100)}',
+        random.choice(['Office', 'Conference', 'Utility']),
+        random.uniform(20.0, 200.0),
+        random.randint(1, 10),
+        random.choice(['Wheelchair accessible', 'Not accessible']),
+        random.choice(['Available', 'Occupied', 'Under Maintenance']),
+    )
+
+
+def user_row():
+    return (
+        fake.name(),
+        fake.email(),
+        random.choice(['Admin', 'Manager', 'Employee']),
+        fake.password(),
+        random_date(date(2015, 1, 1), date(2021, 1, 1)),
+        random_date(date(2021, 1, 1), date.today()),
+        fake.phone_number(),
+        fake.phone_number(),
+        random.choice(['High', 'Medium', 'Low']),
+    )
+
+
+def access_log_row(user_ids, room_ids):
+    return (
+        random.choice(user_ids),
+        random.choice(room_ids),
+        random_date(date(2021, 1, 1), date.today()),
+        random.choice(['Entry', 'Exit']),
+        random.choice(['Card', 'Key', 'Fingerprint']),
+        random.choice(['Granted', 'Denied']),
+    )
+
+
+def building_shapes(seed, count, scale=DEFAULT_SCALE):
+    # Room count of every floor for count buildings, drawn from a dedicated
+    # generator so the shape of a shard is known without generating its rows
+    rng = random.Random(seed)
+    for _ in range(count):
+        yield [rng.randint(scale["min_rooms_per_floor"], scale["max_rooms_per_floor"])
+               for _ in range(rng.randint(scale["min_floors"], scale["max_floors"]))]
+
+
+# Row generators for the COPY loaders. Keys are assigned after the given
+# last ids and rows are produced lazily, so memory does not grow with the counts.
+def building_tree_rows(shapes, building_id, floor_id, room_id):
+    # Yields (table, row) with every parent row before its children
+    for shape in shapes:
+        building_id += 1
+        yield 'buildings', (building_id,) + building_row(len(shape))
+        for floor_number, total_rooms in enumerate(shape, 1):
+            floor_id += 1
+            yield 'floors', (floor_id,) + floor_row(building_id, floor_number, total_rooms)
+            for _ in range(total_rooms):
+                room_id += 1
+                yield 'rooms', (room_id,) + room_row(floor_id)
+
+
+def user_rows(count, user_id):
+    for _ in range(count):
+        user_id += 1
+        yield (user_id,) + user_row()
+
+
+def access_log_rows(count, log_id, user_ids, room_ids):
+    for _ in range(count):
+        log_id += 1
+        yield (log_id,) + access_log_row(user_ids, room_ids)
+
+
+# Per-row INSERTs of psql_generate, prepared once per connection
+register_statement("insert_building", """
+    INSERT INTO buildings (
+        building_name, address, total_floors, construction_year,
+        building_type, emergency_contact, maintenance_contact,
+        energy_rating, building_status
+    )
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+    RETURNING building_id;
+""")
+register_statement("insert_floor", """
+    INSERT INTO floors (
+        building_id, floor_number, description, total_rooms,
+        floor_area, fire_escape_plan, access_control_level
+    )
+    VALUES (%s, %s, %s, %s, %s, %s, %s)
+    RETURNING floor_id;
+""")
+register_statement("insert_room", """
+    INSERT INTO rooms (
+        floor_id, room_name, room_type, room_size,
+        occupancy_limit, accessibility_features, room_status
+    )
+    VALUES (%s, %s, %s, %s, %s, %s, %s);
+""")
+register_statement("insert_user", """
+    INSERT INTO users (
+        user_name, email, role, password_hash,
+        date_joined, last_login_date, phone_number,
+        emergency_contact, access_level
+    )
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s);
+""")
+register_statement("insert_access_log", """
+    INSERT INTO access_logs (
+        user_id, room_id, timestamp, access_type,
+        access_method, access_status
+    )
+    VALUES (%s, %s, %s, %s, %s, %s);
+""")
+
+
+def timed_execute(cur, stats, table, statement, params):
+    # Execute one prepared statement and account its time against the table
+    t1 = time.time()
+    execute_prepared(cur, statement, params)
+    stats.setdefault(table, [0, 0.0])
+    stats[table][0] += 1
+    stats[table][1] += time.time() - t1
+
+
+def report_load_stats(stats, label):
+    print(f"{label} load statistics:")
+    for table, (rows, seconds) in stats.items():
+        rate = rows / seconds if seconds > 0 else float('inf')
+        print(f"  {table}: {rows} rows in {seconds:.2f}s ({rate:,.0f} rows/sec)")
+
+
+def psql_generate(conn, scale=DEFAULT_SCALE):
     cur = conn.cursor()
+    stats = {}
     # Generate data for Buildings table
-    for _ in range(100):
-        building_name = fake.company()
-        address = fake.address().replace('\n', ', ')
-        total_floors = random.randint(1, 10)
-        construction_year = random.randint(1960, 2023)
-        building_type = random.choice(['Office Building', 'Residential Building', 'Commercial Building'])
-        emergency_contact = fake.phone_number()
-        maintenance_contact = fake.phone_number()
-        energy_rating = random.choice(['A', 'B', 'C', 'D'])
-        building_status = random.choice(['Operational', 'Under Construction'])
-
-        cur.execute("""
-            INSERT INTO buildings (
-                building_name, address, total_floors, construction_year,
-                building_type, emergency_contact, maintenance_contact,
-                energy_rating, building_status
-            )
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-            RETURNING building_id;
-        """, (building_name, address, total_floors, construction_year, building_type,
-            emergency_contact, maintenance_contact, energy_rating, building_status))
+    for shape in building_shapes(random.getrandbits(64), scale["buildings"], scale):
+        timed_execute(cur, stats, 'buildings', "insert_building", building_row(len(shape)))
         building_id = cur.fetchone()[0]
 
         # Generate data for Floors table
-        for floor_number in range(1, total_floors + 1):
-            description = f'Floor {floor_number}'
-            total_rooms = random.randint(10, 20)
-            floor_area = random.uniform(500.0, 2000.0)
-            fire_escape_plan = fake.text()
-            access_control_level = random.choice(['High', 'Medium', 'Low'])
-
-            cur.execute("""
-                INSERT INTO floors (
-                    building_id, floor_number, description, total_rooms,
-                    floor_area, fire_escape_plan, access_control_level
-                )
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-                RETURNING floor_id;
-            """, (building_id, floor_number, description, total_rooms,
-                floor_area, fire_escape_plan, access_control_level))
+        for floor_number, total_rooms in enumerate(shape, 1):
+            timed_execute(cur, stats, 'floors', "insert_floor", floor_row(building_id, floor_number, total_rooms))
             floor_id = cur.fetchone()[0]
 
             # Generate data for Rooms table
             for _ in range(total_rooms):
-                room_name = f'Room {random.randint(1, 100)}'
-                room_type = random.choice(['Office', 'Conference', 'Utility'])
-                room_size = random.uniform(20.0, 200.0)
-                occupancy_limit = random.randint(1, 10)
-                accessibility_features = random.choice(['Wheelchair accessible', 'Not accessible'])
-                room_status = random.choice(['Available', 'Occupied', 'Under Maintenance'])
-
-                cur.execute("""
-                    INSERT INTO rooms (
-                        floor_id, room_name, room_type, room_size,
-                        occupancy_limit, accessibility_features, room_status
-                    )
-                    VALUES (%s, %s, %s, %s, %s, %s, %s);
-                """, (floor_id, room_name, room_type, room_size,
-                    occupancy_limit, accessibility_features, room_status))
+                timed_execute(cur, stats, 'rooms', "insert_room", room_row(floor_id))
     
     # Generate data for Users table
-    for _ in range(100):
-        user_name = fake.name()
-        email = fake.email()
-        role = random.choice(['Admin', 'Manager', 'Employee'])
-        password_hash = fake.password()
-        date_joined = random_date(date(2015, 1, 1), date(2021, 1, 1))
-        last_login_date = random_date(date(2021, 1, 1), date.today())
-        phone_number = fake.phone_number()
-        emergency_contact = fake.phone_number()
-        access_level = random.choice(['High', 'Medium', 'Low'])
-
-        cur.execute("""
-            INSERT INTO users (
-                user_name, email, role, password_hash,
-                date_joined, last_login_date, phone_number,
-                emergency_contact, access_level
-            )
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s);
-        """, (user_name, email, role, password_hash,
-            date_joined, last_login_date, phone_number,
-            emergency_contact, access_level))
+    for _ in range(scale["users"]):
+        timed_execute(cur, stats, 'users', "insert_user", user_row())
     
     # Generate data for AccessLogs table
-    for _ in range(100):
-        user_id = random.randint(1, 100)
-        room_id = random.randint(1, 100)
-        timestamp = random_date(date(2021, 1, 1), date.today())
-        access_type = random.choice(['Entry', 'Exit'])
-        access_method = random.choice(['Card', 'Key', 'Fingerprint'])
-        access_status = random.choice(['Granted', 'Denied'])
-
-        cur.execute("""
-            INSERT INTO access_logs (
-                user_id, room_id, timestamp, access_type,
-                access_method, access_status
-            )
-            VALUES (%s, %s, %s, %s, %s, %s);
-        """, (user_id, room_id, timestamp, access_type,
-            access_method, access_status))
+    id_spaces = discover_id_spaces(conn, {'users': ('users', 'user_id'), 'rooms': ('rooms', 'room_id')})
+    user_ids, room_ids = id_spaces['users'], id_spaces['rooms']
+    for _ in range(scale["access_logs"]):
+        timed_execute(cur, stats, 'access_logs', "insert_access_log", access_log_row(user_ids, room_ids))
     
     cur.close()
+    report_load_stats(stats, "Per-row INSERT")
     return 
 
 
+class CopyStream:
+    """
+    Buffers rows for one table client-side and streams them to PostgreSQL
+    through COPY FROM STDIN in chunks of chunk_size rows.
+    """
+
+    def __init__(self, cur, table, columns, chunk_size=COPY_CHUNK_SIZE):
+        self.cur = cur
+        self.table = table
+        self.columns = columns
+        self.chunk_size = chunk_size
+        self.buffer = io.StringIO()
+        self.pending = 0
+        self.rows = 0
+        self.seconds = 0.0
+
+    def write(self, row):
+        self.buffer.write('\t'.join(copy_value(value) for value in row))
+        self.buffer.write('\n')
+        self.pending += 1
+        return self.pending >= self.chunk_size
+
+    def flush(self):
+        if not self.pending:
+            return
+        self.buffer.seek(0)
+        t1 = time.time()
+        self.cur.copy_expert(
+            f"COPY {self.table} ({', '.join(self.columns)}) FROM STDIN", self.buffer)
+        self.seconds += time.time() - t1
+        self.rows += self.pending
+        self.buffer = io.StringIO()
+        self.pending = 0
+
+
+def flush_streams(*streams):
+    # Parents are flushed before children so the foreign keys always resolve
+    for stream in streams:
+        stream.flush()
+
+
+def max_ids(cur):
+    cur.execute("""
+        SELECT (SELECT COALESCE(MAX(building_id), 0) FROM buildings),
+               (SELECT COALESCE(MAX(floor_id), 0) FROM floors),
+               (SELECT COALESCE(MAX(room_id), 0) FROM rooms),
+               (SELECT COALESCE(MAX(user_id), 0) FROM users),
+               (SELECT COALESCE(MAX(log_id), 0) FROM access_logs);
+    """)
+    return cur.fetchone()
+
+
+def sync_sequence(cur, table, column, last_id):
+    # Keys were assigned client-side, move the SERIAL sequence past them
+    if last_id > 0:
+        cur.execute("SELECT setval(pg_get_serial_sequence(%s, %s), %s);", (table, column, last_id))
+
+
+def copy_building_tree(cur, rows, chunk_size=COPY_CHUNK_SIZE):
+    # Stream (table, row) pairs from building_tree_rows into buildings, floors and rooms
+    streams = {
+        'buildings': CopyStream(cur, 'buildings', BUILDING_COLUMNS, chunk_size),
+        'floors': CopyStream(cur, 'floors', FLOOR_COLUMNS, chunk_size),
+        'rooms': CopyStream(cur, 'rooms', ROOM_COLUMNS, chunk_size),
+    }
+    for table, row in rows:
+        if streams[table].write(row):
+            flush_streams(*streams.values())
+    flush_streams(*streams.values())
+    return tuple(streams.values())
+
+
+def copy_rows(cur, table, columns, rows, chunk_size=COPY_CHUNK_SIZE):
+    stream = CopyStream(cur, table, columns, chunk_size)
+    for row in rows:
+        if stream.write(row):
+            stream.flush()
+    stream.flush()
+    return stream
+
+
+def sync_sequences(cur, building_id, floor_id, room_id, user_id, log_id):
+    sync_sequence(cur, 'buildings', 'building_id', building_id)
+    sync_sequence(cur, 'floors', 'floor_id', floor_id)
+    sync_sequence(cur, 'rooms', 'room_id', room_id)
+    sync_sequence(cur, 'users', 'user_id', user_id)
+    sync_sequence(cur, 'access_logs', 'log_id', log_id)
+
+
+def stream_stats(*streams):
+    return {stream.table: [stream.rows, stream.seconds] for stream in streams}
+
+
+def psql_generate_bulk(conn, scale=DEFAULT_SCALE, chunk_size=COPY_CHUNK_SIZE):
+    cur = conn.cursor()
+    t_start = time.time()
+    building_id, floor_id, room_id, user_id, log_id = max_ids(cur)
+
+    shapes = building_shapes(random.getrandbits(64), scale["buildings"], scale)
+    buildings, floors, rooms = copy_building_tree(
+        cur, building_tree_rows(shapes, building_id, floor_id, room_id), chunk_size)
+    users = copy_rows(cur, 'users', USER_COLUMNS, user_rows(scale["users"], user_id), chunk_size)
+
+    # Access logs point at the rooms and users loaded above
+    user_ids = range(user_id + 1, user_id + users.rows + 1)
+    room_ids = range(room_id + 1, room_id + rooms.rows + 1)
+    access_logs = copy_rows(cur, 'access_logs', ACCESS_LOG_COLUMNS,
+                            access_log_rows(scale["access_logs"], log_id, user_ids, room_ids), chunk_size)
+
+    sync_sequences(cur, building_id + buildings.rows, floor_id + floors.rows,
+                   room_id + rooms.rows, user_id + users.rows, log_id + access_logs.rows)
+    cur.close()
+
+    report_load_stats(stream_stats(buildings, floors, rooms, users, access_logs), "COPY")
+    print(f"COPY load finished in {time.time() - t_start:.2f}s")
+    return
+
+
+def seed_generators(seed):
+    # Make random, Faker and the pre-drawn value pools reproducible
+    random.seed(seed)
+    fake.seed_instance(seed)
+    for spec in SENSOR.values():
+        if spec['unit'] != 'boolean':
+            low, high = SENSOR_VALUE_RANGES[spec['unit']]
+            spec['values'] = [fake.random.uniform(low, high) for _ in range(100)]
+    for spec in DEVICE_CONTROL.values():
+        spec['power_consumption'] = [fake.random.uniform(1, 10) for _ in range(100)]
+
+
+# Range of the pre-drawn sensor values per unit of measure
+SENSOR_VALUE_RANGES = {
+    "farhenheit": (50, 90),
+    "percentage": (30, 60),
+    "lux": (200, 1000),
+}
+
 SENSOR = {
     "temperature": {
         "models": ["T1000", "T2000", "T3000"],
@@ -157,10 +445,13 @@ SENSOR = {
 }
 
 
-def generate_sensor_data(room_id):
-    sensor_type = random.choice(list(SENSOR.keys()))
+SENSOR_TYPES = list(SENSOR.keys())
+
+
+def generate_sensor_data(room_id, sensor_id=None):
+    sensor_type = random.choice(SENSOR_TYPES)
     return {
-        'sensor_id': fake.random_int(1, 1000),
+        'sensor_id': fake.random_int(1, 1000) if sensor_id is None else sensor_id,
         'room_id':  random.choice(room_id),
         'sensor_type': sensor_type,
         'model': random.choice(SENSOR[sensor_type]['models']),
@@ -173,9 +464,9 @@ def generate_sensor_data(room_id):
     }
 
 # Generate data for SensorData collection
-def generate_sensor_data_data(sensor_id, sensor_type):
+def generate_sensor_data_data(sensor_id, sensor_type, data_id=None):
     return {
-        'data_id': fake.random_int(1, 1000),
+        'data_id': fake.random_int(1, 1000) if data_id is None else data_id,
         'sensor_id': sensor_id,
         'timestamp': fake.date_time_this_decade().isoformat(),
         'data_type': sensor_type,
@@ -213,10 +504,10 @@ DEVICE_CONTROL = {
 }
 
 # Generate data for DeviceControls collection
-def generate_device_controls_data(room_id):
+def generate_device_controls_data(room_id, device_id=None):
     device_type = random.choice(list(DEVICE_CONTROL.keys()))
     return {
-        'device_id': fake.random_int(1, 100),
+        'device_id': fake.random_int(1, 100) if device_id is None else device_id,
         'room_id': random.choice(room_id),
         'device_type': device_type,
         'last_updated': fake.date_time_this_decade().isoformat(),
@@ -227,16 +518,149 @@ def generate_device_controls_data(room_id):
     }
 
 
-def mongo_data_generator(db, room_id):
+def mongo_documents(room_id, scale=DEFAULT_SCALE, first_ids=(0, 0, 0), timeseries=False):
+    # Yields (collection, document) with sensor, data and device ids assigned
+    # after first_ids. Readings point at the sensors generated here, whose types
+    # are kept one byte per sensor so memory does not grow with the readings.
+    # With timeseries the readings are in the layout of a time-series sensor_data.
+    sensor_id, data_id, device_id = first_ids
+    sensor_types = bytearray()
+    for i in range(scale["sensors"]):
+        sensor = generate_sensor_data(room_id, sensor_id + i + 1)
+        sensor_types.append(SENSOR_TYPES.index(sensor['sensor_type']))
+        yield 'sensors', sensor
+
+    for i in range(scale["sensor_readings"]):
+        index = random.randrange(len(sensor_types))
+        document = generate_sensor_data_data(
+            sensor_id + index + 1, SENSOR_TYPES[sensor_types[index]], data_id + i + 1)
+        yield 'sensor_data', to_timeseries_document(document) if timeseries else document
+
+    for i in range(scale["device_controls"]):
+        yield 'device_controls', generate_device_controls_data(room_id, device_id + i + 1)
+
+
+def mongo_data_generator(db, room_id, scale=DEFAULT_SCALE):
     # Insert data into collections
-    for _ in range(200):
-        sensor_data = generate_sensor_data(room_id)
-        db['sensors'].insert_one(sensor_data)
+    timeseries = timeseries_options(db) is not None
+    for collection, document in mongo_documents(room_id, scale, timeseries=timeseries):
+        db[collection].insert_one(document)
+
+    return
+
+
+class MongoBatchWriter:
+    """
+    Buffers documents per collection and flushes every full buffer with an
+    unordered insert_many. At most max_in_flight flushes run at once, adding
+    a document blocks while all of them are busy.
+    """
+
+    def __init__(self, db, batch_size=MONGO_BATCH_SIZE, max_in_flight=MONGO_MAX_IN_FLIGHT):
+        self.db = db
+        self.batch_size = batch_size
+        self.buffers = {}
+        self.inserted = {}
+        self.failed = {}
+        self.futures = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight)
+
+    def add(self, collection, document):
+        buffer = self.buffers.setdefault(collection, [])
+        buffer.append(document)
+        if len(buffer) >= self.batch_size:
+            self.flush(collection)
+
+    def add_many(self, collection, documents):
+        buffer = self.buffers.setdefault(collection, [])
+        buffer.extend(documents)
+        start = 0
+        while len(buffer) - start >= self.batch_size:
+            self.buffers[collection] = buffer[start:start + self.batch_size]
+            self.flush(collection)
+            start += self.batch_size
+        self.buffers[collection] = buffer[start:]
+
+    def flush(self, collection):
+        documents = self.buffers.get(collection)
+        if not documents:
+            return
+        self.buffers[collection] = []
+        self.slots.acquire()
+        future = self.executor.submit(self._insert, collection, documents)
+        future.add_done_callback(lambda _: self.slots.release())
+        # Surface errors of finished flushes and keep only the running ones
+        running = []
+        for pending in self.futures:
+            if pending.done():
+                pending.result()
+            else:
+                running.append(pending)
+        running.append(future)
+        self.futures = running
+
+    def _insert(self, collection, documents):
+        try:
+            result = self.db[collection].insert_many(documents, ordered=False)
+            inserted, failed = len(result.inserted_ids), 0
+        except BulkWriteError as error:
+            # Unordered inserts keep going past failed documents
+            inserted = error.details['nInserted']
+            failed = len(error.details['writeErrors'])
+        with self.lock:
+            self.inserted[collection] = self.inserted.get(collection, 0) + inserted
+            self.failed[collection] = self.failed.get(collection, 0) + failed
+
+    def close(self):
+        # The worker threads stop even when a flush failed
+        try:
+            for collection in list(self.buffers):
+                self.flush(collection)
+            for future in self.futures:
+                future.result()
+        finally:
+            self.futures = []
+            self.executor.shutdown()
+
+
+def mongo_data_generator_batched(db, room_id, scale=DEFAULT_SCALE, batch_size=MONGO_BATCH_SIZE,
+                                 max_in_flight=MONGO_MAX_IN_FLIGHT, verbose=True, first_ids=(0, 0, 0)):
+    t1 = time.time()
+    timeseries = timeseries_options(db) is not None
+    writer = MongoBatchWriter(db, batch_size, max_in_flight)
+    for collection, document in mongo_documents(room_id, scale, first_ids, timeseries):
+        writer.add(collection, document)
+    writer.close()
+    seconds = time.time() - t1
+
+    total = sum(writer.inserted.values())
+    if verbose:
+        print(f"Batched Mongo load (batch_size={batch_size}, max_in_flight={max_in_flight}):")
+        for collection, inserted in writer.inserted.items():
+            print(f"  {collection}: {inserted} documents inserted, {writer.failed[collection]} failed")
+        print(f"  {total} documents in {seconds:.2f}s ({total / seconds:,.0f} docs/sec)")
+    return total, seconds
 
-        sensor_data_data = generate_sensor_data_data(sensor_data['sensor_id'], sensor_data['sensor_type'])
-        db['sensor_data'].insert_one(sensor_data_data, room_id)
 
-        device_controls_data = generate_device_controls_data(room_id)
-        db['device_controls'].insert_one(device_controls_data)
+def benchmark_mongo_batch_sizes(db, room_id, scale=DEFAULT_SCALE, batch_sizes=(1, 10, 100, 1000, 5000),
+                                max_in_flight=MONGO_MAX_IN_FLIGHT):
+    # Each run loads into a scratch database with the sensor_data layout of db,
+    # and the scratch database is dropped afterwards
+    scratch_name = db.name + '_batch_benchmark'
+    options = timeseries_options(db)
+    results = {}
+    for batch_size in batch_sizes:
+        db.client.drop_database(scratch_name)
+        if options is not None:
+            db.client[scratch_name].create_collection(SENSOR_DATA, timeseries=options)
+        total, seconds = mongo_data_generator_batched(
+            db.client[scratch_name], room_id, scale, batch_size, max_in_flight, verbose=False)
+        results[batch_size] = total / seconds
+    db.client.drop_database(scratch_name)
 
-    return
\ No newline at end of file
+    print(f"Mongo insert throughput by batch size (max_in_flight={max_in_flight}):")
+    for batch_size, rate in results.items():
+        print(f"  batch_size={batch_size}: {rate:,.0f} docs/sec")
+    return results
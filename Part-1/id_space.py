@@ -0,0 +1,140 @@
+import random
+from array import array
+from bisect import bisect_right
+
+
+# Key spaces discovered by compile_ids: name -> (table, key column)
+ID_SPACES = {
+    "buildings": ("buildings", "building_id"),
+    "floors": ("floors", "floor_id"),
+    "rooms": ("rooms", "room_id"),
+    "users": ("users", "user_id"),
+}
+
+# A key space with more gaps than this is kept as a random sample instead
+MAX_RANGES = 1000
+SAMPLE_SIZE = 100000
+# A key space with more ids than this is sampled instead of read whole
+MAX_SCAN_ROWS = 10000000
+
+
+class IdSpace:
+    """
+    The ids of one key column, described as sorted, disjoint (low, high)
+    ranges, or as an array-backed random sample when the ids are too sparse
+    for that. Supports len() and indexing, so random.choice(space) picks an
+    id without the ids ever being materialised.
+    """
+
+    def __init__(self, ranges=(), sample=None):
+        self.ranges = sorted(ranges)
+        self.sample = sample
+        # offsets[i] is the number of ids before ranges[i]
+        self.offsets = []
+        total = 0
+        for low, high in self.ranges:
+            self.offsets.append(total)
+            total += high - low + 1
+        self.size = len(sample) if sample is not None else total
+
+    @property
+    def exact(self):
+        # False when only a sample of the ids is known
+        return self.sample is None
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError("IdSpace index out of range")
+        if self.sample is not None:
+            return self.sample[index]
+        i = bisect_right(self.offsets, index) - 1
+        return self.ranges[i][0] + index - self.offsets[i]
+
+    def __contains__(self, key):
+        if self.sample is not None:
+            return key in self.sample
+        i = bisect_right(self.ranges, (key, float('inf'))) - 1
+        return i >= 0 and self.ranges[i][0] <= key <= self.ranges[i][1]
+
+    def __iter__(self):
+        if self.sample is not None:
+            return iter(self.sample)
+        return (key for low, high in self.ranges for key in range(low, high + 1))
+
+    def choice(self, rng=random):
+        return self[rng.randrange(self.size)]
+
+    def __repr__(self):
+        if self.sample is not None:
+            return f"IdSpace(sample of {self.size} ids)"
+        return f"IdSpace({self.size} ids in {len(self.ranges)} ranges)"
+
+
+def discover_id_spaces(conn, spaces=ID_SPACES, max_ranges=MAX_RANGES, sample_size=SAMPLE_SIZE,
+                       max_scan_rows=MAX_SCAN_ROWS):
+    """
+    Describe every key space in one round trip. Each column is read in key
+    order through its index, at most max_scan_rows keys of it, and only the
+    ids that start a run of consecutive ids (gaps and islands) are sent back,
+    up to max_ranges + 1 of them. The scan stops there, so a fragmented column
+    costs no more than reading up to its gap past max_ranges. Columns with
+    more runs, or more keys than max_scan_rows, are sampled with a second query.
+    """
+    cur = conn.cursor()
+    parts, params = [], []
+    for name, (table, column) in spaces.items():
+        # Rows starting a run, and the last key read with the largest key of the table
+        parts.append(f"""
+            (SELECT %s, {column}, prev, next, (SELECT MAX({column}) FROM {table})
+             FROM (SELECT {column},
+                          LAG({column}) OVER (ORDER BY {column}) AS prev,
+                          LEAD({column}) OVER (ORDER BY {column}) AS next
+                   FROM (SELECT {column} FROM {table} ORDER BY {column} LIMIT %s) scanned) ids
+             WHERE prev IS NULL OR {column} - prev > 1 OR next IS NULL
+             ORDER BY {column}
+             LIMIT %s)
+        """)
+        params += [name, max_scan_rows, max_ranges + 2]
+    cur.execute(" UNION ALL ".join(parts) + ";", params)
+
+    rows = {name: [] for name in spaces}
+    for name, key, prev, following, largest in cur.fetchall():
+        rows[name].append((key, prev, following, largest))
+
+    ranges = {}
+    for name, space_rows in rows.items():
+        space_rows.sort()
+        if not space_rows:
+            ranges[name] = []
+            continue
+        last, _, following, largest = space_rows[-1]
+        starts = [(key, prev) for key, prev, _, _ in space_rows if prev is None or key - prev > 1]
+        if following is not None or last != largest or len(starts) > max_ranges:
+            # Cut off by the range or the scan limit
+            continue
+        ends = [prev for _, prev in starts[1:]] + [last]
+        ranges[name] = [(start, end) for (start, _), end in zip(starts, ends)]
+
+    id_spaces = {}
+    for name, (table, column) in spaces.items():
+        if name in ranges:
+            id_spaces[name] = IdSpace(ranges[name])
+            continue
+        # Too fragmented or too large to scan: keep a random sample. reltuples sizes
+        # the sample fraction, and is -1 before the first ANALYZE, which samples everything.
+        cur.execute(f"""
+            SELECT {column} FROM {table}
+            TABLESAMPLE BERNOULLI ((
+                SELECT LEAST(100, 100.0 * %s / GREATEST(reltuples, 1))
+                FROM pg_class WHERE oid = %s::regclass))
+            ORDER BY random()
+            LIMIT %s;
+        """, (2 * sample_size, table, sample_size))
+        id_spaces[name] = IdSpace(sample=array('q', (row[0] for row in cur.fetchall())))
+    cur.close()
+    return id_spaces
@@ -1,25 +1,119 @@
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
 import psycopg2
-from pymongo import MongoClient
-from data_generator import psql_generate, mongo_data_generator
+from common.db import (connect_psql_db, release_psql_db, psql_connection, get_mongo_client,
+                       stream_psql_rows, report_pool_metrics, close_all, PSQL_ITERSIZE,
+                       MONGO_FIND_BATCH_SIZE)
+from data_generator import (DEFAULT_SCALE, psql_generate, psql_generate_bulk, mongo_data_generator_batched,
+                            benchmark_mongo_batch_sizes, seed_generators, validate_scale)
+from parallel_generator import parallel_generate
+from timeseries import load_sensor_timeseries, compare_sensor_data_layouts
+from common.sensor_data import GRANULARITIES, create_sensor_data_collection, is_timeseries, sensor_data_query
+from common.sharding import SHARD_KEYS, is_mongos, shard_collections
+from common.cache import (PsqlInvalidationListener, cached_count_documents, cached_query,
+                          install_invalidation_triggers, invalidate_on_write, report_cache_metrics,
+                          watch_mongo_changes)
+from common.statements import execute_prepared, register_statement, report_statement_metrics
+from id_space import discover_id_spaces
 
 
 
 DB_NAME = "smart_building"
 
 
-def connect_psql_db(dbname="postgres"):
-    print(f"Connecting to {dbname}....")
+# Loader settings, overridden by a JSON config file (--config) and then by the
+# command line. The entity counts come from DEFAULT_SCALE in data_generator.
+DEFAULT_LOADER = {
+    # "copy" streams client-side generated rows through COPY FROM STDIN,
+    # "row" inserts every row with its own INSERT ... RETURNING round trip
+    "load_mode": "copy",
+    "copy_chunk_size": 50000,
+    # Documents per insert_many and number of concurrent insert_many calls for Mongo
+    "mongo_batch_size": 1000,
+    "mongo_max_in_flight": 4,
+    # Compare Mongo insert throughput across batch sizes before loading
+    "benchmark_mongo_batches": False,
+    # Number of generator processes, 0 generates everything in this process.
+    # Runs with the same seed and worker count produce the same data.
+    "workers": 0,
+    "seed": 512,
+    # Create the tables without keys, load, then build the primary keys and
+    # validate the foreign keys with finalize_workers connections
+    "defer_constraints": False,
+    "finalize_workers": 4,
+    # "faker" draws every sensor reading separately, "timeseries" generates
+    # regular per-sensor series with NumPy (sensor_readings readings in total)
+    "sensor_data_mode": "faker",
+    "reading_interval_seconds": 300,
+    "bad_quality_rate": 0.01,
+    "timeseries_start": "2023-01-01T00:00:00",
+    # "timeseries" creates sensor_data as a MongoDB time-series collection
+    # bucketed by sensor_id and data_type at timeseries_granularity
+    "sensor_data_collection": "plain",
+    "timeseries_granularity": "minutes",
+    # Readings loaded into scratch databases to compare the sensor_data
+    # layouts after the load, 0 skips the comparison
+    "compare_sensor_data_layouts": 0,
+    # Rows per round trip of the server-side cursors and documents per batch
+    # of the Mongo cursors used by the retrieval queries
+    "fetch_itersize": PSQL_ITERSIZE,
+    "mongo_find_batch_size": MONGO_FIND_BATCH_SIZE,
+}
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Create the Smart-Building databases and load generated data")
+    parser.add_argument("--config", help="JSON file with entity counts and loader settings")
+    for key, value in DEFAULT_SCALE.items():
+        parser.add_argument("--" + key.replace("_", "-"), type=int, help=f"default {value}")
+    parser.add_argument("--load-mode", choices=["copy", "row"])
+    parser.add_argument("--copy-chunk-size", type=int)
+    parser.add_argument("--mongo-batch-size", type=int)
+    parser.add_argument("--mongo-max-in-flight", type=int)
+    parser.add_argument("--benchmark-mongo-batches", action="store_true", default=None)
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--defer-constraints", action="store_true", default=None)
+    parser.add_argument("--finalize-workers", type=int)
+    parser.add_argument("--sensor-data-mode", choices=["faker", "timeseries"])
+    parser.add_argument("--reading-interval-seconds", type=int)
+    parser.add_argument("--bad-quality-rate", type=float)
+    parser.add_argument("--timeseries-start")
+    parser.add_argument("--sensor-data-collection", choices=["plain", "timeseries"])
+    parser.add_argument("--timeseries-granularity", choices=GRANULARITIES)
+    parser.add_argument("--compare-sensor-data-layouts", type=int, metavar="READINGS")
+    parser.add_argument("--fetch-itersize", type=int)
+    parser.add_argument("--mongo-find-batch-size", type=int)
+    return parser
+
+
+def load_settings(parser):
+    # Defaults, then the config file, then the command line
+    args = parser.parse_args()
+    settings = {**DEFAULT_SCALE, **DEFAULT_LOADER}
+    if args.config:
+        with open(args.config) as config_file:
+            config = json.load(config_file)
+        unknown = set(config) - set(settings)
+        if unknown:
+            parser.error(f"Unknown settings in {args.config}: {', '.join(sorted(unknown))}")
+        settings.update(config)
+    for key in settings:
+        value = getattr(args, key)
+        if value is not None:
+            settings[key] = value
+
+    scale = {key: settings[key] for key in DEFAULT_SCALE}
     try:
-        connection = psycopg2.connect(  user="postgres",
-                                        password="Password",
-                                        host="127.0.0.1",
-                                        port="5432",
-                                        database=dbname)
-        connection.set_session(autocommit=True)
-        print(f"Connected to {dbname}")
-        return connection
-    except (Exception, psycopg2.Error) as error:
-        print("Error while connecting to PostgreSQL", error)
+        validate_scale(scale)
+    except ValueError as error:
+        parser.error(str(error))
+    return scale, settings
 
 
 def create_psql_SB_db(conn):
@@ -35,89 +129,169 @@ def create_psql_SB_db(conn):
         print("Error while creating Smart-Building database: ", error)
 
 
-def create_psql_tables(conn):
+# Smart-Building tables as (column, type) pairs, without keys
+PSQL_TABLES = {
+    "buildings": [
+        ("building_id", "SERIAL"),
+        ("building_name", "VARCHAR(255)"),
+        ("address", "VARCHAR(255)"),
+        ("total_floors", "INT"),
+        ("construction_year", "INT"),
+        ("building_type", "VARCHAR(50)"),
+        ("emergency_contact", "VARCHAR(50)"),
+        ("maintenance_contact", "VARCHAR(50)"),
+        ("energy_rating", "VARCHAR(2)"),
+        ("building_status", "VARCHAR(50)"),
+    ],
+    "floors": [
+        ("floor_id", "SERIAL"),
+        ("building_id", "INT"),
+        ("floor_number", "INT"),
+        ("description", "TEXT"),
+        ("total_rooms", "INT"),
+        ("floor_area", "FLOAT"),
+        ("fire_escape_plan", "TEXT"),
+        ("access_control_level", "VARCHAR(50)"),
+    ],
+    "rooms": [
+        ("room_id", "SERIAL"),
+        ("floor_id", "INT"),
+        ("room_name", "VARCHAR(255)"),
+        ("room_type", "VARCHAR(50)"),
+        ("room_size", "FLOAT"),
+        ("occupancy_limit", "INT"),
+        ("accessibility_features", "TEXT"),
+        ("room_status", "VARCHAR(50)"),
+    ],
+    "users": [
+        ("user_id", "SERIAL"),
+        ("user_name", "VARCHAR(255)"),
+        ("email", "VARCHAR(255)"),
+        ("role", "VARCHAR(50)"),
+        ("password_hash", "TEXT"),
+        ("date_joined", "DATE"),
+        ("last_login_date", "DATE"),
+        ("phone_number", "VARCHAR(50)"),
+        ("emergency_contact", "VARCHAR(50)"),
+        ("access_level", "VARCHAR(50)"),
+    ],
+    "access_logs": [
+        ("log_id", "SERIAL"),
+        ("user_id", "INT"),
+        ("room_id", "INT"),
+        ("timestamp", "TIMESTAMP"),
+        ("access_type", "VARCHAR(50)"),
+        ("access_method", "VARCHAR(50)"),
+        ("access_status", "VARCHAR(50)"),
+    ],
+}
+
+PRIMARY_KEYS = {
+    "buildings": "building_id",
+    "floors": "floor_id",
+    "rooms": "room_id",
+    "users": "user_id",
+    "access_logs": "log_id",
+}
+
+# (table, column, referenced table, referenced column)
+FOREIGN_KEYS = [
+    ("floors", "building_id", "buildings", "building_id"),
+    ("rooms", "floor_id", "floors", "floor_id"),
+    ("access_logs", "user_id", "users", "user_id"),
+    ("access_logs", "room_id", "rooms", "room_id"),
+]
+
+# Memory for each primary key build and foreign key validation
+FINALIZE_MAINTENANCE_WORK_MEM = "256MB"
+
+
+def create_psql_tables(conn, deferred=False):
+    # With deferred=True the tables are created without primary and foreign
+    # keys, finalize_psql_tables adds them after the data is loaded
     print("Creating tables buildings, floors, rooms, users, access_logs....")
     try:
         cur = conn.cursor()
-        # Buildings Table
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS buildings (
-                building_id SERIAL PRIMARY KEY,
-                building_name VARCHAR(255),
-                address VARCHAR(255),
-                total_floors INT,
-                construction_year INT,
-                building_type VARCHAR(50),
-                emergency_contact VARCHAR(50),
-                maintenance_contact VARCHAR(50),
-                energy_rating VARCHAR(2),
-                building_status VARCHAR(50)
-            );
-        """)
-
-        # Floors Table
-        cur.execute("""
-            CREATE TABLE floors (
-                floor_id SERIAL PRIMARY KEY,
-                building_id INT REFERENCES buildings(building_id),
-                floor_number INT,
-                description TEXT,
-                total_rooms INT,
-                floor_area FLOAT,
-                fire_escape_plan TEXT,
-                access_control_level VARCHAR(50)
-            );
-        """)
-
-        # Rooms Table
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS rooms (
-                room_id SERIAL PRIMARY KEY,
-                floor_id INT REFERENCES floors(floor_id),
-                room_name VARCHAR(255),
-                room_type VARCHAR(50),
-                room_size FLOAT,
-                occupancy_limit INT,
-                accessibility_features TEXT,
-                room_status VARCHAR(50)
-            );
-        """)
-
-        # Users Table
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id SERIAL PRIMARY KEY,
-                user_name VARCHAR(255),
-                email VARCHAR(255),
-                role VARCHAR(50),
-                password_hash TEXT,
-                date_joined DATE,
-                last_login_date DATE,
-                phone_number VARCHAR(50),
-                emergency_contact VARCHAR(50),
-                access_level VARCHAR(50)
-            );
-        """)
-
-        # AccessLogs Table
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS access_logs (
-                log_id SERIAL PRIMARY KEY,
-                user_id INT REFERENCES users(user_id),
-                room_id INT REFERENCES rooms(room_id),
-                timestamp TIMESTAMP,
-                access_type VARCHAR(50),
-                access_method VARCHAR(50),
-                access_status VARCHAR(50)
-            );
-        """)
+        for table, columns in PSQL_TABLES.items():
+            definitions = []
+            for column, column_type in columns:
+                definition = f"{column} {column_type}"
+                if not deferred:
+                    if PRIMARY_KEYS[table] == column:
+                        definition += " PRIMARY KEY"
+                    for fk_table, fk_column, ref_table, ref_column in FOREIGN_KEYS:
+                        if (fk_table, fk_column) == (table, column):
+                            definition += f" REFERENCES {ref_table}({ref_column})"
+                definitions.append(definition)
+            cur.execute(f"CREATE TABLE IF NOT EXISTS {table} ({', '.join(definitions)});")
         cur.close()
-        print("Created tables")
+        print("Created tables" + (" without keys" if deferred else ""))
     except (Exception, psycopg2.Error) as error:
         print("Error while creating tables: ", error)
 
 
-def create_mongo_collections(db):
+def run_timed(dbname, statements):
+    # Run each statement on its own pooled connection, returns seconds per statement
+    with psql_connection(dbname) as conn:
+        cur = conn.cursor()
+        cur.execute("SET maintenance_work_mem = %s;", (FINALIZE_MAINTENANCE_WORK_MEM,))
+        timings = []
+        for statement in statements:
+            t1 = time.time()
+            cur.execute(statement)
+            timings.append((statement, time.time() - t1))
+        cur.close()
+    return timings
+
+
+def run_phase(dbname, name, groups, workers, phase_timings):
+    # Statement groups run in parallel, the statements of one group in order
+    print(f"Finalize phase '{name}'....")
+    t1 = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for timings in executor.map(lambda group: run_timed(dbname, group), groups):
+            for statement, seconds in timings:
+                print(f"  {seconds:8.2f}s  {statement}")
+    phase_timings[name] = time.time() - t1
+
+
+def finalize_psql_tables(dbname, workers=4, phase_timings=None):
+    """
+    Add the keys left out by create_psql_tables(deferred=True). The primary
+    keys are built in parallel, one table per connection. The foreign keys
+    are then added NOT VALID, which skips the check, and validated in
+    parallel. Validation only takes a SHARE UPDATE EXCLUSIVE lock on the
+    referencing table. Finally the tables are analyzed.
+    """
+    phase_timings = {} if phase_timings is None else phase_timings
+    run_phase(dbname, "primary keys", [
+        [f"ALTER TABLE {table} ADD CONSTRAINT {table}_pkey PRIMARY KEY ({column});"]
+        for table, column in PRIMARY_KEYS.items()
+    ], workers, phase_timings)
+
+    # Constraint names match the ones PostgreSQL picks for inline REFERENCES
+    run_phase(dbname, "foreign keys (not valid)", [[
+        f"ALTER TABLE {table} ADD CONSTRAINT {table}_{column}_fkey FOREIGN KEY ({column}) "
+        f"REFERENCES {ref_table}({ref_column}) NOT VALID;"
+        for table, column, ref_table, ref_column in FOREIGN_KEYS
+    ]], 1, phase_timings)
+    # Validations of one table would queue on its lock, so they share a group
+    validations = {}
+    for table, column, _, _ in FOREIGN_KEYS:
+        validations.setdefault(table, []).append(f"ALTER TABLE {table} VALIDATE CONSTRAINT {table}_{column}_fkey;")
+    run_phase(dbname, "validate foreign keys", list(validations.values()), workers, phase_timings)
+
+    run_phase(dbname, "analyze", [[f"ANALYZE {table};"] for table in PSQL_TABLES], workers, phase_timings)
+    return phase_timings
+
+
+def report_phase_timings(phase_timings):
+    print("Phase timings:")
+    for name, seconds in phase_timings.items():
+        print(f"  {name}: {seconds:.2f}s")
+
+
+def create_mongo_collections(db, timeseries=False, granularity="minutes"):
 
     print("Creating collections sensors, sensor_data, device_controls....")
 
@@ -130,8 +304,8 @@ def create_mongo_collections(db):
     if db['sensor_data'] is not None:
         db['sensor_data'].drop()
 
-    # SensorData Collection
-    sensor_data = db['sensor_data']
+    # SensorData Collection, optionally a time-series collection
+    sensor_data = create_sensor_data_collection(db, timeseries, granularity)
 
 
     if db['device_controls'] is not None:
@@ -140,163 +314,316 @@ def create_mongo_collections(db):
     # DeviceControls Collection
     device_controls = db['device_controls']
 
+    # Through mongos the new collections are sharded before any data arrives
+    if is_mongos(db.client):
+        shard_collections(db.client, db.name)
+        print(f"Sharded {', '.join(SHARD_KEYS)}")
+
     print("Created collections")
 
 
 def compile_ids(conn):
-    cur = conn.cursor()
-    cur.execute("SELECT DISTINCT building_id FROM buildings")
-    building_ids = cur.fetchall()
-    building_ids = [building_id[0] for building_id in building_ids]
+    # Key spaces as compact id ranges, discovered in one round trip
+    id_spaces = discover_id_spaces(conn)
+    return id_spaces["buildings"], id_spaces["floors"], id_spaces["rooms"], id_spaces["users"]
 
-    cur.execute("SELECT DISTINCT floor_id FROM floors")
-    floor_ids = cur.fetchall()
-    floor_ids = [floor_id[0] for floor_id in floor_ids]
 
-    cur.execute("SELECT DISTINCT room_id FROM rooms")
-    room_ids = cur.fetchall()
-    room_ids = [room_id[0] for room_id in room_ids]
+# Tables the cached dashboard queries read, invalidated through LISTEN/NOTIFY
+DASHBOARD_TABLES = ["buildings", "floors", "access_logs"]
 
-    cur.execute("SELECT DISTINCT user_id FROM users")
-    user_ids = cur.fetchall()
-    user_ids = [user_id[0] for user_id in user_ids]
 
-    return building_ids, floor_ids, room_ids, user_ids
+def operational_building_count(conn):
+    return cached_query(conn, """ SELECT COUNT(*) 
+                    FROM Buildings 
+                    WHERE building_status = 'Operational';
+                """)[0][0]
 
 
-def basic_data_retrival_psql(conn):
+def building_floors(conn, building_id):
+    # The floors of a building are few, so they are cached whole instead of streamed
+    return cached_query(conn, """
+        SELECT * FROM floors f
+        WHERE f.building_id = %s;
+    """, (building_id,))
 
+
+def bookable_accessible_offices(conn, itersize=PSQL_ITERSIZE):
+    return stream_psql_rows(conn, """
+        SELECT * FROM rooms
+        WHERE accessibility_features = 'Wheelchair accessible' and room_type = 'Office' and room_status = 'Available';
+    """, itersize=itersize)
+
+
+# A keyed lookup with few rows, prepared once per connection instead of
+# streamed, as a named cursor is planned again by every DECLARE
+register_statement("admin_users", """
+    SELECT * FROM users
+    WHERE role = 'Admin' and user_name LIKE %s;
+""")
+
+
+def prepared_rows(conn, statement, params):
     cur = conn.cursor()
+    execute_prepared(cur, statement, params)
+    rows = cur.fetchall()
+    cur.close()
+    return rows
+
+
+def admin_users(conn, name_prefix):
+    return prepared_rows(conn, "admin_users", (name_prefix + '%',))
+
+
+def denied_access_log_count(conn):
+    return cached_query(conn, """
+        SELECT COUNT(*) FROM access_logs
+        WHERE access_status = 'Denied';
+    """)[0][0]
+
+
+def denied_access_read_after_write(conn):
+    # Our own insert invalidates the cached count at once, before its NOTIFY arrives
+    before = denied_access_log_count(conn)
+    cur = conn.cursor()
+    cur.execute("""
+        INSERT INTO access_logs (user_id, room_id, timestamp, access_type, access_method, access_status)
+        SELECT user_id, room_id, timestamp, access_type, access_method, 'Denied' FROM access_logs LIMIT 1
+        RETURNING log_id;
+    """)
+    log_id = cur.fetchone()[0]
+    after = denied_access_log_count(conn)
+    cur.execute("DELETE FROM access_logs WHERE log_id = %s;", (log_id,))
+    cur.close()
+    print(f"Denied access logs: {before} before our insert, {after} right after it, "
+          f"{denied_access_log_count(conn)} after deleting it again")
+
+
+def room_access_logs(conn, room_id, itersize=PSQL_ITERSIZE):
+    # The access logs of a room grow without bound, so they are streamed. A
+    # DECLARE cannot run a prepared statement, so this one is not prepared.
+    return stream_psql_rows(conn, """
+        SELECT * FROM access_logs
+        WHERE room_id = %s;
+    """, (room_id,), itersize)
+
+
+def basic_data_retrival_psql(conn, itersize=PSQL_ITERSIZE):
 
     # Count all Operational Buildings
-    
-    cur.execute(""" SELECT COUNT(*) 
-                    FROM Buildings 
-                    WHERE building_status = 'Operational';
-                """)
-    print("Number of Operational Buildings: ", cur.fetchall()[0][0])
+    print("Number of Operational Buildings: ", operational_building_count(conn))
 
     # Get all floors of building 1
     print("All floors of building 1: ")
-    cur.execute("""
-        SELECT * FROM floors f
-        WHERE f.building_id = 1;
-    """)
-    for i,floor in enumerate(cur.fetchall()):
+    for i,floor in enumerate(building_floors(conn, 1)):
         print(f"{i}) {floor}")
     
 
     # Select office rooms with wheelchair accessibility and that is available for booking
     print("All Office rooms with wheelchair accessibility that is available for booking:")
-    cur.execute("""
-        SELECT * FROM rooms
-        WHERE accessibility_features = 'Wheelchair accessible' and room_type = 'Office' and room_status = 'Available';
-    """)
-    for i,room in enumerate(cur.fetchall()):
+    for i,room in enumerate(bookable_accessible_offices(conn, itersize)):
         print(f"{i}) {room}")
     
     # Select users with admin role with name starting with 'A'
     print("All users with admin role: ")
-    cur.execute("""
-        SELECT * FROM users
-        WHERE role = 'Admin' and user_name LIKE 'A%';
-    """)
-    for i,user in enumerate(cur.fetchall()):
+    for i,user in enumerate(admin_users(conn, 'A')):
         print(f"{i}) {user}")
 
     # Count the number of denied access logs
-    cur.execute("""
-        SELECT COUNT(*) FROM access_logs
-        WHERE access_status = 'Denied';
-    """)
-    print("Number of denied access logs: ",cur.fetchall()[0][0])
+    print("Number of denied access logs: ", denied_access_log_count(conn))
 
     # Select access logs for a specific room
     print("Access logs for room (id=5): ")
-    cur.execute("""
-        SELECT * FROM access_logs
-        WHERE room_id = 5;
-    """)
-    for i,log in enumerate(cur.fetchall()):
+    for i,log in enumerate(room_access_logs(conn, 5, itersize)):
         print(f"{i}) {log}")
 
-    cur.close()
+
+# Fields returned by the Mongo retrieval queries
+SENSOR_PROJECTION = {'_id': 0, 'sensor_id': 1, 'room_id': 1, 'sensor_type': 1, 'model': 1,
+                     'manufacturer': 1, 'sensor_status': 1}
+SENSOR_DATA_PROJECTION = {'_id': 0, 'data_id': 1, 'sensor_id': 1, 'meta': 1, 'timestamp': 1, 'data_type': 1,
+                          'data_value': 1, 'unit_of_measure': 1, 'data_quality': 1}
+DEVICE_CONTROL_PROJECTION = {'_id': 0, 'device_id': 1, 'room_id': 1, 'device_type': 1, 'control_protocol': 1,
+                             'device_status': 1}
+
+
+def sensors_by_type_and_model(db, sensor_type, model, batch_size=MONGO_FIND_BATCH_SIZE):
+    return db['sensors'].find({'sensor_type': sensor_type, 'model': model}, SENSOR_PROJECTION,
+                              batch_size=batch_size)
 
 
-def basic_data_retrival_mongo(db):
+def sensor_readings(db, sensor_id, batch_size=MONGO_FIND_BATCH_SIZE):
+    query = sensor_data_query({'sensor_id': sensor_id}, is_timeseries(db))
+    return db['sensor_data'].find(query, SENSOR_DATA_PROJECTION, batch_size=batch_size)
+
+
+def device_controls_by_type_and_protocol(db, device_type, protocol, batch_size=MONGO_FIND_BATCH_SIZE):
+    return db['device_controls'].find({'device_type': device_type, 'control_protocol': protocol},
+                                      DEVICE_CONTROL_PROJECTION, batch_size=batch_size)
+
+
+def inactive_sensor_count(db):
+    return cached_count_documents(db['sensors'], {'sensor_status': 'inactive'})
+
+
+def dashboard_latency(conn, db, repetitions=1000):
+    # Average latency of the cached dashboard queries, the first call fills the cache
+    queries = {
+        "operational buildings": lambda: operational_building_count(conn),
+        "floors of building 1": lambda: building_floors(conn, 1),
+        "denied access logs": lambda: denied_access_log_count(conn),
+        "inactive sensors": lambda: inactive_sensor_count(db),
+    }
+    for name, query in queries.items():
+        t1 = time.perf_counter()
+        query()
+        first = time.perf_counter() - t1
+        t1 = time.perf_counter()
+        for _ in range(repetitions):
+            query()
+        cached = (time.perf_counter() - t1) / repetitions
+        print(f"  {name}: first call {first * 1000:.2f}ms, cached {cached * 1e6:.1f}us")
+
+
+def basic_data_retrival_mongo(db, batch_size=MONGO_FIND_BATCH_SIZE):
 
     # Find all sensors with sensor type 'Temperature' and model 'T3000
     print("All sensors with sensor type temperature and model T3000: ")
-    sensors = db['sensors']
-    for i,sensor in enumerate(sensors.find({'sensor_type': 'temperature', 'model': 'T3000'})):
+    for i,sensor in enumerate(sensors_by_type_and_model(db, 'temperature', 'T3000', batch_size)):
         print(f"{i}. {sensor}")
 
     # Count all inactive sensors
-    print("Number of inactive sensors: ", sensors.count_documents({'sensor_status': 'inactive'}))
+    print("Number of inactive sensors: ", inactive_sensor_count(db))
 
     # Find Sensor Data with id = 158
     print("Sensor Data with id = 158: ")
-    sensor_data = db['sensor_data']
-    for i,data in enumerate(sensor_data.find({'sensor_id': 158})):
+    for i,data in enumerate(sensor_readings(db, 158, batch_size)):
         print(f"{i}. {data}")
     
 
     # Count sensor data with poor quality
-    print("Number of sensor data with bad quality: ", sensor_data.count_documents({'data_quality': 'bad'}))
+    print("Number of sensor data with bad quality: ", db['sensor_data'].count_documents({'data_quality': 'bad'}))
 
 
     # Find all device controls with device type 'CCTV' and running the ZigBee communication protocol
     print("All device controls with device type 'CCTV' and running the ZigBee communication protocol: ")
-    device_controls = db['device_controls']
-    for i,control in enumerate(device_controls.find({'device_type':'CCTV','control_protocol':'Zigbee'})):
+    for i,control in enumerate(device_controls_by_type_and_protocol(db, 'CCTV', 'Zigbee', batch_size)):
         print(f"{i}. {control}")
 
 
 if __name__ == "__main__":
+    scale, settings = load_settings(build_parser())
+
     # Connect to PostgreSQL
     conn = connect_psql_db()
 
     # Create Smart-Building database
     create_psql_SB_db(conn)
+    release_psql_db(conn)
 
     # Connect to Smart-Building database
     conn = connect_psql_db(DB_NAME)
 
-    # Create tables
-    create_psql_tables(conn)
+    # Create tables, without keys when they are built after the load
+    defer_constraints = settings["defer_constraints"]
+    phase_timings = {}
+    t1 = time.time()
+    create_psql_tables(conn, deferred=defer_constraints)
+    phase_timings["create tables"] = time.time() - t1
 
     # Connect to MongoDB
-    client = MongoClient('mongodb://127.0.0.1:27017/')
+    client = get_mongo_client()
 
     # Connect to Smart-Building database
     db = client[DB_NAME]
 
     # Create collections
-    create_mongo_collections(db)
-
-
-    # Generate and Insert data
-    psql_generate(conn)
-
-    # Compile ids
-    building_ids, floor_ids, room_ids, user_ids = compile_ids(conn)
-
-    # Generate and Insert data
-    mongo_data_generator(db, room_ids)
-
-    # Basic Data Retrieval Queries
-
-    basic_data_retrival_psql(conn)
-    basic_data_retrival_mongo(db)
+    create_mongo_collections(db, settings["sensor_data_collection"] == "timeseries",
+                             settings["timeseries_granularity"])
+
+
+    # Time series readings are generated after the sensors exist
+    timeseries = settings["sensor_data_mode"] == "timeseries"
+    document_scale = {**scale, "sensor_readings": 0} if timeseries else scale
+
+    if settings["workers"]:
+        # Generate and Insert data into PostgreSQL and Mongo from a process pool
+        t1 = time.time()
+        parallel_generate(DB_NAME, document_scale,
+                          seed=settings["seed"], workers=settings["workers"],
+                          chunk_size=settings["copy_chunk_size"],
+                          batch_size=settings["mongo_batch_size"],
+                          max_in_flight=settings["mongo_max_in_flight"])
+        phase_timings["load (PostgreSQL and Mongo)"] = time.time() - t1
+        if defer_constraints:
+            finalize_psql_tables(DB_NAME, settings["finalize_workers"], phase_timings)
+    else:
+        seed_generators(settings["seed"])
+
+        # Generate and Insert data
+        t1 = time.time()
+        if settings["load_mode"] == "copy":
+            psql_generate_bulk(conn, scale, settings["copy_chunk_size"])
+        else:
+            psql_generate(conn, scale)
+        phase_timings["load"] = time.time() - t1
+        if defer_constraints:
+            finalize_psql_tables(DB_NAME, settings["finalize_workers"], phase_timings)
+
+        # Compile ids
+        building_ids, floor_ids, room_ids, user_ids = compile_ids(conn)
+
+        # Generate and Insert data
+        if settings["benchmark_mongo_batches"]:
+            benchmark_mongo_batch_sizes(db, room_ids, document_scale, max_in_flight=settings["mongo_max_in_flight"])
+        mongo_data_generator_batched(db, room_ids, document_scale, settings["mongo_batch_size"],
+                                     settings["mongo_max_in_flight"])
+
+    if timeseries:
+        load_sensor_timeseries(db, scale["sensor_readings"], settings["timeseries_start"],
+                               settings["reading_interval_seconds"], settings["bad_quality_rate"],
+                               settings["seed"], settings["mongo_batch_size"],
+                               settings["mongo_max_in_flight"])
+
+    report_phase_timings(phase_timings)
+
+    # Basic Data Retrieval Queries, the dashboard ones through the result cache.
+    # Writes to their tables from any client invalidate it through LISTEN/NOTIFY.
+    install_invalidation_triggers(conn, DASHBOARD_TABLES)
+    invalidation_listener = PsqlInvalidationListener(DB_NAME, tables=DASHBOARD_TABLES).start()
+    # The cached sensor count through a change stream, when the server has them
+    change_listener = watch_mongo_changes(db, ["sensors"])
+
+    # Our own writes on conn invalidate as soon as they ran
+    with invalidate_on_write(conn):
+        basic_data_retrival_psql(conn, settings["fetch_itersize"])
+        basic_data_retrival_mongo(db, settings["mongo_find_batch_size"])
+
+        print("Latency of the repeated dashboard queries:")
+        dashboard_latency(conn, db)
+        denied_access_read_after_write(conn)
+    report_cache_metrics()
+    invalidation_listener.stop()
+    if change_listener is not None:
+        change_listener.stop()
+    report_statement_metrics(conn)
+
+    if settings["compare_sensor_data_layouts"]:
+        compare_sensor_data_layouts(client, settings["compare_sensor_data_layouts"], scale["sensors"],
+                                    settings["timeseries_start"], settings["reading_interval_seconds"],
+                                    settings["timeseries_granularity"], seed=settings["seed"],
+                                    batch_size=settings["mongo_batch_size"],
+                                    max_in_flight=settings["mongo_max_in_flight"])
     
 
 
 
 
 
+    report_pool_metrics()
+
     # Close the connection
-    client.close()
-    conn.close()
+    release_psql_db(conn)
+    close_all()
 
 
 
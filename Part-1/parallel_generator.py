@@ -0,0 +1,178 @@
+import hashlib
+import os
+import sys
+import time
+from multiprocessing import Pool
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.db import get_mongo_client, psql_connection
+from data_generator import (ACCESS_LOG_COLUMNS, COPY_CHUNK_SIZE, DEFAULT_SCALE, MONGO_BATCH_SIZE,
+                            MONGO_MAX_IN_FLIGHT, USER_COLUMNS, access_log_rows, building_shapes,
+                            building_tree_rows, copy_building_tree, copy_rows, max_ids,
+                            mongo_data_generator_batched, report_load_stats, seed_generators,
+                            stream_stats, sync_sequences, user_rows, validate_scale)
+
+
+def derive_seed(base_seed, *parts):
+    # Stable 64 bit seed for a (phase, shard) pair, independent of which process runs it
+    key = ":".join(str(part) for part in (base_seed,) + parts)
+    return int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], "big")
+
+
+def split_range(start, count, shards):
+    # Split count keys after start into shards contiguous (start, count) slices
+    size, extra = divmod(count, shards)
+    slices = []
+    for shard in range(shards):
+        length = size + (1 if shard < extra else 0)
+        slices.append((start, length))
+        start += length
+    return slices
+
+
+def shard_shape_totals(task):
+    # Number of floors and rooms a building shard will generate
+    floors = rooms = 0
+    for shape in building_shapes(task["shape_seed"], task["count"], task["scale"]):
+        floors += len(shape)
+        rooms += sum(shape)
+    return floors, rooms
+
+
+def load_structure_shard(task):
+    # Phase 1: buildings, floors, rooms and users of one shard
+    seed_generators(task["seed"])
+    with psql_connection(task["dbname"]) as conn:
+        cur = conn.cursor()
+        shapes = building_shapes(task["shape_seed"], task["buildings"], task["scale"])
+        tree = copy_building_tree(
+            cur, building_tree_rows(shapes, task["building_id"], task["floor_id"], task["room_id"]),
+            task["chunk_size"])
+        users = copy_rows(cur, 'users', USER_COLUMNS, user_rows(task["users"], task["user_id"]),
+                          task["chunk_size"])
+        cur.close()
+    return stream_stats(*tree, users)
+
+
+def load_activity_shard(task):
+    # Phase 2: access logs and Mongo documents of one shard, pointing at the
+    # rooms and users loaded by every shard in phase 1
+    seed_generators(task["seed"])
+    user_ids = range(task["user_ids"][0], task["user_ids"][1] + 1)
+    room_ids = range(task["room_ids"][0], task["room_ids"][1] + 1)
+
+    with psql_connection(task["dbname"]) as conn:
+        cur = conn.cursor()
+        access_logs = copy_rows(cur, 'access_logs', ACCESS_LOG_COLUMNS,
+                                access_log_rows(task["access_logs"], task["log_id"], user_ids, room_ids),
+                                task["chunk_size"])
+        cur.close()
+    stats = stream_stats(access_logs)
+
+    documents, seconds = mongo_data_generator_batched(
+        get_mongo_client()[task["dbname"]], room_ids, task["mongo_scale"], task["batch_size"],
+        task["max_in_flight"], verbose=False, first_ids=task["mongo_first_ids"])
+    stats["mongo"] = [documents, seconds]
+    return stats
+
+
+def merge_stats(results):
+    merged = {}
+    for stats in results:
+        for table, (rows, seconds) in stats.items():
+            merged.setdefault(table, [0, 0.0])
+            merged[table][0] += rows
+            merged[table][1] += seconds
+    return merged
+
+
+def parallel_generate(dbname, scale=DEFAULT_SCALE, seed=0, workers=None,
+                      chunk_size=COPY_CHUNK_SIZE, batch_size=MONGO_BATCH_SIZE,
+                      max_in_flight=MONGO_MAX_IN_FLIGHT):
+    """
+    Generate the Part-1 data set with a process pool. The building, user,
+    access log and sensor ranges are split into one shard per worker and
+    every shard is generated from a seed derived from seed, so a run with the
+    same seed and worker count produces the same rows. Every worker writes its
+    own shard to the dbname databases of PostgreSQL and Mongo.
+    """
+    validate_scale(scale)
+    workers = workers or os.cpu_count()
+    if scale["sensor_readings"]:
+        # Readings of a shard point at the sensors of the same shard
+        workers = min(workers, scale["sensors"])
+    t_start = time.time()
+
+    with psql_connection(dbname) as conn:
+        cur = conn.cursor()
+        building_id, floor_id, room_id, user_id, log_id = max_ids(cur)
+        cur.close()
+    first_user_id, first_room_id = user_id + 1, room_id + 1
+
+    building_slices = split_range(building_id, scale["buildings"], workers)
+    user_slices = split_range(user_id, scale["users"], workers)
+    log_slices = split_range(log_id, scale["access_logs"], workers)
+    sensor_slices = split_range(0, scale["sensors"], workers)
+    reading_slices = split_range(0, scale["sensor_readings"], workers)
+    device_slices = split_range(0, scale["device_controls"], workers)
+
+    with Pool(processes=workers) as pool:
+        # Floor and room keys depend on the shape of the earlier shards
+        shape_seeds = [derive_seed(seed, "shape", shard) for shard in range(workers)]
+        totals = pool.map(shard_shape_totals, [
+            {"shape_seed": shape_seeds[shard], "count": building_slices[shard][1], "scale": scale}
+            for shard in range(workers)
+        ])
+
+        structure_tasks = []
+        for shard in range(workers):
+            structure_tasks.append({
+                "seed": derive_seed(seed, "structure", shard),
+                "shape_seed": shape_seeds[shard],
+                "scale": scale,
+                "dbname": dbname,
+                "chunk_size": chunk_size,
+                "building_id": building_slices[shard][0],
+                "buildings": building_slices[shard][1],
+                "floor_id": floor_id,
+                "room_id": room_id,
+                "user_id": user_slices[shard][0],
+                "users": user_slices[shard][1],
+            })
+            floor_id += totals[shard][0]
+            room_id += totals[shard][1]
+        structure_stats = pool.map(load_structure_shard, structure_tasks)
+
+        user_id = first_user_id + scale["users"] - 1
+        activity_tasks = [{
+            "seed": derive_seed(seed, "activity", shard),
+            "dbname": dbname,
+            "chunk_size": chunk_size,
+            "batch_size": batch_size,
+            "max_in_flight": max_in_flight,
+            "user_ids": (first_user_id, user_id),
+            "room_ids": (first_room_id, room_id),
+            "log_id": log_slices[shard][0],
+            "access_logs": log_slices[shard][1],
+            "mongo_scale": {**scale,
+                            "sensors": sensor_slices[shard][1],
+                            "sensor_readings": reading_slices[shard][1],
+                            "device_controls": device_slices[shard][1]},
+            "mongo_first_ids": (sensor_slices[shard][0], reading_slices[shard][0],
+                                device_slices[shard][0]),
+        } for shard in range(workers)]
+        activity_stats = pool.map(load_activity_shard, activity_tasks)
+
+    with psql_connection(dbname) as conn:
+        cur = conn.cursor()
+        sync_sequences(cur, building_id + scale["buildings"], floor_id, room_id, user_id,
+                       log_id + scale["access_logs"])
+        cur.close()
+
+    # Per table seconds are summed over workers, so rows/sec is per worker
+    stats = merge_stats(structure_stats + activity_stats)
+    report_load_stats(stats, f"Parallel ({workers} workers, per worker)")
+    seconds = time.time() - t_start
+    rows = sum(rows for rows, _ in stats.values())
+    print(f"Parallel load finished in {seconds:.2f}s ({rows / seconds:,.0f} rows/sec overall)")
+    return seconds
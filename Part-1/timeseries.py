@@ -0,0 +1,271 @@
+import argparse
+import time
+
+import numpy as np
+
+from data_generator import SENSOR, SENSOR_TYPES, MONGO_BATCH_SIZE, MONGO_MAX_IN_FLIGHT, MongoBatchWriter
+from common.sensor_data import (SENSOR_DATA, TIME_FIELD, META_FIELD, create_sensor_data_collection,
+                                is_timeseries, sensor_data_query)
+
+
+# Readings produced per column batch
+TIMESERIES_BATCH_SIZE = 1000000
+
+# Shape of the daily curve per sensor type: mean level, half of the day/night
+# swing, noise standard deviation, hour of the daily peak, and the spread of
+# the per-sensor offset. Motion values are the probability of a detection.
+TIMESERIES_PROFILES = {
+    "temperature": {"base": 70.0, "amplitude": 8.0, "noise": 0.8, "peak_hour": 15, "sensor_spread": 3.0},
+    "humidity": {"base": 45.0, "amplitude": 7.0, "noise": 1.2, "peak_hour": 5, "sensor_spread": 4.0},
+    "light": {"base": 500.0, "amplitude": 480.0, "noise": 35.0, "peak_hour": 13, "sensor_spread": 60.0},
+    "motion": {"base": 0.3, "amplitude": 0.25, "noise": 0.0, "peak_hour": 11, "sensor_spread": 0.1},
+}
+
+PROFILE_COLUMNS = ("base", "amplitude", "noise", "peak_hour", "sensor_spread")
+
+# Lookup tables indexed by the position of the type in SENSOR_TYPES
+TYPE_PROFILES = {
+    column: np.array([TIMESERIES_PROFILES[sensor_type][column] for sensor_type in SENSOR_TYPES])
+    for column in PROFILE_COLUMNS
+}
+TYPE_NAMES = np.array(SENSOR_TYPES, dtype=object)
+TYPE_UNITS = np.array([SENSOR[sensor_type]["unit"] for sensor_type in SENSOR_TYPES], dtype=object)
+MOTION = SENSOR_TYPES.index("motion")
+LIGHT = SENSOR_TYPES.index("light")
+
+
+def sensor_data_batches(sensor_ids, sensor_types, readings, start="2023-01-01T00:00:00",
+                        interval_seconds=300, bad_quality_rate=0.01, seed=0,
+                        first_data_id=0, batch_size=TIMESERIES_BATCH_SIZE):
+    """
+    Generate readings time series for the given sensors as column batches.
+
+    sensor_ids and sensor_types are equally long arrays, the type being the
+    index into SENSOR_TYPES. Every sensor reports every interval_seconds from
+    start, with a fixed per-sensor phase inside the interval, until readings
+    values were produced. A value follows the daily curve of its type plus a
+    per-sensor offset and Gaussian noise. A bad_quality_rate share of the
+    readings is flagged bad and carries a spike.
+
+    Yields dicts of NumPy arrays with the sensor_data fields, at most
+    batch_size readings each.
+    """
+    rng = np.random.default_rng(seed)
+    sensor_ids = np.asarray(sensor_ids, dtype=np.int64)
+    sensor_types = np.asarray(sensor_types, dtype=np.int8)
+    sensors = len(sensor_ids)
+    if not sensors or not readings:
+        return
+
+    # Fixed per-sensor characteristics
+    offsets = rng.normal(0.0, TYPE_PROFILES["sensor_spread"][sensor_types])
+    phases = rng.integers(0, interval_seconds, sensors)
+    start_seconds = np.datetime64(start, "s").astype(np.int64)
+
+    steps_per_batch = max(1, batch_size // sensors)
+    sensor_chunk = min(sensors, batch_size)
+    data_id = first_data_id
+    remaining = readings
+    step = 0
+    while remaining > 0:
+        steps = np.arange(step, step + steps_per_batch, dtype=np.int64)
+        for low in range(0, sensors, sensor_chunk):
+            if remaining <= 0:
+                break
+            high = min(low + sensor_chunk, sensors)
+            count = min(len(steps) * (high - low), remaining)
+
+            # Time major: every sensor of the chunk for step 0, then step 1, ...
+            ids = np.tile(sensor_ids[low:high], len(steps))[:count]
+            types = np.tile(sensor_types[low:high], len(steps))[:count]
+            offset = np.tile(offsets[low:high], len(steps))[:count]
+            seconds = (start_seconds
+                       + np.repeat(steps, high - low)[:count] * interval_seconds
+                       + np.tile(phases[low:high], len(steps))[:count])
+
+            # Daily curve peaking at peak_hour, plus sensor offset and noise
+            day_fraction = (seconds % 86400) / 86400.0
+            curve = np.cos(2 * np.pi * (day_fraction - TYPE_PROFILES["peak_hour"][types] / 24.0))
+            values = (TYPE_PROFILES["base"][types] + offset
+                      + TYPE_PROFILES["amplitude"][types] * curve
+                      + TYPE_PROFILES["noise"][types] * rng.standard_normal(count))
+
+            bad = rng.random(count) < bad_quality_rate
+            values = np.where(bad, values + 10 * TYPE_PROFILES["noise"][types] * rng.standard_normal(count), values)
+            values = np.where(types == LIGHT, np.maximum(values, 0.0), values)
+            motion = types == MOTION
+            values = np.where(motion, rng.random(count) < values, values)
+
+            yield {
+                "data_id": np.arange(data_id + 1, data_id + count + 1, dtype=np.int64),
+                "sensor_id": ids,
+                "timestamp": seconds.astype("datetime64[s]"),
+                "data_type": types,
+                "data_value": values,
+                "is_motion": motion,
+                "bad_quality": bad,
+                "confirmed": rng.random(count) < 0.5,
+            }
+            data_id += count
+            remaining -= count
+        step += steps_per_batch
+
+
+def batch_documents(batch, timeseries=False):
+    # Turn a column batch into sensor_data documents in the layout of
+    # generate_sensor_data_data, or of a time-series sensor_data with timeseries
+    values = batch["data_value"].astype(object)
+    values[batch["is_motion"]] = np.where(batch["data_value"][batch["is_motion"]] != 0, "True", "False")
+    if timeseries:
+        # datetime64[s] converts to naive datetimes, which pymongo stores as UTC
+        timestamps = batch["timestamp"].tolist()
+    else:
+        timestamps = np.datetime_as_string(batch["timestamp"], unit="s").tolist()
+    columns = (
+        batch["data_id"].tolist(),
+        batch["sensor_id"].tolist(),
+        timestamps,
+        TYPE_NAMES[batch["data_type"]].tolist(),
+        values.tolist(),
+        TYPE_UNITS[batch["data_type"]].tolist(),
+        np.where(batch["bad_quality"], "bad", "good").tolist(),
+        np.where(batch["confirmed"], "confirmed", "unconfirmed").tolist(),
+    )
+    fields = ("data_id", "sensor_id", "timestamp", "data_type", "data_value",
+              "unit_of_measure", "data_quality", "data_status")
+    if timeseries:
+        return [{"data_id": data_id, TIME_FIELD: timestamp,
+                 META_FIELD: {"sensor_id": sensor_id, "data_type": data_type},
+                 "data_value": value, "unit_of_measure": unit, "data_quality": quality, "data_status": status}
+                for data_id, sensor_id, timestamp, data_type, value, unit, quality, status in zip(*columns)]
+    return [dict(zip(fields, row)) for row in zip(*columns)]
+
+
+def sensor_catalog(db):
+    # sensor_id and type index of every sensor, streamed into NumPy arrays
+    cursor = db['sensors'].find({}, {'_id': 0, 'sensor_id': 1, 'sensor_type': 1}).batch_size(10000)
+    ids, types = [], []
+    for sensor in cursor:
+        ids.append(sensor['sensor_id'])
+        types.append(SENSOR_TYPES.index(sensor['sensor_type']))
+    return np.array(ids, dtype=np.int64), np.array(types, dtype=np.int8)
+
+
+def load_sensor_timeseries(db, readings, start="2023-01-01T00:00:00", interval_seconds=300,
+                           bad_quality_rate=0.01, seed=0, batch_size=MONGO_BATCH_SIZE,
+                           max_in_flight=MONGO_MAX_IN_FLIGHT):
+    # Generate readings for every sensor in db and insert them into sensor_data
+    t1 = time.time()
+    sensor_ids, sensor_types = sensor_catalog(db)
+    timeseries = is_timeseries(db)
+    writer = MongoBatchWriter(db, batch_size, max_in_flight)
+    for batch in sensor_data_batches(sensor_ids, sensor_types, readings, start, interval_seconds,
+                                     bad_quality_rate, seed):
+        writer.add_many('sensor_data', batch_documents(batch, timeseries))
+    writer.close()
+    seconds = time.time() - t1
+
+    inserted = writer.inserted.get('sensor_data', 0)
+    print(f"Time series load: {inserted} readings for {len(sensor_ids)} sensors in {seconds:.2f}s "
+          f"({inserted / seconds:,.0f} readings/sec), {writer.failed.get('sensor_data', 0)} failed")
+    return inserted, seconds
+
+
+def storage_stats(collection):
+    # Sizes in bytes. For a time-series collection they are those of its buckets.
+    stats = next(collection.aggregate([{"$collStats": {"storageStats": {}}}]))["storageStats"]
+    return {"documents": collection.estimated_document_count(),
+            "storage_size": stats["storageSize"],
+            "index_size": stats["totalIndexSize"]}
+
+
+def range_query_latencies(collection, timeseries, sensor_ids, start_seconds, span_seconds,
+                          window_seconds, queries, rng):
+    # Milliseconds per fully read range query: one sensor over window_seconds
+    latencies = []
+    for _ in range(queries):
+        low = start_seconds + int(rng.integers(0, max(1, span_seconds - window_seconds)))
+        low_time = np.datetime64(low, "s")
+        high_time = np.datetime64(low + window_seconds, "s")
+        if timeseries:
+            bounds = {"$gte": low_time.tolist(), "$lt": high_time.tolist()}
+        else:
+            # ISO strings of one format order like the times they encode
+            bounds = {"$gte": str(low_time), "$lt": str(high_time)}
+        query = sensor_data_query({"sensor_id": int(rng.choice(sensor_ids)), "timestamp": bounds}, timeseries)
+        t1 = time.perf_counter()
+        for _ in collection.find(query):
+            pass
+        latencies.append((time.perf_counter() - t1) * 1000)
+    return np.array(latencies)
+
+
+def compare_sensor_data_layouts(client, readings=1000000, sensors=1000, start="2023-01-01T00:00:00",
+                                interval_seconds=300, granularity="minutes", window_seconds=86400,
+                                queries=200, seed=0, batch_size=MONGO_BATCH_SIZE,
+                                max_in_flight=MONGO_MAX_IN_FLIGHT):
+    """
+    Load the same readings into a plain sensor_data, a plain one with a
+    (sensor_id, timestamp) index and a time-series one, each in its own
+    scratch database, then compare storage sizes and the latency of
+    one-sensor range queries over window_seconds. The scratch databases are
+    dropped afterwards.
+    """
+    rng = np.random.default_rng(seed)
+    sensor_ids = np.arange(1, sensors + 1)
+    sensor_types = rng.integers(0, len(SENSOR_TYPES), sensors)
+    span_seconds = -(-readings // sensors) * interval_seconds
+    start_seconds = int(np.datetime64(start, "s").astype(np.int64))
+
+    layouts = {"plain": False, "plain + index": False, "timeseries": True}
+    results = {}
+    for layout, timeseries in layouts.items():
+        scratch_name = "sensor_data_layout_" + layout.replace(" + ", "_")
+        client.drop_database(scratch_name)
+        db = client[scratch_name]
+        collection = create_sensor_data_collection(db, timeseries, granularity)
+        if layout == "plain + index":
+            collection.create_index([("sensor_id", 1), ("timestamp", 1)])
+
+        t1 = time.time()
+        writer = MongoBatchWriter(db, batch_size, max_in_flight)
+        for batch in sensor_data_batches(sensor_ids, sensor_types, readings, start, interval_seconds,
+                                         seed=seed):
+            writer.add_many(SENSOR_DATA, batch_documents(batch, timeseries))
+        writer.close()
+        load_seconds = time.time() - t1
+
+        latencies = range_query_latencies(collection, timeseries, sensor_ids, start_seconds, span_seconds,
+                                          window_seconds, queries, np.random.default_rng(seed))
+        results[layout] = {**storage_stats(collection), "load_seconds": load_seconds,
+                           "p50_ms": float(np.percentile(latencies, 50)),
+                           "p95_ms": float(np.percentile(latencies, 95))}
+        client.drop_database(scratch_name)
+
+    print(f"sensor_data layouts ({readings} readings, {sensors} sensors, "
+          f"{window_seconds}s range queries, granularity={granularity}):")
+    for layout, result in results.items():
+        print(f"  {layout}: {result['storage_size'] / 2**20:.1f} MiB data, "
+              f"{result['index_size'] / 2**20:.1f} MiB indexes, load {result['load_seconds']:.2f}s, "
+              f"range query p50 {result['p50_ms']:.2f}ms p95 {result['p95_ms']:.2f}ms")
+    return results
+
+
+if __name__ == "__main__":
+    # Measure the generation rate alone, without a database
+    parser = argparse.ArgumentParser(description="Benchmark the vectorised sensor_data generator")
+    parser.add_argument("--sensors", type=int, default=10000)
+    parser.add_argument("--readings", type=int, default=100000000)
+    parser.add_argument("--batch-size", type=int, default=TIMESERIES_BATCH_SIZE)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    t1 = time.time()
+    generated = 0
+    for batch in sensor_data_batches(np.arange(1, args.sensors + 1),
+                                     rng.integers(0, len(SENSOR_TYPES), args.sensors),
+                                     args.readings, seed=args.seed, batch_size=args.batch_size):
+        generated += len(batch["data_id"])
+    seconds = time.time() - t1
+    print(f"Generated {generated} readings in {seconds:.2f}s ({generated / seconds:,.0f} readings/sec)")
@@ -0,0 +1,339 @@
+"""
+Incremental synchronisation of fragments with their source tables.
+
+Statement level triggers on every source table record the keys of the rows
+changed by each transaction in the change table, together with its
+transaction id. Each fragment remembers, in the sync table, the last change
+it applied. A sync reads the pending changes of a fragment in batches and, for
+the keys of a batch, replaces the rows of the fragment with the current rows
+of the source, so the order in which transactions committed does not matter.
+Only changes of transactions older than every running transaction are read,
+so a change that commits late is never skipped.
+
+Fragments of a "maintained" range partitioned table only hold the periods
+that are still attached, changes to older rows are not applied to them.
+
+sync_lag reports the pending changes of every fragment and the age of the
+oldest one, and verify_fragment compares checksums of a fragment and its
+source.
+"""
+
+import argparse
+import io
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.db import copy_value, psql_connection
+from fragmentation import FRAGMENTATION_SPEC, fragment_node, source_layout, validate_fragment
+from partition_manager import attached_partitions
+
+
+CHANGE_TABLE = "fragment_changes"
+SYNC_TABLE = "fragment_sync"
+# Changes applied per transaction, and seconds between runs of the sync job
+SYNC_BATCH_SIZE = 5000
+SYNC_EVERY = 10
+
+CAPTURE_DDL = f"""
+    CREATE TABLE IF NOT EXISTS {CHANGE_TABLE} (
+        id bigserial PRIMARY KEY,
+        source text NOT NULL,
+        key text NOT NULL,
+        xid xid8 NOT NULL DEFAULT pg_current_xact_id(),
+        changed_at timestamptz NOT NULL DEFAULT clock_timestamp()
+    );
+    CREATE INDEX IF NOT EXISTS {CHANGE_TABLE}_source_idx ON {CHANGE_TABLE} (source, xid, id);
+
+    CREATE TABLE IF NOT EXISTS {SYNC_TABLE} (
+        fragment text PRIMARY KEY,
+        source text NOT NULL,
+        applied_xid xid8 NOT NULL DEFAULT '0',
+        applied_id bigint NOT NULL DEFAULT 0,
+        applied_at timestamptz
+    );
+
+    -- The key column is the first trigger argument
+    CREATE OR REPLACE FUNCTION capture_fragment_changes() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO {CHANGE_TABLE} (source, key)
+            SELECT DISTINCT TG_TABLE_NAME, to_jsonb(n) ->> TG_ARGV[0] FROM new_rows n;
+        ELSIF TG_OP = 'UPDATE' THEN
+            INSERT INTO {CHANGE_TABLE} (source, key)
+            SELECT TG_TABLE_NAME, to_jsonb(o) ->> TG_ARGV[0] FROM old_rows o
+            UNION
+            SELECT TG_TABLE_NAME, to_jsonb(n) ->> TG_ARGV[0] FROM new_rows n;
+        ELSE
+            INSERT INTO {CHANGE_TABLE} (source, key)
+            SELECT DISTINCT TG_TABLE_NAME, to_jsonb(o) ->> TG_ARGV[0] FROM old_rows o;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+"""
+
+# Transition tables need one trigger per event
+CAPTURE_EVENTS = {
+    "insert": "NEW TABLE AS new_rows",
+    "update": "OLD TABLE AS old_rows NEW TABLE AS new_rows",
+    "delete": "OLD TABLE AS old_rows",
+}
+
+
+def fragment_layout(cur, fragment):
+    # Columns of the fragment in order, its key and the type of the key
+    source_columns, primary_key = source_layout(cur, fragment["source"])
+    key = fragment.get("key", primary_key)
+    if key is None:
+        raise ValueError(f"{fragment['name']}: {fragment['source']} has no single column primary key, set a key")
+    if fragment["type"] == "vertical":
+        return [key] + fragment["columns"], key, source_columns[key]
+    return list(source_columns), key, source_columns[key]
+
+
+def install_change_capture(spec=FRAGMENTATION_SPEC, dbname="smart_building", target="psql"):
+    """
+    Create the change and sync tables and the capture triggers of every source
+    of spec, and register its fragments. Install capture before the fragments
+    are first loaded: changes made in between are applied again, which is
+    harmless, while changes made before capture exists are never seen.
+    """
+    for fragment in spec:
+        validate_fragment(fragment)
+    with psql_connection(dbname, target, autocommit=False) as conn:
+        cur = conn.cursor()
+        cur.execute(CAPTURE_DDL)
+        sources = {}
+        for fragment in spec:
+            sources[fragment["source"]] = fragment_layout(cur, fragment)[1]
+            cur.execute(f"""
+                INSERT INTO {SYNC_TABLE} (fragment, source) VALUES (%s, %s)
+                ON CONFLICT (fragment) DO NOTHING;
+            """, (fragment["name"], fragment["source"]))
+        for source, key in sources.items():
+            for event, transition in CAPTURE_EVENTS.items():
+                trigger = f"{source}_capture_{event}"
+                cur.execute(f"DROP TRIGGER IF EXISTS {trigger} ON {source};")
+                cur.execute(f"""
+                    CREATE TRIGGER {trigger} AFTER {event.upper()} ON {source} REFERENCING {transition}
+                    FOR EACH STATEMENT EXECUTE FUNCTION capture_fragment_changes(%s);
+                """, (key,))
+        conn.commit()
+        cur.close()
+
+
+def retained_from(cur, fragment):
+    # Lower bound of the oldest attached period of a maintained fragment, else None
+    if not fragment.get("maintained"):
+        return None
+    partitions, _ = attached_partitions(cur, fragment["name"])
+    return min((low for low, _ in partitions.values()), default=None)
+
+
+def pending_changes(cur, fragment, batch_size):
+    # The next batch of changes to apply, from transactions that have all ended
+    cur.execute(f"""
+        SELECT c.xid, c.id, c.key
+        FROM {CHANGE_TABLE} c JOIN {SYNC_TABLE} s ON s.source = c.source
+        WHERE s.fragment = %s AND (c.xid, c.id) > (s.applied_xid, s.applied_id)
+          AND c.xid < pg_snapshot_xmin(pg_current_snapshot())
+        ORDER BY c.xid, c.id
+        LIMIT %s;
+    """, (fragment["name"], batch_size))
+    return cur.fetchall()
+
+
+def sync_fragment(fragment, dbname="smart_building", target="psql", batch_size=SYNC_BATCH_SIZE):
+    """
+    Apply the pending changes of one fragment in batches of batch_size.
+    Returns the number of changes and of distinct keys applied.
+    """
+    table = fragment["name"]
+    source = (dbname, target)
+    node = fragment_node(fragment, dbname, target)
+    changes = keys = 0
+
+    with psql_connection(*source, autocommit=False) as conn:
+        cur = conn.cursor()
+        columns, key, key_type = fragment_layout(cur, fragment)
+        column_list = ", ".join(columns)
+        conn.commit()
+        with psql_connection(*node, autocommit=False) as node_conn:
+            node_cur = node_conn.cursor()
+            low = retained_from(node_cur, fragment)
+            node_conn.commit()
+            retained = "" if low is None else f" AND {fragment['column']} >= %s"
+
+            while True:
+                batch = pending_changes(cur, fragment, batch_size)
+                if not batch:
+                    conn.commit()
+                    break
+                batch_keys = list({change_key for _, _, change_key in batch})
+                params = (batch_keys,) if low is None else (batch_keys, low)
+                select = f"SELECT {column_list} FROM {fragment['source']} WHERE {key} = ANY(%s::{key_type}[]){retained}"
+                delete = f"DELETE FROM {table} WHERE {key} = ANY(%s::{key_type}[]);"
+
+                if node == source:
+                    # One transaction applies the batch and records it
+                    cur.execute(delete, (batch_keys,))
+                    cur.execute(f"INSERT INTO {table} ({column_list}) {select};", params)
+                else:
+                    # The batch is applied on the node first, a failure in
+                    # between means it is applied again, which is harmless
+                    cur.execute(select + ";", params)
+                    buffer = io.StringIO()
+                    for row in cur.fetchall():
+                        buffer.write('\t'.join(copy_value(value) for value in row) + '\n')
+                    buffer.seek(0)
+                    node_cur.execute(delete, (batch_keys,))
+                    node_cur.copy_expert(f"COPY {table} ({column_list}) FROM STDIN", buffer)
+                    node_conn.commit()
+
+                last_xid, last_id, _ = batch[-1]
+                cur.execute(f"""
+                    UPDATE {SYNC_TABLE} SET applied_xid = %s::xid8, applied_id = %s, applied_at = clock_timestamp()
+                    WHERE fragment = %s;
+                """, (last_xid, last_id, table))
+                conn.commit()
+                changes += len(batch)
+                keys += len(batch_keys)
+            node_cur.close()
+        cur.close()
+    return {"changes": changes, "keys": keys}
+
+
+def purge_changes(dbname="smart_building", target="psql"):
+    # Delete the changes every registered fragment of their source has applied
+    with psql_connection(dbname, target) as conn:
+        cur = conn.cursor()
+        cur.execute(f"""
+            DELETE FROM {CHANGE_TABLE} c
+            USING (SELECT DISTINCT ON (source) source, applied_xid, applied_id
+                   FROM {SYNC_TABLE} ORDER BY source, applied_xid, applied_id) s
+            WHERE c.source = s.source AND (c.xid, c.id) <= (s.applied_xid, s.applied_id);
+        """)
+        purged = cur.rowcount
+        cur.close()
+    return purged
+
+
+def sync_lag(dbname="smart_building", target="psql"):
+    """
+    fragment -> pending changes, age in seconds of the oldest pending change
+    (0 when there is none), and when the fragment last applied changes.
+    """
+    with psql_connection(dbname, target) as conn:
+        cur = conn.cursor()
+        cur.execute(f"""
+            SELECT s.fragment, COUNT(c.id),
+                   COALESCE(EXTRACT(EPOCH FROM clock_timestamp() - MIN(c.changed_at)), 0)::float,
+                   s.applied_at
+            FROM {SYNC_TABLE} s
+            LEFT JOIN {CHANGE_TABLE} c
+                ON c.source = s.source AND (c.xid, c.id) > (s.applied_xid, s.applied_id)
+            GROUP BY s.fragment, s.applied_at
+            ORDER BY s.fragment;
+        """)
+        lag = {fragment: {"pending": pending, "lag_seconds": seconds, "applied_at": applied_at}
+               for fragment, pending, seconds, applied_at in cur.fetchall()}
+        cur.close()
+    return lag
+
+
+def table_checksum(cur, table, columns, where="", params=None):
+    # Row count and an order independent checksum of the given columns
+    cur.execute(f"""
+        SELECT COUNT(*), COALESCE(SUM(('x' || left(md5(ROW({', '.join(columns)})::text), 16))::bit(64)::bigint), 0)
+        FROM {table}{where};
+    """, params)
+    return cur.fetchone()
+
+
+def verify_fragment(fragment, dbname="smart_building", target="psql"):
+    """
+    Compare the rows of a fragment with the rows of its source it should
+    hold. Changes still pending show up as differences.
+    """
+    source = (dbname, target)
+    node = fragment_node(fragment, dbname, target)
+    with psql_connection(*node) as conn:
+        cur = conn.cursor()
+        low = retained_from(cur, fragment)
+        cur.close()
+    where, params = ("", None) if low is None else (f" WHERE {fragment['column']} >= %s", (low,))
+
+    with psql_connection(*source) as conn:
+        cur = conn.cursor()
+        columns, _, _ = fragment_layout(cur, fragment)
+        source_rows, source_sum = table_checksum(cur, fragment["source"], columns, where, params)
+        cur.close()
+    with psql_connection(*node) as conn:
+        cur = conn.cursor()
+        fragment_rows, fragment_sum = table_checksum(cur, fragment["name"], columns, where, params)
+        cur.close()
+    return {"source_rows": source_rows, "fragment_rows": fragment_rows,
+            "in_sync": (source_rows, source_sum) == (fragment_rows, fragment_sum)}
+
+
+def sync_fragments(spec=FRAGMENTATION_SPEC, dbname="smart_building", target="psql",
+                   batch_size=SYNC_BATCH_SIZE, verbose=True):
+    results = {}
+    for fragment in spec:
+        results[fragment["name"]] = result = sync_fragment(fragment, dbname, target, batch_size)
+        if verbose and result["changes"]:
+            print(f"Fragment {fragment['name']}: {result['changes']} changes applied to {result['keys']} keys")
+    purged = purge_changes(dbname, target)
+    if verbose and purged:
+        print(f"{purged} applied changes purged")
+    return results
+
+
+def print_lag(dbname="smart_building", target="psql"):
+    for fragment, lag in sync_lag(dbname, target).items():
+        print(f"{fragment}: {lag['pending']} pending changes, {lag['lag_seconds']:.1f}s behind, "
+              f"last applied {lag['applied_at'] or 'never'}")
+
+
+def run_sync_job(spec=FRAGMENTATION_SPEC, dbname="smart_building", target="psql", every=SYNC_EVERY):
+    # Sync every `every` seconds. A failed run is reported and retried next time.
+    while True:
+        try:
+            sync_fragments(spec, dbname, target)
+        except Exception as error:
+            print("Error while syncing fragments: ", error)
+        time.sleep(every)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Keep the fragments in sync with their source tables")
+    parser.add_argument("--dbname", default="smart_building")
+    parser.add_argument("--target", default="psql")
+    parser.add_argument("--only", nargs="+", metavar="NAME", help="sync only these fragments")
+    parser.add_argument("--install", action="store_true", help="install change capture first")
+    parser.add_argument("--once", action="store_true", help="sync once, e.g. from cron")
+    parser.add_argument("--every", type=int, default=SYNC_EVERY, help="seconds between syncs")
+    parser.add_argument("--batch-size", type=int, default=SYNC_BATCH_SIZE)
+    parser.add_argument("--lag", action="store_true", help="print the lag of every fragment and exit")
+    parser.add_argument("--verify", action="store_true", help="sync once, then verify every fragment")
+    args = parser.parse_args()
+
+    spec = FRAGMENTATION_SPEC
+    if args.only:
+        spec = [fragment for fragment in spec if fragment["name"] in args.only]
+    if args.install:
+        install_change_capture(spec, args.dbname, args.target)
+    if args.lag:
+        print_lag(args.dbname, args.target)
+    elif args.verify:
+        sync_fragments(spec, args.dbname, args.target, args.batch_size)
+        for fragment in spec:
+            result = verify_fragment(fragment, args.dbname, args.target)
+            print(f"{fragment['name']}: {'in sync' if result['in_sync'] else 'OUT OF SYNC'}, "
+                  f"{result['fragment_rows']} of {result['source_rows']} source rows")
+    elif args.once:
+        sync_fragments(spec, args.dbname, args.target, args.batch_size)
+    else:
+        run_sync_job(spec, args.dbname, args.target, args.every)
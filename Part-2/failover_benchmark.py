@@ -0,0 +1,262 @@
+"""
+Failover benchmark for the SmartBuilding replica set.
+
+A writer and a reader keep a steady load on the set while the primary is
+killed. A monitor polls every member to time the election of a new primary.
+Every run reports
+
+- the write unavailable window: the gap between the last write acknowledged
+  before the kill and the first acknowledgement of a write started after it
+- the election time: from the kill until another member is writable primary
+- writes that needed retrying, writes that failed for good, and acknowledged
+  writes missing from the new primary once the set has settled (lost)
+- write and read latency percentiles before, during and after the failover.
+  Operations in flight at the kill count as during, as they wait for the
+  new primary.
+
+Runs are repeated for every electionTimeoutMillis given. The primary is killed
+with SIGKILL, as in a crash, and restarted before the next run.
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+from pymongo import WriteConcern
+from pymongo.errors import PyMongoError
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.db import get_mongo_client
+from node_control import kill_member, start_member, wait_until_healthy
+from read_routing import REPLICA_SET_PORTS, REPLICA_SET_URI
+
+
+BENCHMARK_COLLECTION = "failover_benchmark"
+ELECTION_TIMEOUTS_MS = [10000, 5000, 2000]
+# Seconds of load before the kill and after the new primary is elected
+WARMUP_SECONDS = 5
+SETTLE_SECONDS = 5
+# A write is retried for up to this many seconds before it counts as failed
+RETRY_FOR_SECONDS = 60
+# Seconds between writes, reads and polls of the members
+WRITE_INTERVAL = 0.01
+READ_INTERVAL = 0.01
+POLL_INTERVAL = 0.05
+PERCENTILES = (50, 95, 99)
+
+
+def member_client(port):
+    return get_mongo_client(f"mongodb://localhost:{port}/", directConnection=True,
+                            serverSelectionTimeoutMS=500, connectTimeoutMS=500)
+
+
+def writable_primary(port):
+    try:
+        return member_client(port).admin.command("hello").get("isWritablePrimary", False)
+    except PyMongoError:
+        return False
+
+
+def primary_port():
+    return next((port for port in REPLICA_SET_PORTS if writable_primary(port)), None)
+
+
+def set_election_timeout(client, timeout_ms):
+    config = client.admin.command("replSetGetConfig")["config"]
+    if config.get("settings", {}).get("electionTimeoutMillis") == timeout_ms:
+        return
+    config.setdefault("settings", {})["electionTimeoutMillis"] = timeout_ms
+    config["version"] += 1
+    client.admin.command("replSetReconfig", config)
+
+
+class Load:
+    # Writer, reader and primary monitor threads sharing one stop event
+
+    def __init__(self, collection, run):
+        self.collection = collection
+        self.run = run
+        self.stop = threading.Event()
+        self.writes = []
+        self.reads = []
+        self.primaries = []
+        self.acknowledged = []
+        self.threads = [threading.Thread(target=target, daemon=True)
+                        for target in (self.write_loop, self.read_loop, self.monitor_loop)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def join(self):
+        self.stop.set()
+        for thread in self.threads:
+            thread.join()
+
+    def write_loop(self):
+        seq = 0
+        while not self.stop.is_set():
+            seq += 1
+            started = time.monotonic()
+            attempts, ok = 0, False
+            while not ok and time.monotonic() - started < RETRY_FOR_SECONDS:
+                attempts += 1
+                try:
+                    self.collection.insert_one({"run": self.run, "seq": seq, "written_at": time.time()})
+                    ok = True
+                except PyMongoError:
+                    time.sleep(WRITE_INTERVAL)
+            self.writes.append((started, time.monotonic(), ok, attempts))
+            if ok:
+                self.acknowledged.append(seq)
+            time.sleep(WRITE_INTERVAL)
+
+    def read_loop(self):
+        while not self.stop.is_set():
+            started = time.monotonic()
+            try:
+                self.collection.find_one({"run": self.run}, sort=[("seq", -1)])
+                self.reads.append((started, time.monotonic(), True))
+            except PyMongoError:
+                self.reads.append((started, time.monotonic(), False))
+            time.sleep(READ_INTERVAL)
+
+    def monitor_loop(self):
+        while not self.stop.is_set():
+            self.primaries.append((time.monotonic(), primary_port()))
+            time.sleep(POLL_INTERVAL)
+
+
+def latency_percentiles(latencies):
+    if not latencies:
+        return {"count": 0}
+    return {"count": len(latencies), **{f"p{p}_ms": float(np.percentile(latencies, p)) for p in PERCENTILES}}
+
+
+def phase_latencies(operations, killed_at, recovered_at):
+    """
+    Percentiles in ms of the successful operations finished before the kill,
+    of those in flight at the kill or started before recovered_at, and of
+    those started from recovered_at on.
+    """
+    phases = {"before": [], "during": [], "after": []}
+    for started, finished, ok, *_ in operations:
+        if not ok:
+            continue
+        phase = "before" if finished <= killed_at else "during" if started < recovered_at else "after"
+        phases[phase].append((finished - started) * 1000)
+    return {phase: latency_percentiles(latencies) for phase, latencies in phases.items()}
+
+
+def failover_run(client, run, election_timeout_ms):
+    """
+    One failover under load. Returns the measurements of the run described in
+    the module docstring.
+    """
+    set_election_timeout(client, election_timeout_ms)
+    wait_until_healthy(client)
+    old_primary = primary_port()
+    if old_primary is None:
+        raise RuntimeError(f"No writable primary among ports {', '.join(map(str, REPLICA_SET_PORTS))}")
+    collection = client["smart_building"].get_collection(
+        BENCHMARK_COLLECTION, write_concern=WriteConcern(w="majority", wtimeout=RETRY_FOR_SECONDS * 1000))
+
+    load = Load(collection, run)
+    load.start()
+    time.sleep(WARMUP_SECONDS)
+    killed_at = time.monotonic()
+    kill_member(old_primary)
+
+    elected_at = None
+    while elected_at is None and time.monotonic() - killed_at < RETRY_FOR_SECONDS:
+        elected_at = next((at for at, port in load.primaries
+                           if at > killed_at and port not in (None, old_primary)), None)
+        time.sleep(POLL_INTERVAL)
+    time.sleep(SETTLE_SECONDS)
+    load.join()
+
+    # The last acknowledgement before the kill, and the first one of a write started after it.
+    # Writes in flight at the kill may be acknowledged by the old primary just after it.
+    before = max((finished for _, finished, ok, _ in load.writes if ok and finished <= killed_at), default=None)
+    after = min((finished for started, finished, ok, _ in load.writes if ok and started > killed_at),
+                default=None)
+    recovered_at = after or time.monotonic()
+
+    start_member(old_primary)
+    wait_until_healthy(client)
+    stored = {doc["seq"] for doc in collection.find({"run": run}, {"seq": 1, "_id": 0})}
+    collection.delete_many({"run": run})
+
+    return {
+        "run": run,
+        "election_timeout_ms": election_timeout_ms,
+        "killed": old_primary,
+        "election_seconds": elected_at - killed_at if elected_at else None,
+        "write_unavailable_seconds": after - before if before and after else None,
+        "writes": len(load.writes),
+        "retried_writes": sum(1 for *_, ok, attempts in load.writes if ok and attempts > 1),
+        "failed_writes": sum(1 for *_, ok, _ in load.writes if not ok),
+        "lost_writes": len(set(load.acknowledged) - stored),
+        "write_latency": phase_latencies(load.writes, killed_at, recovered_at),
+        "read_latency": phase_latencies(load.reads, killed_at, recovered_at),
+    }
+
+
+def print_run(result):
+    def seconds(value):
+        return f"{value:.2f}s" if value is not None else "n/a"
+
+    print(f"Run {result['run']} (electionTimeoutMillis {result['election_timeout_ms']}, killed {result['killed']}): "
+          f"election {seconds(result['election_seconds'])}, "
+          f"writes unavailable {seconds(result['write_unavailable_seconds'])}, "
+          f"{result['writes']} writes, {result['retried_writes']} retried, "
+          f"{result['failed_writes']} failed, {result['lost_writes']} lost")
+    for kind in ("write_latency", "read_latency"):
+        for phase, latency in result[kind].items():
+            if latency["count"]:
+                print(f"  {kind.replace('_', ' ')} {phase}: {latency['count']} ops, "
+                      + ", ".join(f"p{p} {latency[f'p{p}_ms']:.1f}ms" for p in PERCENTILES))
+
+
+def failover_benchmark(election_timeouts=ELECTION_TIMEOUTS_MS, runs=3, uri=REPLICA_SET_URI):
+    # Every run for every election timeout, then the means per timeout, latency percentiles included
+    client = get_mongo_client(uri, retryWrites=True, serverSelectionTimeoutMS=2000)
+    results = []
+    for timeout_ms in election_timeouts:
+        for run in range(1, runs + 1):
+            result = failover_run(client, f"{timeout_ms}-{run}", timeout_ms)
+            print_run(result)
+            results.append(result)
+
+    print("Mean per electionTimeoutMillis")
+    for timeout_ms in election_timeouts:
+        timed = [result for result in results if result["election_timeout_ms"] == timeout_ms]
+        elections = [result["election_seconds"] for result in timed if result["election_seconds"] is not None]
+        windows = [result["write_unavailable_seconds"] for result in timed
+                   if result["write_unavailable_seconds"] is not None]
+        print(f"  {timeout_ms}ms: election {np.mean(elections) if elections else float('nan'):.2f}s, "
+              f"writes unavailable {np.mean(windows) if windows else float('nan'):.2f}s, "
+              f"{sum(result['lost_writes'] for result in timed)} lost writes over {len(timed)} runs")
+        for kind in ("write_latency", "read_latency"):
+            for phase in ("before", "during", "after"):
+                measured = [result[kind][phase] for result in timed if result[kind][phase]["count"]]
+                if measured:
+                    print(f"    {kind.replace('_', ' ')} {phase}: "
+                          + ", ".join(f"p{p} {np.mean([latency[f'p{p}_ms'] for latency in measured]):.1f}ms"
+                                      for p in PERCENTILES)
+                          + f" (mean over {len(measured)} runs)")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure write unavailability while the primary fails over")
+    parser.add_argument("--election-timeouts", type=int, nargs="+", default=ELECTION_TIMEOUTS_MS,
+                        metavar="MS", help="electionTimeoutMillis values to run with")
+    parser.add_argument("--runs", type=int, default=3, help="failovers per election timeout")
+    parser.add_argument("--uri", default=REPLICA_SET_URI)
+    args = parser.parse_args()
+
+    failover_benchmark(args.election_timeouts, args.runs, args.uri)
@@ -0,0 +1,385 @@
+"""
+Declarative fragmentation of the Smart-Building tables.
+
+A spec is a list of fragments, each built from one source table:
+
+- "vertical": the key of the source plus a subset of its columns
+- "list", "range" and "hash": a copy of the source partitioned on one column
+
+A fragment can be placed on another node, a database given by a target of
+common.db and a name. Rows are loaded in parallel chunks of key values and
+the row counts of every fragment are checked against its source.
+
+Applying a spec is idempotent. Every fragment is labelled with a signature of
+its definition once it is loaded and verified. A fragment whose signature and
+row count match is left alone, a missing one is created, and one that differs
+from its definition or is out of date is rebuilt under a temporary name and
+swapped in with one transaction. Fragments marked "maintained" have further
+partitions managed by partition_manager, and are only rebuilt when their
+definition changes.
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.db import copy_value, psql_connection, stream_psql_rows
+
+
+FRAGMENT_TYPES = ("vertical", "list", "range", "hash")
+# Parallel load connections and key values per load chunk
+FRAGMENT_WORKERS = 4
+FRAGMENT_CHUNK_SIZE = 100000
+# Name suffix of a fragment while it is rebuilt
+REBUILD_SUFFIX = "__rebuild"
+SIGNATURE_PREFIX = "fragment "
+IDENTIFIER = re.compile(r"^[a-z_][a-z0-9_]*$")
+INTEGER_TYPES = ("smallint", "integer", "bigint")
+# Hash partitions of access_logs_by_room
+ACCESS_LOGS_HASH_MODULUS = 8
+
+
+def access_logs_hash_fragment(modulus=ACCESS_LOGS_HASH_MODULUS):
+    # Access logs hashed on room_id, so the logs of a room are in one partition
+    return {"name": "access_logs_by_room", "source": "access_logs", "type": "hash", "column": "room_id",
+            "modulus": modulus}
+
+
+FRAGMENTATION_SPEC = [
+    # Rooms by frequency of column access
+    {"name": "room_frequently_accessed_partition", "source": "rooms", "type": "vertical",
+     "columns": ["room_name", "room_type", "floor_id", "room_status"]},
+    {"name": "room_less_frequently_accessed_partition", "source": "rooms", "type": "vertical",
+     "columns": ["room_size", "occupancy_limit", "accessibility_features"]},
+    # Users by role
+    {"name": "users_copy", "source": "users", "type": "list", "column": "role",
+     "partitions": {"users_admin_partition": ["Admin"],
+                    "users_manager_partition": ["Manager"],
+                    "users_employee_partition": ["Employee"]}},
+    # Access logs by year, later months are partitioned by partition_manager
+    {"name": "access_logs_copy", "source": "access_logs", "type": "range", "column": "timestamp",
+     "partitions": {"access_logs_2021_partition": ["2021-01-01", "2022-01-01"],
+                    "access_logs_2022_partition": ["2022-01-01", "2023-01-01"],
+                    "access_logs_2023_partition": ["2023-01-01", "2024-01-01"]},
+     "default": "access_logs_default_partition", "maintained": True},
+    # Access logs by room, for aggregations run on every partition at once
+    access_logs_hash_fragment(),
+]
+
+
+def validate_fragment(fragment):
+    names = [fragment.get("name"), fragment.get("source"), fragment.get("key"), fragment.get("column"),
+             fragment.get("default")]
+    names += fragment.get("columns", [])
+    partitions = fragment.get("partitions", {})
+    names += list(partitions)
+    for name in names:
+        if name is not None and not IDENTIFIER.match(name):
+            raise ValueError(f"{name!r} is not a plain lower case identifier")
+    if not fragment.get("name") or not fragment.get("source"):
+        raise ValueError("Every fragment needs a name and a source")
+    if fragment.get("type") not in FRAGMENT_TYPES:
+        raise ValueError(f"{fragment['name']}: type must be one of {', '.join(FRAGMENT_TYPES)}")
+
+    if fragment["type"] == "vertical":
+        if not fragment.get("columns"):
+            raise ValueError(f"{fragment['name']}: a vertical fragment needs columns")
+        return
+    if not fragment.get("column"):
+        raise ValueError(f"{fragment['name']}: a {fragment['type']} fragment needs a partition column")
+    if fragment["type"] == "hash":
+        if fragment.get("modulus", 0) < 1:
+            raise ValueError(f"{fragment['name']}: a hash fragment needs a positive modulus")
+        if fragment.get("default"):
+            raise ValueError(f"{fragment['name']}: hash partitioned tables cannot have a default partition")
+        if partitions and len(partitions) != fragment["modulus"]:
+            raise ValueError(f"{fragment['name']}: give one partition name per remainder")
+    elif not partitions:
+        raise ValueError(f"{fragment['name']}: a {fragment['type']} fragment needs partitions")
+    if fragment["type"] == "range":
+        for name, bounds in partitions.items():
+            if len(bounds) != 2:
+                raise ValueError(f"{fragment['name']}: range partition {name} needs [from, to) bounds")
+
+
+def fragment_signature(fragment):
+    return SIGNATURE_PREFIX + hashlib.sha256(json.dumps(fragment, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def fragment_node(fragment, dbname, target):
+    node = fragment.get("node", {})
+    return node.get("dbname", dbname), node.get("target", target)
+
+
+def partition_names(fragment):
+    if fragment["type"] == "hash":
+        return list(fragment.get("partitions") or
+                    [f"{fragment['name']}_p{remainder}" for remainder in range(fragment["modulus"])])
+    names = list(fragment["partitions"])
+    if fragment.get("default"):
+        names.append(fragment["default"])
+    return names
+
+
+def source_layout(cur, table):
+    # Columns and types in table order, and the single primary key column
+    cur.execute("""
+        SELECT a.attname, format_type(a.atttypid, a.atttypmod)
+        FROM pg_attribute a
+        WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped
+        ORDER BY a.attnum;
+    """, (table,))
+    columns = dict(cur.fetchall())
+    cur.execute("""
+        SELECT a.attname
+        FROM pg_index i JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+        WHERE i.indrelid = %s::regclass AND i.indisprimary;
+    """, (table,))
+    keys = [row[0] for row in cur.fetchall()]
+    return columns, keys[0] if len(keys) == 1 else None
+
+
+def source_foreign_keys(cur, table, columns):
+    # Foreign keys of table that only use the given columns
+    cur.execute("""
+        SELECT c.conname, pg_get_constraintdef(c.oid),
+               ARRAY(SELECT a.attname FROM pg_attribute a
+                     WHERE a.attrelid = c.conrelid AND a.attnum = ANY(c.conkey))
+        FROM pg_constraint c
+        WHERE c.conrelid = %s::regclass AND c.contype = 'f';
+    """, (table,))
+    return [(name, definition) for name, definition, keys in cur.fetchall() if set(keys) <= set(columns)]
+
+
+def partition_bounds(cur, fragment):
+    def literal(value):
+        if value in ("MINVALUE", "MAXVALUE"):
+            return value
+        return cur.mogrify("%s", (value,)).decode()
+
+    names = partition_names(fragment)
+    if fragment["type"] == "hash":
+        return [(name, f"FOR VALUES WITH (MODULUS {fragment['modulus']}, REMAINDER {remainder})")
+                for remainder, name in enumerate(names)]
+    bounds = []
+    for name, values in fragment["partitions"].items():
+        if fragment["type"] == "list":
+            bounds.append((name, f"FOR VALUES IN ({', '.join(literal(value) for value in values)})"))
+        else:
+            bounds.append((name, f"FOR VALUES FROM ({literal(values[0])}) TO ({literal(values[1])})"))
+    if fragment.get("default"):
+        bounds.append((fragment["default"], "DEFAULT"))
+    return bounds
+
+
+def fragment_ddl(cur, fragment, table, columns, key, foreign_keys, suffix):
+    definitions = [f"{column} {column_type}" for column, column_type in columns.items()]
+    if fragment["type"] == "vertical":
+        definitions[0] += " NOT NULL"
+        definitions.append(f"CONSTRAINT {table}_pkey PRIMARY KEY ({key})")
+    definitions += [f"CONSTRAINT {name} {definition}" for name, definition in foreign_keys]
+    body = ",\n    ".join(definitions)
+
+    if fragment["type"] == "vertical":
+        return [f"CREATE TABLE {table} (\n    {body}\n);"]
+    statements = [f"CREATE TABLE {table} (\n    {body}\n) PARTITION BY {fragment['type'].upper()} ({fragment['column']});"]
+    for name, bound in partition_bounds(cur, fragment):
+        statements.append(f"CREATE TABLE {name}{suffix} PARTITION OF {table} {bound};")
+    return statements
+
+
+def table_signature(cur, table):
+    # None when the table does not exist, "" when it is not a loaded fragment
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL, obj_description(to_regclass(%s), 'pg_class');",
+                (table, table))
+    exists, comment = cur.fetchone()
+    if not exists:
+        return None
+    return comment or ""
+
+
+def key_chunks(cur, fragment, key, key_type, chunk_size):
+    # Inclusive (low, high) key ranges covering the source, or one unbounded chunk
+    if key_type not in INTEGER_TYPES:
+        return [None]
+    cur.execute(f"SELECT MIN({key}), MAX({key}) FROM {fragment['source']};")
+    low, high = cur.fetchone()
+    if low is None:
+        return []
+    return [(start, min(start + chunk_size - 1, high)) for start in range(low, high + 1, chunk_size)]
+
+
+def load_chunk(source, node, fragment, table, columns, key, chunk):
+    column_list = ", ".join(columns)
+    query = f"SELECT {column_list} FROM {fragment['source']}"
+    params = None
+    if chunk is not None:
+        query += f" WHERE {key} BETWEEN %s AND %s"
+        params = chunk
+
+    if node == source:
+        with psql_connection(*node) as conn:
+            cur = conn.cursor()
+            cur.execute(f"INSERT INTO {table} ({column_list}) {query};", params)
+            rows = cur.rowcount
+            cur.close()
+        return rows
+
+    # Another node: stream the chunk out of the source and COPY it in
+    buffer = io.StringIO()
+    rows = 0
+    with psql_connection(*source) as conn:
+        for row in stream_psql_rows(conn, query, params):
+            buffer.write('\t'.join(copy_value(value) for value in row) + '\n')
+            rows += 1
+    buffer.seek(0)
+    with psql_connection(*node) as conn:
+        cur = conn.cursor()
+        cur.copy_expert(f"COPY {table} ({column_list}) FROM STDIN", buffer)
+        cur.close()
+    return rows
+
+
+def row_counts(source, node, fragment, table):
+    with psql_connection(*source) as conn:
+        cur = conn.cursor()
+        cur.execute(f"SELECT COUNT(*) FROM {fragment['source']};")
+        source_rows = cur.fetchone()[0]
+        cur.close()
+    with psql_connection(*node) as conn:
+        cur = conn.cursor()
+        cur.execute(f"SELECT tableoid::regclass::text, COUNT(*) FROM {table} GROUP BY 1 ORDER BY 1;")
+        partitions = dict(cur.fetchall())
+        cur.close()
+    return source_rows, partitions
+
+
+def swap_fragment(node, fragment, build, table, exists):
+    # Replace the old fragment by the rebuilt one in one transaction
+    with psql_connection(*node, autocommit=False) as conn:
+        cur = conn.cursor()
+        if exists:
+            cur.execute(f"DROP TABLE {table};")
+        if build != table:
+            cur.execute(f"ALTER TABLE {build} RENAME TO {table};")
+            if fragment["type"] == "vertical":
+                cur.execute(f"ALTER TABLE {table} RENAME CONSTRAINT {build}_pkey TO {table}_pkey;")
+            else:
+                for name in partition_names(fragment):
+                    cur.execute(f"ALTER TABLE {name}{REBUILD_SUFFIX} RENAME TO {name};")
+        cur.execute(f"COMMENT ON TABLE {table} IS %s;", (fragment_signature(fragment),))
+        conn.commit()
+        cur.close()
+
+
+def apply_fragment(fragment, dbname, target="psql", workers=FRAGMENT_WORKERS, chunk_size=FRAGMENT_CHUNK_SIZE):
+    """
+    Bring one fragment in line with its definition. Returns its status
+    ("unchanged", "created" or "rebuilt"), the source row count and the row
+    count per partition. Raises RuntimeError when the loaded row counts do
+    not match the source.
+    """
+    validate_fragment(fragment)
+    t1 = time.time()
+    table = fragment["name"]
+    source = (dbname, target)
+    node = fragment_node(fragment, dbname, target)
+
+    with psql_connection(*source) as conn:
+        cur = conn.cursor()
+        source_columns, primary_key = source_layout(cur, fragment["source"])
+        key = fragment.get("key", primary_key)
+        if key is None:
+            raise ValueError(f"{table}: {fragment['source']} has no single column primary key, set a key")
+        if fragment["type"] == "vertical":
+            columns = {column: source_columns[column] for column in [key] + fragment["columns"]}
+        else:
+            columns = source_columns
+        # Foreign keys cannot point at tables of another node
+        foreign_keys = source_foreign_keys(cur, fragment["source"], columns) if node == source else []
+        chunks = key_chunks(cur, fragment, key, source_columns[key], chunk_size)
+        cur.close()
+
+    with psql_connection(*node) as conn:
+        cur = conn.cursor()
+        signature = table_signature(cur, table)
+        cur.close()
+
+    if signature == fragment_signature(fragment):
+        # The partitions of a maintained fragment are added and retired at
+        # runtime, so only its definition is compared
+        source_rows, partitions = row_counts(source, node, fragment, table)
+        if fragment.get("maintained") or source_rows == sum(partitions.values()):
+            return {"status": "unchanged", "rows": source_rows, "partitions": partitions,
+                    "seconds": time.time() - t1}
+
+    # A fragment that exists is rebuilt next to it, a new one is built in place
+    exists = signature is not None
+    build = table + REBUILD_SUFFIX if exists else table
+    suffix = REBUILD_SUFFIX if exists else ""
+    with psql_connection(*node, autocommit=False) as conn:
+        cur = conn.cursor()
+        cur.execute(f"DROP TABLE IF EXISTS {table + REBUILD_SUFFIX};")
+        for statement in fragment_ddl(cur, fragment, build, columns, key, foreign_keys, suffix):
+            cur.execute(statement)
+        conn.commit()
+        cur.close()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        loaded = sum(executor.map(
+            lambda chunk: load_chunk(source, node, fragment, build, columns, key, chunk), chunks))
+
+    source_rows, partitions = row_counts(source, node, fragment, build)
+    if loaded != source_rows or sum(partitions.values()) != source_rows:
+        raise RuntimeError(f"{table}: loaded {loaded} rows, {sum(partitions.values())} found, "
+                           f"source has {source_rows}")
+    swap_fragment(node, fragment, build, table, exists)
+
+    if build != table:
+        partitions = {name.replace(REBUILD_SUFFIX, ""): rows for name, rows in partitions.items()}
+    return {"status": "rebuilt" if exists else "created", "rows": source_rows, "partitions": partitions,
+            "seconds": time.time() - t1}
+
+
+def apply_fragmentation(spec=FRAGMENTATION_SPEC, dbname="smart_building", target="psql",
+                        workers=FRAGMENT_WORKERS, chunk_size=FRAGMENT_CHUNK_SIZE, verbose=True):
+    # Apply every fragment of spec in order
+    for fragment in spec:
+        validate_fragment(fragment)
+    results = {}
+    for fragment in spec:
+        result = apply_fragment(fragment, dbname, target, workers, chunk_size)
+        results[fragment["name"]] = result
+        if verbose:
+            print(f"Fragment {fragment['name']} ({fragment['type']} of {fragment['source']}): "
+                  f"{result['status']}, {result['rows']} rows verified in {result['seconds']:.2f}s")
+            if len(result["partitions"]) > 1:
+                for name, rows in result["partitions"].items():
+                    print(f"  {name}: {rows} rows")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply a fragmentation spec to the Smart-Building database")
+    parser.add_argument("--spec", help="JSON file with a list of fragments, defaults to FRAGMENTATION_SPEC")
+    parser.add_argument("--dbname", default="smart_building")
+    parser.add_argument("--target", default="psql")
+    parser.add_argument("--only", nargs="+", metavar="NAME", help="apply only these fragments")
+    parser.add_argument("--workers", type=int, default=FRAGMENT_WORKERS)
+    parser.add_argument("--chunk-size", type=int, default=FRAGMENT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    spec = FRAGMENTATION_SPEC
+    if args.spec:
+        with open(args.spec) as spec_file:
+            spec = json.load(spec_file)
+    if args.only:
+        spec = [fragment for fragment in spec if fragment["name"] in args.only]
+    apply_fragmentation(spec, args.dbname, args.target, args.workers, args.chunk_size)
@@ -0,0 +1,250 @@
+"""
+Workload-driven vertical fragmentation advice.
+
+The workload is a count of normalised statements, either recorded from the
+cursors of a connection with common.workload.record_workload, read from
+pg_stat_statements, or read from a file of statements. Every statement that
+reads or writes the table is reduced to the columns of the table it touches.
+The advisor then tries every split of the non-key columns into two fragments
+and picks the one that reads the fewest pages for the workload, assuming each
+statement scans the fragments holding its columns. The result is reported
+per statement class and emitted as a fragmentation spec with its DDL.
+"""
+
+import argparse
+import math
+import os
+import re
+import sys
+from collections import Counter
+from itertools import combinations
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.db import psql_connection
+from common.workload import (normalize_statement, statement_columns, workload_from_file,
+                             workload_from_pg_stat_statements)
+from fragmentation import fragment_ddl, source_foreign_keys, source_layout
+
+
+PAGE_SIZE = 8192
+# Tuple header and line pointer of every row
+TUPLE_OVERHEAD = 28
+# Splits are enumerated up to this many non-key columns, beyond that greedily
+MAX_EXHAUSTIVE_COLUMNS = 16
+# Keys per B-tree page, to estimate the pages of an index lookup
+INDEX_FANOUT = 300
+
+
+def column_widths(cur, table, columns):
+    # Average stored width per column from the planner statistics, sampled without them
+    cur.execute("SELECT attname, avg_width FROM pg_stats WHERE tablename = %s AND schemaname = 'public';",
+                (table,))
+    widths = dict(cur.fetchall())
+    missing = [column for column in columns if column not in widths]
+    if missing:
+        cur.execute(f"""
+            SELECT {', '.join(f'AVG(pg_column_size({column}))' for column in missing)}
+            FROM (SELECT * FROM {table} LIMIT 10000) sample;
+        """)
+        widths.update(zip(missing, (float(width or 0) for width in cur.fetchone())))
+    return {column: widths[column] for column in columns}
+
+
+def table_rows(cur, table):
+    cur.execute("SELECT reltuples FROM pg_class WHERE oid = %s::regclass;", (table,))
+    rows = cur.fetchone()[0]
+    if rows < 0:
+        cur.execute(f"SELECT COUNT(*) FROM {table};")
+        rows = cur.fetchone()[0]
+    return rows
+
+
+def fragment_pages(rows, widths, key, columns):
+    width = TUPLE_OVERHEAD + widths[key] + sum(widths[column] for column in columns)
+    return math.ceil(rows * width / PAGE_SIZE)
+
+
+def is_key_lookup(statement, key):
+    return re.search(rf"(?<![\w.])(?:\w+\.)?{key}\s*(?:=\s*\?|in\s*\()", statement) is not None
+
+
+def lookup_pages(rows):
+    # Index descent plus one heap page
+    return max(1, math.ceil(math.log(max(rows, 2), INDEX_FANOUT))) + 1
+
+
+def statement_cost(used, lookup, fragments, fragment_sizes, rows):
+    # Fragments a statement reads and the pages it reads from them. Key
+    # lookups read a few pages of each fragment, other statements scan them.
+    touched = [i for i, fragment in enumerate(fragments) if used & fragment]
+    if not touched:
+        # Key-only statements read the smallest fragment
+        touched = [min(range(len(fragments)), key=fragment_sizes.__getitem__)]
+    if lookup:
+        return touched, len(touched) * lookup_pages(rows)
+    return touched, sum(fragment_sizes[i] for i in touched)
+
+
+def workload_cost(classes, fragments, fragment_sizes, rows):
+    # Pages read and fragment joins for the workload with the given fragments
+    pages = joins = 0
+    for used, lookup, calls in classes:
+        touched, statement_pages = statement_cost(used, lookup, fragments, fragment_sizes, rows)
+        pages += calls * statement_pages
+        joins += calls * (len(touched) - 1)
+    return pages, joins
+
+
+def candidate_splits(columns):
+    # Every split of columns into two non-empty fragments, each once
+    first, rest = columns[0], columns[1:]
+    for size in range(len(rest)):
+        for chosen in combinations(rest, size):
+            hot = {first, *chosen}
+            yield hot, set(columns) - hot
+
+
+def greedy_splits(columns, classes):
+    # Start from the columns of the most frequent statements and grow one column at a time
+    counts = Counter()
+    for used, _, calls in classes:
+        for column in used:
+            counts[column] += calls
+    ordered = sorted(columns, key=lambda column: -counts[column])
+    for size in range(1, len(ordered)):
+        yield set(ordered[:size]), set(ordered[size:])
+
+
+def advise_split(conn, table, workload, key=None):
+    """
+    Propose a two-way vertical split of table for workload, a Counter of
+    normalised statements. Returns the chosen fragments, the estimated pages
+    read by the workload before and after, and a report per statement class.
+    """
+    cur = conn.cursor()
+    layout, primary_key = source_layout(cur, table)
+    key = key or primary_key
+    columns = [column for column in layout if column != key]
+    widths = column_widths(cur, table, list(layout))
+    rows = table_rows(cur, table)
+    cur.close()
+
+    statements = []
+    for statement, calls in workload.items():
+        used = statement_columns(statement, table, layout)
+        if used is not None:
+            statements.append((statement, used - {key}, is_key_lookup(statement, key), calls))
+    classes = [(used, lookup, calls) for _, used, lookup, calls in statements]
+
+    columns_set = set(columns)
+    whole = ([columns_set], [fragment_pages(rows, widths, key, columns)])
+    best = (whole[0],) + workload_cost(classes, *whole, rows)
+    splits = (candidate_splits(columns) if len(columns) <= MAX_EXHAUSTIVE_COLUMNS
+              else greedy_splits(columns, classes))
+    for hot, cold in splits:
+        fragments = [hot, cold]
+        sizes = [fragment_pages(rows, widths, key, fragment) for fragment in fragments]
+        pages, joins = workload_cost(classes, fragments, sizes, rows)
+        if (pages, joins) < best[1:]:
+            best = (fragments, pages, joins)
+    pages_before = workload_cost(classes, *whole, rows)[0]
+
+    # The fragment used by most calls first
+    fragments = sorted(best[0], key=lambda fragment: -sum(calls for used, _, calls in classes if used & fragment))
+    sizes = [fragment_pages(rows, widths, key, fragment) for fragment in fragments]
+
+    report = []
+    for statement, used, lookup, calls in sorted(statements, key=lambda item: -item[3]):
+        touched, after = statement_cost(used, lookup, fragments, sizes, rows)
+        _, before = statement_cost(used, lookup, *whole, rows)
+        report.append({"statement": statement, "calls": calls, "columns": sorted(used), "key_lookup": lookup,
+                       "fragments": touched, "pages_before": before, "pages_after": after,
+                       "pages_saved": calls * (before - after)})
+    return {"table": table, "key": key, "rows": rows,
+            "fragments": [sorted(fragment, key=columns.index) for fragment in fragments],
+            "fragment_pages": sizes, "pages_before": pages_before, "pages_after": best[1],
+            "joins": best[2], "report": report}
+
+
+def proposal_spec(advice, names=None):
+    # The proposed split as fragments of a fragmentation spec
+    table = advice["table"]
+    names = names or [f"{table}_fragment_{i + 1}" for i in range(len(advice["fragments"]))]
+    return [{"name": name, "source": table, "type": "vertical", "key": advice["key"], "columns": columns}
+            for name, columns in zip(names, advice["fragments"])]
+
+
+def proposal_ddl(conn, spec):
+    cur = conn.cursor()
+    statements = []
+    for fragment in spec:
+        layout, _ = source_layout(cur, fragment["source"])
+        columns = {column: layout[column] for column in [fragment["key"]] + fragment["columns"]}
+        foreign_keys = source_foreign_keys(cur, fragment["source"], columns)
+        statements += fragment_ddl(cur, fragment, fragment["name"], columns, fragment["key"], foreign_keys, "")
+    cur.close()
+    return statements
+
+
+def print_advice(advice, spec, ddl):
+    mb = PAGE_SIZE / 2**20
+    print(f"Vertical fragmentation advice for {advice['table']} ({advice['rows']:.0f} rows):")
+    if len(advice["fragments"]) == 1:
+        print("  Keep the table whole, no split reads fewer pages for this workload")
+    for fragment, pages in zip(spec, advice["fragment_pages"]):
+        print(f"  {fragment['name']}: {', '.join([fragment['key']] + fragment['columns'])} "
+              f"({pages} pages, {pages * mb:.1f} MB)")
+    saved = advice["pages_before"] - advice["pages_after"]
+    print(f"  Workload reads {advice['pages_before'] * mb:,.1f} MB whole and {advice['pages_after'] * mb:,.1f} MB "
+          f"split, {saved * mb:,.1f} MB saved, {advice['joins']} fragment joins")
+    print("  Per statement class (calls, fragments read, MB saved per call):")
+    for entry in advice["report"]:
+        per_call = (entry["pages_before"] - entry["pages_after"]) * mb
+        print(f"    {entry['calls']:>8} x [{', '.join(spec[i]['name'] for i in entry['fragments'])}] "
+              f"{per_call:+.2f} MB  {entry['statement'][:100]}")
+    print("  DDL:")
+    for statement in ddl:
+        print("    " + statement.replace("\n", "\n    "))
+
+
+def check_statement_columns():
+    # Offline checks of the columns statements are costed on, no database needed
+    layout = ["room_id", "floor_id", "room_name", "room_type", "room_size", "occupancy_limit",
+              "accessibility_features", "room_status"]
+    for query, expected in [
+        ("SELECT MAX(room_size) FROM rooms;", {"room_size"}),
+        ("SELECT room_id FROM rooms WHERE lower(room_type) = 'office';", {"room_id", "room_type"}),
+        ("SELECT COUNT(DISTINCT room_status) FROM rooms;", {"room_status"}),
+        ("SELECT COUNT(*) FROM rooms;", set()),
+        ("SELECT f.floor_number, r.room_name FROM floors f JOIN rooms r USING (floor_id);",
+         {"room_name", "floor_id"}),
+        ("SELECT AVG(r.occupancy_limit) FROM rooms r WHERE r.room_id IN (1, 2);", {"room_id", "occupancy_limit"}),
+    ]:
+        used = statement_columns(normalize_statement(query), "rooms", layout)
+        assert used == expected, (query, used)
+
+    # An aggregate scans the fragment holding its column, not the smallest one
+    fragments = [{"room_name", "room_type"}, {"room_size"}]
+    touched, _ = statement_cost({"room_name"}, False, fragments, [100, 10], 1000)
+    assert touched == [0], touched
+    print("Fragmentation advisor checks passed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Propose a vertical split of a table from its workload")
+    parser.add_argument("--dbname", default="smart_building")
+    parser.add_argument("--table", default="rooms")
+    parser.add_argument("--queries", help="file of ;-separated statements instead of pg_stat_statements")
+    parser.add_argument("--names", nargs=2, metavar="NAME", help="names of the two fragments")
+    parser.add_argument("--check", action="store_true", help="run the offline checks and exit")
+    args = parser.parse_args()
+
+    if args.check:
+        check_statement_columns()
+        sys.exit()
+
+    with psql_connection(args.dbname) as conn:
+        workload = workload_from_file(args.queries) if args.queries else workload_from_pg_stat_statements(conn)
+        advice = advise_split(conn, args.table, workload)
+        spec = proposal_spec(advice, args.names if args.names and len(advice["fragments"]) == 2 else None)
+        print_advice(advice, spec, proposal_ddl(conn, spec))
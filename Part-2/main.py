@@ -2,91 +2,51 @@
 # 2. Vertical Fragmentation: Divide tables into smaller subsets based on columns to optimize data retrieval.
 # 3. Replication Setup: Configure replication models such as master-slave or peer-to-peer replication to enhance data availability.
 
-import psutil
 import psycopg2
-from pymongo import MongoClient
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.db import connect_psql_db, release_psql_db, stream_psql_rows, get_mongo_client, close_all
+from fragmentation import ACCESS_LOGS_HASH_MODULUS, FRAGMENTATION_SPEC, apply_fragmentation
+from change_capture import install_change_capture, print_lag, sync_fragments, verify_fragment
+from partition_manager import attached_partitions, run_maintenance
+from query_router import VerticalRouter
+from node_control import stop_member
+from read_routing import REPLICA_SET_URI, print_member_report, read_distribution, routed_database, tag_members
+from scatter_gather import compare_with_single_backend, denied_access_count
 import time
 from pprint import pprint
 
-def connect_psql_db(dbname="postgres"):
-    print(f"Connecting to {dbname}....")
-    try:
-        connection = psycopg2.connect(  user="postgres",
-                                        password="Password",
-                                        host="127.0.0.1",
-                                        port="5432",
-                                        database=dbname)
-        connection.set_session(autocommit=True)
-        print(f"Connected to {dbname}")
-        return connection
-    except (Exception, psycopg2.Error) as error:
-        print("Error while connecting to PostgreSQL", error)
+def fragments_of(source, *types):
+    return [fragment for fragment in FRAGMENTATION_SPEC
+            if fragment["source"] == source and (not types or fragment["type"] in types)]
+
+
+def display_fragment(conn, table, description=None):
+    print(f"Displaying 10 records{description or ''} from {table}")
+    for i,row in enumerate(stream_psql_rows(conn, f"""
+        SELECT * FROM {table} LIMIT 10;
+    """)):
+        print(f"{i}. {row}")
+
 
 def create_vertical_partitions(conn):
     # Vertical Fragmentation on Rooms Table
     # Criteria: Frequency of column access.
     # Implementation: Split the Rooms table into two: one part containing frequently accessed columns like RoomID, 
     # RoomName, RoomType, and another part with less frequently used columns like RoomSize, OccupancyLimit, AccessibilityFeatures.
+    # The split is declared in FRAGMENTATION_SPEC.
 
     print("Vertical Fragmentation on Rooms Table")
     print("Criteria: Frequency of column access")
     print("Implementation: Split the Rooms table into two: one part containing frequently accessed columns like RoomID, RoomName, RoomType, and another part with less frequently used columns like RoomSize, OccupancyLimit, AccessibilityFeatures.")
 
     try:
-        cur = conn.cursor()
-
-        # Create the frequently accessed table
-        cur.execute("""
-            CREATE TABLE room_frequently_accessed_partition (
-                room_id SERIAL PRIMARY KEY,
-                room_name VARCHAR(255),
-                room_type VARCHAR(50),
-                floor_id INT REFERENCES floors(floor_id),
-                room_status VARCHAR(50)
-            );
-        """)
-
-        # Copy data from the original Rooms table to the frequently accessed table
-        cur.execute("""
-            INSERT INTO room_frequently_accessed_partition (room_id, room_name, room_type, floor_id, room_status)
-            SELECT room_id, room_name, room_type, floor_id, room_status
-            FROM rooms;
-        """)
-
-        # Create the less frequently accessed table
-        cur.execute("""
-            CREATE TABLE room_less_frequently_accessed_partition (
-                room_id SERIAL PRIMARY KEY,
-                room_size FLOAT,
-                occupancy_limit INT,
-                accessibility_features TEXT
-            );
-        """)
-
-        # Copy data from the original Rooms table to the less frequently accessed table
-        cur.execute("""
-            INSERT INTO room_less_frequently_accessed_partition (room_id, room_size, occupancy_limit, accessibility_features)
-            SELECT room_id, room_size, occupancy_limit, accessibility_features
-            FROM Rooms;
-        """)
-
-        print("Displaying 10 records from room_frequently_accessed_partition")
-        cur.execute("""
-            SELECT * FROM room_frequently_accessed_partition LIMIT 10;
-        """)
+        install_change_capture(fragments_of("rooms"), conn.info.dbname)
+        apply_fragmentation(fragments_of("rooms"), conn.info.dbname)
 
-        for i,row in enumerate(cur.fetchall()):
-            print(f"{i}. {row}")
-        
-        print("Displaying 10 records from room_less_frequently_accessed_partition")
-        cur.execute("""
-            SELECT * FROM room_less_frequently_accessed_partition LIMIT 10;
-        """)
-
-        for i,row in enumerate(cur.fetchall()):
-            print(f"{i}. {row}")
-
-        cur.close()
+        display_fragment(conn, "room_frequently_accessed_partition")
+        display_fragment(conn, "room_less_frequently_accessed_partition")
 
         print("Vertical Fragmentation on Rooms Table complete")
     
@@ -96,6 +56,31 @@ def create_vertical_partitions(conn):
     return
 
 
+def route_room_queries(conn):
+    # Room queries read the narrow fragment when its columns are enough, and
+    # join the fragments on room_id only when they need the wide columns
+    print("Routing queries on Rooms to its vertical fragments")
+    router = VerticalRouter.from_spec(conn, "rooms")
+    queries = [
+        "SELECT room_name, room_type, room_status FROM rooms WHERE room_id = 5;",
+        "SELECT r.room_id, r.occupancy_limit FROM rooms r WHERE r.accessibility_features = 'Wheelchair accessible' LIMIT 5;",
+        "SELECT * FROM rooms WHERE room_id = 5;",
+    ]
+    try:
+        cur = conn.cursor()
+        for query in queries:
+            rewritten, route = router.rewrite(query)
+            print(f"{query}\n  -> ({route}) {rewritten}")
+            cur.execute(rewritten)
+            for i,row in enumerate(cur.fetchall()):
+                print(f"{i}. {row}")
+        cur.close()
+        print("Routes taken: ", dict(router.routes))
+
+    except (Exception, psycopg2.Error) as error:
+        print("Error while routing queries on Rooms: ", error)
+
+
 def create_horizontal_partitions(conn):
     # Horizontal Fragmentation on Users Table
     # Criteria: Role of the user.
@@ -105,81 +90,14 @@ def create_horizontal_partitions(conn):
     print("Implementation: Split the Users table into three parts based on the role of the user: Admin, Manager, Employee.")
 
     try:
-        cur = conn.cursor()
-
-        # Create a copy of the Users table with partition on role
-
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS users_copy (
-                user_id INT,
-                user_name VARCHAR(255),
-                email VARCHAR(255),
-                role VARCHAR(50),
-                password_hash TEXT,
-                date_joined DATE,
-                last_login_date DATE,
-                phone_number VARCHAR(50),
-                emergency_contact VARCHAR(255),
-                access_level VARCHAR(50)
-            ) PARTITION BY LIST (role);
-        """)
-
-        # Create a partition for Admin users
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS users_admin_partition
-            PARTITION OF users_copy
-            FOR VALUES IN ('Admin');
-        """)
-
-        # Create a partition for Manager users
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS users_manager_partition
-            PARTITION OF users_copy
-            FOR VALUES IN ('Manager');
-        """)
-
-        # Create a partition for Employee users
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS users_employee_partition
-            PARTITION OF users_copy
-            FOR VALUES IN ('Employee');
-        """)
-
-        # Insert data into the partitions from Users table
-        cur.execute("""
-            INSERT INTO users_copy
-            SELECT * FROM users;
-        """)
+        install_change_capture(fragments_of("users"), conn.info.dbname)
+        apply_fragmentation(fragments_of("users"), conn.info.dbname)
 
         print("List partitions on Users Table based on their roles complete")
 
-        print("Displaying 10 records with role Admin from users_admin_partition")
-        cur.execute("""
-            SELECT * FROM users_admin_partition LIMIT 10;
-        """)
-
-        for i,row in enumerate(cur.fetchall()):
-            print(f"{i}. {row}")
-        
-        print("Displaying 10 records with role Manager from users_manager_partition")
-
-        cur.execute("""
-            SELECT * FROM users_manager_partition LIMIT 10;
-        """)
-
-        for i,row in enumerate(cur.fetchall()):
-            print(f"{i}. {row}")
-
-        print("Displaying 10 records with role Staff from users_employee_partition")
-
-        cur.execute("""
-            SELECT * FROM users_employee_partition LIMIT 10;
-        """)
-
-        for i,row in enumerate(cur.fetchall()):
-            print(f"{i}. {row}")
-    
-        cur.close()
+        display_fragment(conn, "users_admin_partition", " with role Admin")
+        display_fragment(conn, "users_manager_partition", " with role Manager")
+        display_fragment(conn, "users_employee_partition", " with role Employee")
     
     except (Exception, psycopg2.Error) as error:
         print("Error while performing List partitions on Users Table based on their roles: ", error)
@@ -188,124 +106,108 @@ def create_horizontal_partitions(conn):
     # Horizontal Fragmentation on AccessLogs Table
     # Criteria: Timestamp of the access.
     # Implementation: Split the AccessLogs table into three parts based on the timestamp of the access: 2021, 2022, 2023.
+    # Later months are added, and old partitions retired, by the partition manager.
     print("Creating Range partitions on AccessLogs Table")
     print("Criteria: Timestamp of the access")
     print("Implementation: Split the AccessLogs table into three parts based on the timestamp of the access: 2021, 2022, 2023.")
     
     try:
+        install_change_capture(fragments_of("access_logs", "range"), conn.info.dbname)
+        apply_fragmentation(fragments_of("access_logs", "range"), conn.info.dbname)
+        run_maintenance(conn.info.dbname)
+
+        print("Range partitions on AccessLogs Table based on timestamp complete")
+
+        # The oldest partitions still attached
         cur = conn.cursor()
+        partitions, _ = attached_partitions(cur, "access_logs_copy")
+        cur.close()
+        for partition in sorted(partitions, key=partitions.get)[:3]:
+            display_fragment(conn, partition)
 
-        # Create a copy of the AccessLogs table with partition on timestamp
+    except (Exception, psycopg2.Error) as error:
+        print("Error while performing Range partitions on AccessLogs Table based on timestamp: ", error)
 
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS access_logs_copy (
-                log_id INT,
-                user_id INT REFERENCES users(user_id),
-                room_id INT REFERENCES rooms(room_id),
-                timestamp TIMESTAMP,
-                access_type VARCHAR(50),
-                access_method VARCHAR(50),
-                access_status VARCHAR(50)
-            ) PARTITION BY RANGE (timestamp);
-        """)
 
-        # Create a partition for 2021
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS access_logs_2021_partition
-            PARTITION OF access_logs_copy
-            FOR VALUES FROM ('2021-01-01') TO ('2021-12-31');
-        """)
+    # Horizontal Fragmentation on AccessLogs Table
+    # Criteria: Hash of the room of the access.
+    # Implementation: Split the AccessLogs table into ACCESS_LOGS_HASH_MODULUS parts by the hash of room_id,
+    # so aggregations can run on every part at once.
+    print("Creating Hash partitions on AccessLogs Table")
+    print("Criteria: Hash of the room of the access")
+    print(f"Implementation: Split the AccessLogs table into {ACCESS_LOGS_HASH_MODULUS} parts based on the hash of room_id.")
 
-        # Create a partition for 2022
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS access_logs_2022_partition
-            PARTITION OF access_logs_copy
-            FOR VALUES FROM ('2022-01-01') TO ('2022-12-31');
-        """)
+    try:
+        install_change_capture(fragments_of("access_logs", "hash"), conn.info.dbname)
+        apply_fragmentation(fragments_of("access_logs", "hash"), conn.info.dbname)
 
-        # Create a partition for 2023
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS access_logs_2023_partition
-            PARTITION OF access_logs_copy
-            FOR VALUES FROM ('2023-01-01') TO ('2023-12-31');
-        """)
+        print("Hash partitions on AccessLogs Table based on room complete")
 
-        # Insert data into the partitions from AccessLogs table
+        print("Denied accesses, counted on every partition at once: ", denied_access_count(dbname=conn.info.dbname))
+        compare_with_single_backend(dbname=conn.info.dbname)
 
-        cur.execute("""
-            INSERT INTO access_logs_copy
-            SELECT * FROM access_logs;
-        """)
+    except (Exception, psycopg2.Error) as error:
+        print("Error while performing Hash partitions on AccessLogs Table based on room: ", error)
 
-        print("Range partitions on AccessLogs Table based on timestamp complete")
+    return
 
-        print("Displaying 10 records from access_logs_2021_partition")
+def sync_fragments_incrementally(conn):
+    # Changes to the source tables are captured by triggers and only the
+    # changed rows are applied to the fragments
+    print("Syncing fragments with the changes made to their source tables")
+    original = None
+    try:
+        cur = conn.cursor()
         cur.execute("""
-            SELECT * FROM access_logs_2021_partition LIMIT 10;
+            SELECT room_status, role FROM rooms, users
+            WHERE room_id = 1 AND user_id = 1;
         """)
-
-        for i,row in enumerate(cur.fetchall()):
-            print(f"{i}. {row}")
-
-        print("Displaying 10 records from access_logs_2022_partition")
-
+        original = cur.fetchone()
         cur.execute("""
-            SELECT * FROM access_logs_2022_partition LIMIT 10;
+            UPDATE rooms SET room_status = CASE room_status WHEN 'Available' THEN 'Occupied' ELSE 'Available' END
+            WHERE room_id = 1;
         """)
+        cur.execute("UPDATE users SET role = 'Manager' WHERE user_id = 1;")
+        cur.close()
 
-        for i,row in enumerate(cur.fetchall()):
-            print(f"{i}. {row}")
+        print("Lag before the sync")
+        print_lag(conn.info.dbname)
+        sync_fragments(FRAGMENTATION_SPEC, conn.info.dbname)
+        print("Lag after the sync")
+        print_lag(conn.info.dbname)
 
-        print("Displaying 10 records from access_logs_2023_partition")
+        for fragment in FRAGMENTATION_SPEC:
+            result = verify_fragment(fragment, conn.info.dbname)
+            print(f"{fragment['name']}: {'in sync' if result['in_sync'] else 'out of sync'}, "
+                  f"{result['fragment_rows']} of {result['source_rows']} source rows")
 
-        cur.execute("""
-            SELECT * FROM access_logs_2023_partition LIMIT 10;
-        """)
+    except (Exception, psycopg2.Error) as error:
+        print("Error while syncing fragments: ", error)
+
+    finally:
+        if original is not None:
+            restore_sample_rows(conn, *original)
 
-        for i,row in enumerate(cur.fetchall()):
-            print(f"{i}. {row}")
 
+def restore_sample_rows(conn, room_status, role):
+    # Undo the sample changes in the source tables and sync the fragments again
+    try:
+        cur = conn.cursor()
+        cur.execute("UPDATE rooms SET room_status = %s WHERE room_id = 1;", (room_status,))
+        cur.execute("UPDATE users SET role = %s WHERE user_id = 1;", (role,))
         cur.close()
+        sync_fragments(FRAGMENTATION_SPEC, conn.info.dbname)
+        print("Restored room 1 and user 1 in the source tables and their fragments")
 
     except (Exception, psycopg2.Error) as error:
-        print("Error while performing Range partitions on AccessLogs Table based on timestamp: ", error)
-    
-    return
-
-def find_process_by_port(port):
-    """
-    Find a process by the port it is listening on.
-    """
-    for process in psutil.process_iter(['pid', 'name', 'connections']):
-        connections = process.info.get('connections')
-        if connections:
-            for conn in connections:
-                if conn.laddr and conn.laddr.port == port:
-                    return process.info['pid']
-    return None
-
-def kill_process_by_port(port):
-    """
-    Kill a process by the port it is listening on.
-    """
-    pid = find_process_by_port(port)
-    if pid is not None:
-        try:
-            process = psutil.Process(pid)
-            process.terminate()  # or process.kill() for forceful termination
-            print(f"Process with PID {pid} on port {port} terminated.")
-            
-        except psutil.NoSuchProcess as e:
-            print(f"Error: {e}")
-    else:
-        print(f"No process found on port {port}.")
+        print("Error while restoring the sample rows: ", error)
 
 
 def replication_interaction():
     # Interactions with replica set using pymongo
     # Connect to MongoDB
     print("Connecting to MongoDB....")
-    client = MongoClient('mongodb://localhost:27017,localhost:27018,localhost:27019/?replicaSet=SmartBuilding')
+    client = get_mongo_client(REPLICA_SET_URI)
     print("Connected to MongoDB")
 
     # Status of the replica set
@@ -330,12 +232,26 @@ def replication_interaction():
     print("Reading the document from the collection")
     pprint(sensor_data.find_one())
 
+    # Sensor and dashboard reads go to the secondaries, writes stay on the primary
+    print("Routing reads to the secondaries")
+    if tag_members(client):
+        print("Tagged the replica set members")
+    print("Members of the replica set")
+    print_member_report(client)
+    reporting = routed_database('smart_building', mode='secondaryPreferred')
+    served, latency = read_distribution(reporting, 'sensor_data')
+    print(f"Reads served per member (secondaryPreferred): {dict(served)}, {latency:.2f}ms per read")
+
     print("Failover Scenario")
 
     # Kill the primary node
     print("Killing the primary node")
 
-    kill_process_by_port(27017)
+    pid = stop_member(27017)
+    if pid is not None:
+        print(f"Process with PID {pid} on port 27017 terminated.")
+    else:
+        print("No process found on port 27017.")
     time.sleep(10)
 
     # Status of the replica set
@@ -359,12 +275,20 @@ if __name__ == '__main__':
 
     # # Create Vertical Partitions
     create_vertical_partitions(conn)
+    route_room_queries(conn)
 
     # # Create Horizontal Partitions
     create_horizontal_partitions(conn)
 
+    # Keep the fragments in sync with their source tables
+    sync_fragments_incrementally(conn)
+
+    release_psql_db(conn)
+
     # Setup Replication
     replication_interaction()
 
+    close_all()
+
 
 
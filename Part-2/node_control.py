@@ -0,0 +1,236 @@
+"""
+Start, stop and kill the mongod members of the SmartBuilding replica set.
+
+Every member is started by start_member, which writes the PID of its mongod
+next to its data directory (./rsN/mongod.pid), so finding the process of a
+member is a file read and a check that the PID is still that mongod. Members
+started some other way are found with one scan of the socket table, indexed
+by listening port, instead of listing the connections of every process.
+
+start_process, process_pid and signal_process do the same for any mongod or
+mongos given its port and directory, e.g. the members of sharded_cluster.
+"""
+
+import argparse
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import time
+
+import psutil
+from pymongo.errors import PyMongoError
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.db import get_mongo_client
+from read_routing import REPLICA_SET, REPLICA_SET_PORTS, routed_client
+
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Seconds to wait for a member to stop, or to answer, before giving up
+STOP_TIMEOUT = 30
+START_TIMEOUT = 60
+
+
+def member_dir(port):
+    return os.path.join(BASE_DIR, f"rs{REPLICA_SET_PORTS.index(port) + 1}")
+
+
+def pid_file(directory, binary="mongod"):
+    return os.path.join(directory, f"{binary}.pid")
+
+
+def is_mongo_process(pid, port, binary="mongod"):
+    # The PID is alive and still the binary of this port, not a reused PID
+    try:
+        process = psutil.Process(pid)
+        return process.name().startswith(binary) and str(port) in process.cmdline()
+    except (psutil.NoSuchProcess, psutil.AccessDenied):
+        return False
+
+
+def listening_pids():
+    # port -> PID of every listening TCP socket, from one scan of the socket table
+    try:
+        connections = psutil.net_connections(kind="tcp")
+    except psutil.AccessDenied:
+        connections = [connection for process in psutil.process_iter()
+                       for connection in _process_connections(process)]
+    return {connection.laddr.port: connection.pid for connection in connections
+            if connection.status == psutil.CONN_LISTEN and connection.pid}
+
+
+def _process_connections(process):
+    try:
+        # net_connections is called connections before psutil 6
+        connections = getattr(process, "net_connections", process.connections)
+        return [connection._replace(pid=process.pid) for connection in connections(kind="tcp")]
+    except (psutil.NoSuchProcess, psutil.AccessDenied):
+        return []
+
+
+def process_pid(port, directory, binary="mongod"):
+    # PID of the binary started in directory for port, or None when it is not running
+    try:
+        with open(pid_file(directory, binary)) as file:
+            pid = int(file.read().strip())
+        if is_mongo_process(pid, port, binary):
+            return pid
+    except (OSError, ValueError):
+        pass
+    return listening_pids().get(port)
+
+
+def member_pid(port):
+    # PID of the mongod of a member, or None when it is not running
+    return process_pid(port, member_dir(port))
+
+
+def answers(port):
+    try:
+        client = get_mongo_client(f"mongodb://localhost:{port}/", directConnection=True,
+                                  serverSelectionTimeoutMS=500, connectTimeoutMS=500)
+        client.admin.command("ping")
+        return True
+    except PyMongoError:
+        return False
+
+
+def start_process(port, directory, args, logpath, binary="mongod", fresh=False, timeout=START_TIMEOUT):
+    """
+    Start binary on port with args, with an empty directory when fresh, and
+    wait until it answers. Returns its PID, or the PID already running there.
+    """
+    pid = process_pid(port, directory, binary)
+    if pid is not None:
+        if not fresh:
+            return pid
+        signal_process(port, directory, signal.SIGTERM, binary)
+    if fresh and os.path.isdir(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory, exist_ok=True)
+
+    # A session of its own, so the process outlives the shell or script that started it
+    process = subprocess.Popen(
+        [binary, *args, "--logpath", logpath, "--logappend", "--port", str(port)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    with open(pid_file(directory, binary), "w") as file:
+        file.write(f"{process.pid}\n")
+
+    deadline = time.monotonic() + timeout
+    while not answers(port):
+        if process.poll() is not None:
+            raise RuntimeError(f"{binary} on port {port} exited with {process.returncode}, see {logpath}")
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"{binary} on port {port} did not answer within {timeout}s")
+        time.sleep(0.2)
+    return process.pid
+
+
+def signal_process(port, directory, signum, binary="mongod", timeout=STOP_TIMEOUT):
+    # Signal the process and wait for it to exit. Returns its PID, or None if not running.
+    pid = process_pid(port, directory, binary)
+    if pid is None:
+        return None
+    try:
+        process = psutil.Process(pid)
+        process.send_signal(signum)
+        try:
+            process.wait(timeout)
+        except psutil.TimeoutExpired:
+            if signum == signal.SIGKILL:
+                raise RuntimeError(f"{binary} on port {port} (PID {pid}) did not exit within {timeout}s of SIGKILL")
+            print(f"{binary} on port {port} (PID {pid}) did not exit within {timeout}s, killing it")
+            process.kill()
+            process.wait(timeout)
+    except psutil.NoSuchProcess:
+        pass
+    finally:
+        try:
+            os.remove(pid_file(directory, binary))
+        except OSError:
+            pass
+    return pid
+
+
+def start_member(port, fresh=False, timeout=START_TIMEOUT):
+    """
+    Start the mongod of a member, with an empty data directory when fresh, and
+    wait until it answers. Returns its PID.
+    """
+    directory = member_dir(port)
+    number = REPLICA_SET_PORTS.index(port) + 1
+    return start_process(port, directory, ["--replSet", REPLICA_SET, "--dbpath", directory],
+                         os.path.join(directory, f"{number}.log"), fresh=fresh, timeout=timeout)
+
+
+def stop_member(port, timeout=STOP_TIMEOUT):
+    # Clean shutdown, a primary steps down first. Returns the PID, or None if not running.
+    return signal_process(port, member_dir(port), signal.SIGTERM, timeout=timeout)
+
+
+def kill_member(port, timeout=STOP_TIMEOUT):
+    # Crash the member: no step down, no flush. Returns the PID, or None if not running.
+    return signal_process(port, member_dir(port), signal.SIGKILL, timeout=timeout)
+
+
+def initiate_replica_set(ports=REPLICA_SET_PORTS, name=REPLICA_SET, configsvr=False):
+    # Initiate the set from its first member, unless it already is
+    client = get_mongo_client(f"mongodb://localhost:{ports[0]}/", directConnection=True)
+    try:
+        client.admin.command("replSetGetStatus")
+        return False
+    except PyMongoError:
+        pass
+    config = {
+        "_id": name,
+        "members": [{"_id": i, "host": f"localhost:{port}"} for i, port in enumerate(ports)],
+    }
+    if configsvr:
+        config["configsvr"] = True
+    client.admin.command("replSetInitiate", config)
+    return True
+
+
+def wait_until_healthy(client, timeout=120):
+    # Until there is a primary and every other member is a secondary
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            states = [member["stateStr"] for member in client.admin.command("replSetGetStatus")["members"]]
+            if states.count("PRIMARY") == 1 and states.count("SECONDARY") == len(states) - 1:
+                return
+        except PyMongoError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError("The replica set did not become healthy in time")
+
+
+def member_status(ports=REPLICA_SET_PORTS):
+    return {port: {"pid": member_pid(port), "answers": answers(port)} for port in ports}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Control the mongod members of the replica set")
+    parser.add_argument("command", choices=["start", "stop", "kill", "status", "initiate", "wait"])
+    parser.add_argument("--ports", type=int, nargs="+", default=list(REPLICA_SET_PORTS))
+    parser.add_argument("--fresh", action="store_true", help="start with empty data directories")
+    args = parser.parse_args()
+
+    if args.command == "start":
+        for port in args.ports:
+            print(f"mongod on port {port}: PID {start_member(port, args.fresh)}")
+    elif args.command in ("stop", "kill"):
+        action, done = (stop_member, "stopped") if args.command == "stop" else (kill_member, "killed")
+        for port in args.ports:
+            pid = action(port)
+            print(f"mongod on port {port}: " + (f"PID {pid} {done}" if pid else "not running"))
+    elif args.command == "initiate":
+        print("Replica set initiated" if initiate_replica_set(args.ports) else "Replica set already initiated")
+    elif args.command == "wait":
+        wait_until_healthy(routed_client())
+        print("Replica set healthy")
+    else:
+        for port, status in member_status(args.ports).items():
+            print(f"mongod on port {port}: PID {status['pid']}, {'answering' if status['answers'] else 'not answering'}")
@@ -0,0 +1,245 @@
+"""
+Rolling time partitions for range partitioned tables.
+
+Every maintenance run makes sure that a table of ROLLING_PARTITIONS has
+
+- a DEFAULT partition, so rows outside every partition are still accepted,
+- a partition for the current period and the next premake periods,
+- a partition for every recent period that has rows in the DEFAULT
+  partition, with those rows moved into it, which keeps pruning tight,
+- its partitions older than retention periods retired: detached and renamed
+  with a _detached suffix, moved to an archive tablespace, or dropped.
+
+Runs are idempotent and are meant to be scheduled, either with
+run_maintenance_job or with cron calling this script with --once.
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.db import psql_connection
+
+
+INTERVALS = ("month", "day")
+RETIRE_MODES = ("detach", "tablespace", "drop")
+DETACHED_SUFFIX = "_detached"
+# Seconds between runs of the maintenance job
+MAINTENANCE_EVERY = 3600
+
+ROLLING_PARTITIONS = {
+    "access_logs_copy": {
+        "column": "timestamp",
+        "interval": "month",
+        # Periods created ahead of the current one
+        "premake": 3,
+        # Periods kept attached before the current one
+        "retention": 36,
+        "retire": "detach",
+        # Tablespace of retired partitions with retire "tablespace"
+        "archive_tablespace": None,
+        "default": "access_logs_default_partition",
+    },
+}
+
+BOUNDS = re.compile(r"FOR VALUES FROM \((.+)\) TO \((.+)\)")
+
+
+def validate_rolling(table, config):
+    if config["interval"] not in INTERVALS:
+        raise ValueError(f"{table}: interval must be one of {', '.join(INTERVALS)}")
+    if config["retire"] not in RETIRE_MODES:
+        raise ValueError(f"{table}: retire must be one of {', '.join(RETIRE_MODES)}")
+    if config["retire"] == "tablespace" and not config.get("archive_tablespace"):
+        raise ValueError(f"{table}: retire 'tablespace' needs an archive_tablespace")
+    if config["premake"] < 0 or config["retention"] < 1:
+        raise ValueError(f"{table}: premake must be >= 0 and retention >= 1")
+
+
+def period_start(moment, interval):
+    if interval == "month":
+        return datetime(moment.year, moment.month, 1)
+    return datetime(moment.year, moment.month, moment.day)
+
+
+def shift_period(start, interval, periods):
+    if interval == "month":
+        month = start.month - 1 + periods
+        return datetime(start.year + month // 12, month % 12 + 1, 1)
+    return start + timedelta(days=periods)
+
+
+def period_name(table, start, interval):
+    return f"{table}_{start:%Y%m}" if interval == "month" else f"{table}_{start:%Y%m%d}"
+
+
+def bound_value(text):
+    if text in ("MINVALUE", "MAXVALUE"):
+        return datetime.min if text == "MINVALUE" else datetime.max
+    return datetime.fromisoformat(text.strip("'"))
+
+
+def attached_partitions(cur, table):
+    # name -> (from, to) of every range partition, and the name of the default partition
+    cur.execute("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = %s::regclass;
+    """, (table,))
+    partitions, default = {}, None
+    for name, bound in cur.fetchall():
+        if bound == "DEFAULT":
+            default = name
+            continue
+        low, high = BOUNDS.match(bound).groups()
+        partitions[name] = (bound_value(low), bound_value(high))
+    return partitions, default
+
+
+def create_period_partition(conn, table, config, default, name, low, high):
+    """
+    Create the partition [low, high) next to the table, move the rows of the
+    period out of the default partition into it and attach it, all in one
+    transaction. The CHECK constraint lets ATTACH skip scanning the new
+    partition. Returns the number of rows moved.
+    """
+    column = config["column"]
+    cur = conn.cursor()
+    cur.execute(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS);")
+    cur.execute(f"""
+        ALTER TABLE {name} ADD CONSTRAINT {name}_bounds
+        CHECK ({column} IS NOT NULL AND {column} >= %s AND {column} < %s);
+    """, (low, high))
+    moved = 0
+    if default:
+        cur.execute(f"""
+            WITH moved AS (
+                DELETE FROM {default} WHERE {column} >= %s AND {column} < %s RETURNING *
+            )
+            INSERT INTO {name} SELECT * FROM moved;
+        """, (low, high))
+        moved = cur.rowcount
+    cur.execute(f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s);", (low, high))
+    cur.execute(f"ALTER TABLE {name} DROP CONSTRAINT {name}_bounds;")
+    conn.commit()
+    cur.close()
+    return moved
+
+
+def retire_partition(conn, table, config, name):
+    # Returns False when the partition was already retired
+    cur = conn.cursor()
+    if config["retire"] == "detach":
+        # Renamed so that the name is free for the partition manager and fragmentation
+        cur.execute(f"ALTER TABLE {table} DETACH PARTITION {name};")
+        cur.execute(f"ALTER TABLE {name} RENAME TO {name}{DETACHED_SUFFIX};")
+    elif config["retire"] == "drop":
+        cur.execute(f"DROP TABLE {name};")
+    else:
+        cur.execute("""
+            SELECT COALESCE(t.spcname, 'pg_default')
+            FROM pg_class c LEFT JOIN pg_tablespace t ON t.oid = c.reltablespace
+            WHERE c.oid = %s::regclass;
+        """, (name,))
+        if cur.fetchone()[0] == config["archive_tablespace"]:
+            conn.rollback()
+            cur.close()
+            return False
+        cur.execute(f"ALTER TABLE {name} SET TABLESPACE {config['archive_tablespace']};")
+    conn.commit()
+    cur.close()
+    return True
+
+
+def maintain_partitions(conn, table, config, now=None):
+    """
+    One maintenance run for table on conn, which must not be in autocommit
+    mode. Returns the partitions created with the rows moved into each, the
+    partitions retired, and the rows left in the default partition.
+    """
+    validate_rolling(table, config)
+    interval = config["interval"]
+    column = config["column"]
+    current = period_start(now or datetime.now(), interval)
+    cutoff = shift_period(current, interval, -config["retention"])
+    cur = conn.cursor()
+
+    partitions, default = attached_partitions(cur, table)
+    if default is None:
+        default = config["default"]
+        cur.execute(f"CREATE TABLE {default} PARTITION OF {table} DEFAULT;")
+        conn.commit()
+
+    # Recent periods with rows in the default partition, then the upcoming ones
+    cur.execute(f"SELECT DISTINCT date_trunc(%s, {column}) FROM {default} WHERE {column} >= %s;",
+                (interval, cutoff))
+    periods = {start for (start,) in cur.fetchall()}
+    periods |= {shift_period(current, interval, ahead) for ahead in range(config["premake"] + 1)}
+    conn.commit()
+
+    created = {}
+    for start in sorted(periods):
+        end = shift_period(start, interval, 1)
+        # Periods overlapping an existing partition, e.g. a yearly one, are covered
+        if any(low < end and start < high for low, high in partitions.values()):
+            continue
+        name = period_name(table, start, interval)
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (name,))
+        if cur.fetchone()[0]:
+            conn.commit()
+            print(f"Skipping {name}: a table of that name exists but is not a partition of {table}")
+            continue
+        conn.commit()
+        created[name] = create_period_partition(conn, table, config, default, name, start, end)
+        partitions[name] = (start, end)
+
+    retired = []
+    for name, (low, high) in sorted(partitions.items(), key=lambda item: item[1]):
+        if high <= cutoff and retire_partition(conn, table, config, name):
+            retired.append(name)
+
+    cur.execute(f"SELECT COUNT(*) FROM {default};")
+    default_rows = cur.fetchone()[0]
+    conn.commit()
+    cur.close()
+    return {"created": created, "retired": retired, "default_rows": default_rows}
+
+
+def run_maintenance(dbname="smart_building", tables=ROLLING_PARTITIONS, now=None, verbose=True):
+    results = {}
+    with psql_connection(dbname, autocommit=False) as conn:
+        for table, config in tables.items():
+            results[table] = result = maintain_partitions(conn, table, config, now)
+            if verbose:
+                print(f"Partition maintenance of {table}: {len(result['created'])} partitions created, "
+                      f"{sum(result['created'].values())} rows moved out of the default partition, "
+                      f"{len(result['retired'])} retired ({config['retire']}), "
+                      f"{result['default_rows']} rows left in the default partition")
+    return results
+
+
+def run_maintenance_job(dbname="smart_building", tables=ROLLING_PARTITIONS, every=MAINTENANCE_EVERY):
+    # Run maintenance every `every` seconds. A failed run is reported and retried next time.
+    while True:
+        try:
+            run_maintenance(dbname, tables)
+        except Exception as error:
+            print("Error during partition maintenance: ", error)
+        time.sleep(every)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain rolling time partitions")
+    parser.add_argument("--dbname", default="smart_building")
+    parser.add_argument("--once", action="store_true", help="run once, e.g. from cron")
+    parser.add_argument("--every", type=int, default=MAINTENANCE_EVERY, help="seconds between runs")
+    args = parser.parse_args()
+
+    if args.once:
+        run_maintenance(args.dbname)
+    else:
+        run_maintenance_job(args.dbname, every=args.every)
@@ -0,0 +1,188 @@
+"""
+Routing of queries on a vertically fragmented table to its fragments.
+
+A VerticalRouter knows the columns of every vertical fragment of a table.
+It rewrites a SELECT on the table to read the smallest fragment holding
+every column the query uses, or a join of fragments on the key when no
+single fragment does. The fragment, or the join wrapped in a subquery,
+keeps the alias of the table, so qualified column names keep working.
+String literals and comments are never rewritten. Other statements, and
+queries using columns no fragment holds, go to the table itself.
+
+route_queries applies a router to every cursor of a connection.
+"""
+
+import os
+import re
+import sys
+from collections import Counter
+from contextlib import contextmanager
+from itertools import combinations
+
+import psycopg2.extensions
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.workload import KEYWORDS, STRING_LITERAL, normalize_statement, statement_columns
+from fragmentation import FRAGMENTATION_SPEC, source_layout
+
+
+# Text the table references are not looked for in: string literals, comments
+# and dollar quoted strings. Masked ones are \x00<number>\x00.
+UNROUTED_TEXT = re.compile(rf"{STRING_LITERAL.pattern}|--[^\n]*|/\*.*?\*/|\$(\w*)\$.*?\$\1\$", re.DOTALL)
+MASKED_TEXT = re.compile(r"\x00(\d+)\x00")
+
+
+def mask_unrouted(query):
+    # The query with its literals and comments masked, and the masked texts
+    masked = []
+
+    def mask(match):
+        masked.append(match.group())
+        return f"\x00{len(masked) - 1}\x00"
+
+    return UNROUTED_TEXT.sub(mask, query), masked
+
+
+def unmask(query, masked):
+    return MASKED_TEXT.sub(lambda match: masked[int(match.group(1))], query)
+
+
+class VerticalRouter:
+
+    def __init__(self, table, key, columns, fragments):
+        # columns in table order, fragments as {name: columns without the key}
+        self.table = table
+        self.key = key
+        self.columns = list(columns)
+        self.fragments = {name: set(fragment_columns) for name, fragment_columns in fragments.items()}
+        self.routes = Counter()
+        not_keyword = "".join(rf"(?!{keyword}\b)" for keyword in sorted(KEYWORDS))
+        self.reference = re.compile(rf"\b(from|join)\s+{table}\b(?:\s+(?:as\s+)?{not_keyword}(\w+))?",
+                                    re.IGNORECASE)
+
+    @classmethod
+    def from_spec(cls, conn, table, spec=FRAGMENTATION_SPEC):
+        # Router over the vertical fragments of table in a fragmentation spec
+        cur = conn.cursor()
+        columns, primary_key = source_layout(cur, table)
+        cur.close()
+        key = primary_key
+        fragments = {}
+        # Fragments on other nodes cannot be joined with a local query
+        for fragment in spec:
+            if fragment["source"] == table and fragment["type"] == "vertical" and "node" not in fragment:
+                key = fragment.get("key", primary_key)
+                fragments[fragment["name"]] = fragment["columns"]
+        return cls(table, key, columns, fragments)
+
+    def fragments_for(self, used):
+        """
+        The fewest fragments holding every column in used, the narrowest
+        first, or None when no combination of fragments does.
+        """
+        names = sorted(self.fragments, key=lambda name: len(self.fragments[name]))
+        if not used:
+            return names[:1]
+        for count in range(1, len(names) + 1):
+            covering = [chosen for chosen in combinations(names, count)
+                        if used <= set().union(*(self.fragments[name] for name in chosen))]
+            if covering:
+                return list(min(covering, key=lambda chosen: sum(len(self.fragments[name]) for name in chosen)))
+        return None
+
+    def relation(self, chosen):
+        if len(chosen) == 1:
+            return chosen[0]
+        # The joined fragments f1, f2, ... with the columns in table order
+        owner = {self.key: "f1"}
+        for i, name in enumerate(chosen, 1):
+            for column in self.fragments[name]:
+                owner.setdefault(column, f"f{i}")
+        select = ", ".join(f"{owner[column]}.{column}" for column in self.columns if column in owner)
+        joins = " ".join(f"JOIN {name} f{i} ON f{i}.{self.key} = f1.{self.key}"
+                         for i, name in enumerate(chosen[1:], 2))
+        return f"(SELECT {select} FROM {chosen[0]} f1 {joins})"
+
+    def rewrite(self, query):
+        """
+        Returns the query to run and its route: "fragment", "join", "table",
+        or None when the query does not use the table.
+        """
+        masked_query, masked = mask_unrouted(query)
+        statement = normalize_statement(masked_query)
+        used = statement_columns(statement, self.table, self.columns)
+        if used is None:
+            return query, None
+        chosen = None
+        if statement.startswith(("select", "with")):
+            chosen = self.fragments_for(used - {self.key})
+        if not chosen:
+            self.routes["table"] += 1
+            return query, "table"
+
+        relation = self.relation(chosen)
+        route = "fragment" if len(chosen) == 1 else "join"
+        self.routes[route] += 1
+        rewritten = self.reference.sub(
+            lambda match: f"{match.group(1)} {relation} AS {match.group(2) or self.table}", masked_query)
+        return unmask(rewritten, masked), route
+
+
+def routing_cursor(router):
+    class RoutingCursor(psycopg2.extensions.cursor):
+        def execute(self, query, vars=None):
+            if isinstance(query, str):
+                query, _ = router.rewrite(query)
+            return super().execute(query, vars)
+
+    return RoutingCursor
+
+
+@contextmanager
+def route_queries(conn, router):
+    # Route the queries of every new cursor of conn, named ones included
+    previous = conn.cursor_factory
+    conn.cursor_factory = routing_cursor(router)
+    try:
+        yield router
+    finally:
+        conn.cursor_factory = previous
+
+
+if __name__ == "__main__":
+    # Offline checks of the rewriting, no database needed
+    router = VerticalRouter("rooms", "room_id",
+                            ["room_id", "floor_id", "room_name", "room_type", "room_size", "occupancy_limit",
+                             "accessibility_features", "room_status"],
+                            {fragment["name"]: fragment["columns"] for fragment in FRAGMENTATION_SPEC
+                             if fragment["source"] == "rooms"})
+
+    query = "SELECT room_id FROM rooms WHERE room_name LIKE '%FROM rooms%';"
+    rewritten, route = router.rewrite(query)
+    assert route == "fragment" and rewritten.endswith("WHERE room_name LIKE '%FROM rooms%';"), rewritten
+
+    for query in ["SELECT 'JOIN rooms' AS label;",
+                  "SELECT 1; -- FROM rooms",
+                  "SELECT /* FROM rooms r */ 1;",
+                  "SELECT $$FROM rooms$$;"]:
+        rewritten, route = router.rewrite(query)
+        assert (rewritten, route) == (query, None), (query, rewritten, route)
+
+    query = "SELECT room_name FROM rooms -- JOIN rooms\nWHERE room_status = 'Available';"
+    rewritten, route = router.rewrite(query)
+    assert rewritten.count("room_frequently_accessed_partition") == 1, rewritten
+    assert "-- JOIN rooms\n" in rewritten and "'Available'" in rewritten, rewritten
+
+    # Columns used only inside a function call or USING still pick the fragment
+    for query in ["SELECT MAX(room_name) FROM rooms;",
+                  "SELECT room_id FROM rooms WHERE lower(room_type) = 'office';",
+                  "SELECT f.floor_number, r.room_id FROM floors f JOIN rooms r USING (floor_id);",
+                  "SELECT COUNT(DISTINCT room_status) FROM rooms;"]:
+        rewritten, route = router.rewrite(query)
+        assert route == "fragment" and "room_frequently_accessed_partition" in rewritten, (query, rewritten)
+
+    rewritten, route = router.rewrite("SELECT COUNT(*) FROM rooms;")
+    assert route == "fragment" and "room_less_frequently_accessed_partition" in rewritten, rewritten
+    rewritten, route = router.rewrite("SELECT r.* FROM rooms r;")
+    assert route == "join", rewritten
+    print("Query router checks passed")
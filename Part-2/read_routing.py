@@ -0,0 +1,151 @@
+"""
+Read routing for the SmartBuilding replica set.
+
+Writes always go to the primary. Sensor and dashboard reads can be routed to
+the secondaries instead through a read preference:
+
+- mode: "secondaryPreferred" reads from a secondary while one is available,
+  "nearest" from any member, "primary" keeps the default
+- max_staleness: secondaries more than this many seconds behind the primary
+  are not read from (at least 90, the smallest value MongoDB accepts)
+- tag_sets: tried in order, the first one matching some member wins, {} matches
+  every member. By default secondaryPreferred prefers the reporting members
+  and nearest reads from any member, see TAG_SETS
+- local_threshold_ms: members whose round trip time is within this window of
+  the fastest eligible member share the reads
+
+member_report lists the state, round trip time, replication lag and tags of
+every member, as seen by the client and by replSetGetStatus.
+"""
+
+import os
+import sys
+import time
+from collections import Counter
+
+from pymongo.read_preferences import Nearest, Primary, SecondaryPreferred
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.db import get_mongo_client
+
+
+REPLICA_SET = "SmartBuilding"
+REPLICA_SET_PORTS = (27017, 27018, 27019)
+REPLICA_SET_URI = (f"mongodb://{','.join(f'localhost:{port}' for port in REPLICA_SET_PORTS)}"
+                   f"/?replicaSet={REPLICA_SET}")
+
+# Member tags set by tag_members, the first member is the preferred primary
+MEMBER_TAGS = {
+    27017: {"node": "rs1", "use": "operational"},
+    27018: {"node": "rs2", "use": "reporting"},
+    27019: {"node": "rs3", "use": "reporting"},
+}
+
+READ_MODES = {"primary": Primary, "secondaryPreferred": SecondaryPreferred, "nearest": Nearest}
+MAX_STALENESS_SECONDS = 90
+# Default tag sets per mode
+TAG_SETS = {
+    "secondaryPreferred": [{"use": "reporting"}, {}],
+    "nearest": [{}],
+}
+LOCAL_THRESHOLD_MS = 15
+
+
+def read_preference(mode="secondaryPreferred", max_staleness=MAX_STALENESS_SECONDS, tag_sets=None):
+    if mode not in READ_MODES:
+        raise ValueError(f"mode must be one of {', '.join(READ_MODES)}")
+    if mode == "primary":
+        return Primary()
+    if max_staleness != -1 and max_staleness < 90:
+        raise ValueError("max_staleness must be at least 90 seconds, or -1 for no limit")
+    if tag_sets is None:
+        tag_sets = TAG_SETS[mode]
+    return READ_MODES[mode](tag_sets=tag_sets, max_staleness=max_staleness)
+
+
+def routed_client(uri=REPLICA_SET_URI, local_threshold_ms=LOCAL_THRESHOLD_MS):
+    return get_mongo_client(uri, localThresholdMS=local_threshold_ms)
+
+
+def routed_database(dbname="smart_building", mode="secondaryPreferred", max_staleness=MAX_STALENESS_SECONDS,
+                    tag_sets=None, local_threshold_ms=LOCAL_THRESHOLD_MS, uri=REPLICA_SET_URI):
+    # The database with its reads routed by the given preference
+    client = routed_client(uri, local_threshold_ms)
+    return client.get_database(dbname, read_preference=read_preference(mode, max_staleness, tag_sets))
+
+
+def tag_members(client, tags=MEMBER_TAGS):
+    """
+    Tag the members of the replica set by port, so that tag sets can select
+    them. Returns False when they already carry these tags.
+    """
+    config = client.admin.command("replSetGetConfig")["config"]
+    changed = False
+    for member in config["members"]:
+        port = int(member["host"].rsplit(":", 1)[1])
+        if port in tags and member.get("tags") != tags[port]:
+            member["tags"] = tags[port]
+            changed = True
+    if changed:
+        config["version"] += 1
+        client.admin.command("replSetReconfig", config)
+    return changed
+
+
+def member_report(client):
+    """
+    One entry per member: its address, state, the average round trip time the
+    client measured, how far its last applied write is behind the primary's
+    and its tags.
+    """
+    status = client.admin.command("replSetGetStatus")
+    config = client.admin.command("replSetGetConfig")["config"]
+    tags = {member["host"]: member.get("tags", {}) for member in config["members"]}
+    primary = max((member["optimeDate"] for member in status["members"] if member["stateStr"] == "PRIMARY"),
+                  default=None)
+    round_trips = {f"{host}:{port}": server.round_trip_time
+                   for (host, port), server in client.topology_description.server_descriptions().items()}
+
+    report = []
+    for member in status["members"]:
+        host = member["name"]
+        round_trip = round_trips.get(host)
+        lag = (primary - member["optimeDate"]).total_seconds() if primary and "optimeDate" in member else None
+        report.append({
+            "member": host,
+            "state": member["stateStr"],
+            "rtt_ms": round_trip * 1000 if round_trip is not None else None,
+            "lag_seconds": lag,
+            "tags": tags.get(host, {}),
+        })
+    return report
+
+
+def print_member_report(client):
+    for member in member_report(client):
+        rtt = f"{member['rtt_ms']:.2f}ms" if member["rtt_ms"] is not None else "unknown"
+        lag = f"{member['lag_seconds']:.0f}s" if member["lag_seconds"] is not None else "unknown"
+        print(f"  {member['member']} {member['state']}: round trip {rtt}, lag {lag}, tags {member['tags']}")
+
+
+def read_distribution(db, collection="sensors", reads=100, query=None):
+    # Members that served each of `reads` finds on the collection, and the average latency
+    served = Counter()
+    t1 = time.monotonic()
+    for _ in range(reads):
+        cursor = db[collection].find(query or {}, limit=1)
+        list(cursor)
+        served[f"{cursor.address[0]}:{cursor.address[1]}"] += 1
+    return served, (time.monotonic() - t1) / reads * 1000
+
+
+if __name__ == "__main__":
+    client = routed_client()
+    if tag_members(client):
+        print("Tagged the replica set members")
+    print("Members of the replica set")
+    print_member_report(client)
+    for mode in READ_MODES:
+        db = routed_database(mode=mode)
+        served, latency = read_distribution(db)
+        print(f"{mode}: {dict(served)}, {latency:.2f}ms per read")
@@ -0,0 +1,188 @@
+"""
+Scatter-gather aggregation over the partitions of a partitioned table.
+
+An aggregation is split into one partial aggregation per leaf partition. The
+partials run at the same time from a pool of connections, each on its own
+backend, and their results are merged by group. Aggregates are given as
+(function, expression) pairs with function one of count, sum, min, max and
+avg, avg being merged from a partial sum and count.
+
+When the groups include the partition key, e.g. room_id on the hash
+partitions of access_logs_by_room, every group is in one partition and the
+partial results are only concatenated. As in SQL, groups come in no order.
+"""
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.db import PSQL_POOL_MAX, psql_connection
+from fragmentation import ACCESS_LOGS_HASH_MODULUS, access_logs_hash_fragment, apply_fragment
+
+
+# Partials run at once, no more than the connections of a pool
+SCATTER_WORKERS = PSQL_POOL_MAX
+
+# function -> the partial aggregates it is merged from
+AGGREGATES = {
+    "count": ["COUNT({})"],
+    "sum": ["SUM({})"],
+    "min": ["MIN({})"],
+    "max": ["MAX({})"],
+    "avg": ["SUM({})", "COUNT({})"],
+}
+
+
+def merge_aggregate(function, partials):
+    # One value from the partial rows of one aggregate of one group
+    if function == "count":
+        return sum(count for (count,) in partials)
+    if function == "avg":
+        count = sum(count for _, count in partials)
+        return sum(total for total, _ in partials if total is not None) / count if count else None
+    values = [value for (value,) in partials if value is not None]
+    if not values:
+        return None
+    return {"sum": sum, "min": min, "max": max}[function](values)
+
+
+def leaf_partitions(cur, table):
+    # Partitions holding the rows of table, at any depth, or the table itself
+    cur.execute("SELECT relid::text FROM pg_partition_tree(%s::regclass) WHERE isleaf ORDER BY 1;", (table,))
+    return [name for (name,) in cur.fetchall()]
+
+
+def partition_key(cur, table):
+    # Columns table is partitioned on, empty when it is not partitioned
+    cur.execute("SELECT pg_get_partkeydef(%s::regclass);", (table,))
+    definition = cur.fetchone()[0]
+    if definition is None:
+        return []
+    return [column.strip() for column in definition[definition.index("(") + 1:definition.rindex(")")].split(",")]
+
+
+def partial_query(partition, aggregates, group_by, where):
+    select = list(group_by)
+    for function, expression in aggregates:
+        if function not in AGGREGATES:
+            raise ValueError(f"{function} cannot be merged from partials, use one of {', '.join(AGGREGATES)}")
+        select += [partial.format(expression) for partial in AGGREGATES[function]]
+    query = f"SELECT {', '.join(select)} FROM {partition}"
+    if where:
+        query += f" WHERE {where}"
+    if group_by:
+        query += f" GROUP BY {', '.join(group_by)}"
+    return query + ";"
+
+
+def merge_partials(results, aggregates, group_by, disjoint=False):
+    # Groups found in one partition only, with no avg to finish, are final
+    if disjoint and all(len(AGGREGATES[function]) == 1 for function, _ in aggregates):
+        return [tuple(row) for rows in results for row in rows]
+
+    # {group: [partial rows of the aggregates]} merged into one row per group
+    groups = {}
+    for rows in results:
+        for row in rows:
+            groups.setdefault(tuple(row[:len(group_by)]), []).append(row[len(group_by):])
+    # An aggregate over no groups still returns one row, as in SQL
+    if not group_by and not groups:
+        groups[()] = []
+
+    merged = []
+    for group, partials in groups.items():
+        values, offset = [], 0
+        for function, _ in aggregates:
+            width = len(AGGREGATES[function])
+            values.append(merge_aggregate(function, [partial[offset:offset + width] for partial in partials]))
+            offset += width
+        merged.append(group + tuple(values))
+    return merged
+
+
+def scatter_gather(table, aggregates, group_by=(), where="", params=None, dbname="smart_building",
+                   target="psql", workers=SCATTER_WORKERS):
+    """
+    Run the aggregates over table, grouped by the group_by columns and
+    filtered by the where clause with params, on every leaf partition at once.
+    Returns one tuple per group: the group values, then the aggregates.
+    """
+    with psql_connection(dbname, target) as conn:
+        cur = conn.cursor()
+        partitions = leaf_partitions(cur, table)
+        key = partition_key(cur, table)
+        cur.close()
+    disjoint = bool(key) and set(key) <= set(group_by)
+
+    def partial(partition):
+        with psql_connection(dbname, target) as conn:
+            cur = conn.cursor()
+            cur.execute(partial_query(partition, aggregates, group_by, where), params)
+            rows = cur.fetchall()
+            cur.close()
+        return rows
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(partitions))) as executor:
+        results = list(executor.map(partial, partitions))
+    return merge_partials(results, aggregates, group_by, disjoint)
+
+
+def denied_access_count(table="access_logs_by_room", **options):
+    return scatter_gather(table, [("count", "*")], where="access_status = 'Denied'", **options)[0][0]
+
+
+def room_access_summary(table="access_logs_by_room", **options):
+    # Per room: accesses, denied accesses, first and last access
+    return scatter_gather(table, [("count", "*"),
+                                  ("count", "CASE WHEN access_status = 'Denied' THEN 1 END"),
+                                  ("min", "timestamp"),
+                                  ("max", "timestamp")],
+                          group_by=["room_id"], **options)
+
+
+def compare_with_single_backend(table="access_logs_by_room", source="access_logs", dbname="smart_building",
+                                target="psql", workers=SCATTER_WORKERS):
+    """
+    Time the per room summary as one query on source, and scatter-gathered
+    over the partitions of table, and check that both agree.
+    """
+    t1 = time.time()
+    with psql_connection(dbname, target) as conn:
+        cur = conn.cursor()
+        cur.execute(f"""
+            SELECT room_id, COUNT(*), COUNT(CASE WHEN access_status = 'Denied' THEN 1 END),
+                   MIN(timestamp), MAX(timestamp)
+            FROM {source} GROUP BY room_id;
+        """)
+        single = cur.fetchall()
+        cur.close()
+    t2 = time.time()
+    single.sort(key=lambda row: (row[0] is None, row[0]))
+    gathered = room_access_summary(table, dbname=dbname, target=target, workers=workers)
+    t3 = time.time()
+    gathered.sort(key=lambda row: (row[0] is None, row[0]))
+    print(f"Per room summary of {len(single)} rooms: {t2 - t1:.2f}s on {source}, "
+          f"{t3 - t2:.2f}s scatter-gathered over {table} with {workers} workers, "
+          f"results {'match' if single == gathered else 'DIFFER'}")
+    return {"single_seconds": t2 - t1, "scatter_gather_seconds": t3 - t2, "match": single == gathered}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scatter-gather aggregation over hash partitioned access logs")
+    parser.add_argument("--dbname", default="smart_building")
+    parser.add_argument("--target", default="psql")
+    parser.add_argument("--modulus", type=int, default=ACCESS_LOGS_HASH_MODULUS,
+                        help="hash partitions of access_logs_by_room, it is rebuilt when this changes")
+    parser.add_argument("--workers", type=int, default=SCATTER_WORKERS)
+    args = parser.parse_args()
+
+    fragment = access_logs_hash_fragment(args.modulus)
+    result = apply_fragment(fragment, args.dbname, args.target)
+    print(f"Fragment {fragment['name']} with {args.modulus} hash partitions: {result['status']}, "
+          f"{result['rows']} rows verified")
+    print("Denied accesses: ", denied_access_count(fragment["name"], dbname=args.dbname, target=args.target,
+                                                    workers=args.workers))
+    compare_with_single_backend(fragment["name"], dbname=args.dbname, target=args.target, workers=args.workers)
@@ -0,0 +1,15 @@
+#!/bin/bash
+
+# This script is used to setup a local sharded mongoDB cluster: a config server
+# replica set, two shard replica sets and a mongos on port 27040
+
+# Start every process with an empty data directory under ./cluster. Then load
+# the data through mongos, Part-1 shards sensor_data and device_controls when
+# it creates them:
+#   MONGO_URI=mongodb://localhost:27040/ python ../Part-1/main.py
+# Collections loaded some other way are sharded after the load with
+#   python sharded_cluster.py shard
+# Add a shard later with
+#   python sharded_cluster.py add-shard --number 3
+cd "$(dirname "$0")"
+python sharded_cluster.py start --fresh --shards 2
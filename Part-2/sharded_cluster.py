@@ -0,0 +1,195 @@
+"""
+A local sharded MongoDB cluster for the Smart-Building collections.
+
+Everything runs on localhost:
+
+- a config server replica set on CONFIG_PORTS
+- shard replica sets shard1, shard2, ... of SHARD_MEMBERS members each, shard
+  N on the ports from SHARD_BASE_PORT + 10 * (N - 1)
+- a mongos router on MONGOS_PORT, which applications connect to
+
+Processes are started through node_control, with their data, logs and PID
+files under ./cluster. The collections are sharded on the keys of
+common.sharding, by Part-1 when it creates them through mongos, or by the
+shard command for collections loaded otherwise. add_shard starts one more
+shard and adds it, and the balancer then moves chunks to it.
+"""
+
+import argparse
+import os
+import random
+import signal
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.db import get_mongo_client
+from common.sensor_data import is_timeseries, to_timeseries_document
+from common.sharding import SHARD_KEYS, shard_collections
+from node_control import BASE_DIR, initiate_replica_set, signal_process, start_process, wait_until_healthy
+
+
+CLUSTER_DIR = os.path.join(BASE_DIR, "cluster")
+CONFIG_REPLICA_SET = "SmartBuildingConfig"
+CONFIG_PORTS = (27100, 27101, 27102)
+SHARD_BASE_PORT = 27110
+SHARD_COUNT = 2
+SHARD_MEMBERS = 3
+MONGOS_PORT = 27040
+CLUSTER_URI = f"mongodb://localhost:{MONGOS_PORT}/"
+
+
+def shard_ports(number, members=SHARD_MEMBERS):
+    return tuple(SHARD_BASE_PORT + 10 * (number - 1) + i for i in range(members))
+
+
+def replica_set_uri(name, ports):
+    return f"mongodb://{','.join(f'localhost:{port}' for port in ports)}/?replicaSet={name}"
+
+
+def start_replica_set(name, ports, role, fresh=False):
+    # Start and initiate a config server or shard replica set, wait for its primary
+    for port in ports:
+        directory = os.path.join(CLUSTER_DIR, f"{name}-{port}")
+        start_process(port, directory, [role, "--replSet", name, "--dbpath", directory],
+                      os.path.join(directory, "mongod.log"), fresh=fresh)
+    initiate_replica_set(ports, name, configsvr=role == "--configsvr")
+    wait_until_healthy(get_mongo_client(replica_set_uri(name, ports)))
+
+
+def start_mongos(fresh=False):
+    directory = os.path.join(CLUSTER_DIR, f"mongos-{MONGOS_PORT}")
+    config_db = f"{CONFIG_REPLICA_SET}/{','.join(f'localhost:{port}' for port in CONFIG_PORTS)}"
+    return start_process(MONGOS_PORT, directory, ["--configdb", config_db],
+                         os.path.join(directory, "mongos.log"), binary="mongos", fresh=fresh)
+
+
+def cluster_shards(client):
+    return {shard["_id"]: shard["host"] for shard in client.admin.command("listShards")["shards"]}
+
+
+def add_shard(number, members=SHARD_MEMBERS, fresh=False):
+    """
+    Start shard replica set number and add it to the cluster, unless it is
+    part of it already. Returns the shard name.
+    """
+    name = f"shard{number}"
+    ports = shard_ports(number, members)
+    start_replica_set(name, ports, "--shardsvr", fresh)
+    client = get_mongo_client(CLUSTER_URI)
+    if name not in cluster_shards(client):
+        client.admin.command("addShard", f"{name}/{','.join(f'localhost:{port}' for port in ports)}", name=name)
+    return name
+
+
+def start_cluster(shards=SHARD_COUNT, members=SHARD_MEMBERS, fresh=False):
+    start_replica_set(CONFIG_REPLICA_SET, CONFIG_PORTS, "--configsvr", fresh)
+    start_mongos(fresh)
+    for number in range(1, shards + 1):
+        add_shard(number, members, fresh)
+    return get_mongo_client(CLUSTER_URI)
+
+
+def stop_cluster(shards=SHARD_COUNT, members=SHARD_MEMBERS):
+    # mongos first, then the shards and the config servers
+    signal_process(MONGOS_PORT, os.path.join(CLUSTER_DIR, f"mongos-{MONGOS_PORT}"), signal.SIGTERM, "mongos")
+    replica_sets = [(f"shard{number}", shard_ports(number, members)) for number in range(1, shards + 1)]
+    for name, ports in replica_sets + [(CONFIG_REPLICA_SET, CONFIG_PORTS)]:
+        for port in ports:
+            signal_process(port, os.path.join(CLUSTER_DIR, f"{name}-{port}"), signal.SIGTERM)
+
+
+def chunk_balance(client, dbname="smart_building", collection="sensor_data"):
+    """
+    shard -> chunks and documents of the collection on it, with the ratio of
+    the largest to the smallest document count over the shards holding any.
+    """
+    config = client["config"]
+    names = [f"{dbname}.{collection}", f"{dbname}.system.buckets.{collection}"]
+    entry = config["collections"].find_one({"_id": {"$in": names}, "dropped": {"$ne": True}})
+    if entry is None:
+        raise ValueError(f"{dbname}.{collection} is not sharded")
+    # Chunks refer to their collection by uuid since MongoDB 5.0, by namespace before
+    chunks = config["chunks"].aggregate([
+        {"$match": {"uuid": entry["uuid"]} if "timestamp" in entry else {"ns": entry["_id"]}},
+        {"$group": {"_id": "$shard", "chunks": {"$sum": 1}}},
+    ])
+    balance = {shard: {"chunks": 0, "documents": 0} for shard in cluster_shards(client)}
+    for row in chunks:
+        balance[row["_id"]]["chunks"] = row["chunks"]
+    for row in client[dbname][collection].aggregate([{"$collStats": {"count": {}}}]):
+        balance[row["shard"]]["documents"] = row["count"]
+
+    counts = [shard["documents"] for shard in balance.values() if shard["documents"]]
+    skew = max(counts) / min(counts) if counts else None
+    return balance, skew
+
+
+def print_chunk_balance(client, dbname="smart_building", collections=SHARD_KEYS):
+    for collection in collections:
+        balance, skew = chunk_balance(client, dbname, collection)
+        print(f"{collection}: " + ", ".join(f"{shard} {counts['chunks']} chunks / {counts['documents']} documents"
+                                           for shard, counts in sorted(balance.items()))
+              + (f", largest/smallest shard {skew:.2f}" if skew else ""))
+
+
+def write_throughput(client, dbname="smart_building", documents=200000, sensors=10000, batch_size=1000,
+                     writers=8):
+    """
+    Insert synthetic sensor readings through mongos from `writers` threads and
+    return the documents written per second.
+    """
+    collection = client[dbname]["sensor_data"]
+    timeseries = is_timeseries(client[dbname])
+    start = datetime(2024, 1, 1)
+
+    def batch(count):
+        documents = []
+        for _ in range(count):
+            reading = {"sensor_id": random.randint(1, sensors), "data_type": "Temperature",
+                       "timestamp": (start + timedelta(seconds=random.randrange(365 * 86400))).isoformat(),
+                       "data_value": random.uniform(15, 30)}
+            documents.append(to_timeseries_document(reading) if timeseries else reading)
+        collection.insert_many(documents, ordered=False)
+        return count
+
+    sizes = [min(batch_size, documents - offset) for offset in range(0, documents, batch_size)]
+    t1 = time.time()
+    with ThreadPoolExecutor(max_workers=writers) as executor:
+        written = sum(executor.map(batch, sizes))
+    return written / (time.time() - t1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local sharded cluster for the Smart-Building collections")
+    parser.add_argument("command", choices=["start", "stop", "add-shard", "shard", "balance", "throughput"])
+    parser.add_argument("--shards", type=int, default=SHARD_COUNT, help="shards to start or stop")
+    parser.add_argument("--number", type=int, default=SHARD_COUNT + 1, help="number of the shard to add")
+    parser.add_argument("--members", type=int, default=SHARD_MEMBERS, help="members of every shard replica set")
+    parser.add_argument("--fresh", action="store_true", help="start with empty data directories")
+    parser.add_argument("--dbname", default="smart_building")
+    parser.add_argument("--documents", type=int, default=200000, help="readings written by throughput")
+    args = parser.parse_args()
+
+    if args.command == "start":
+        client = start_cluster(args.shards, args.members, args.fresh)
+        print(f"Cluster running, connect to {CLUSTER_URI}. Shards: {', '.join(cluster_shards(client))}")
+        print(f"Load it with MONGO_URI={CLUSTER_URI} python Part-1/main.py, which shards the collections")
+    elif args.command == "stop":
+        stop_cluster(args.shards, args.members)
+    elif args.command == "add-shard":
+        print(f"Added {add_shard(args.number, args.members, args.fresh)}")
+    elif args.command == "shard":
+        # Collections loaded without Part-1 are sharded after the load
+        shard_collections(get_mongo_client(CLUSTER_URI), args.dbname)
+    elif args.command == "balance":
+        print_chunk_balance(get_mongo_client(CLUSTER_URI), args.dbname)
+    else:
+        client = get_mongo_client(CLUSTER_URI)
+        # Sharded already when Part-1 created the collections
+        shard_collections(client, args.dbname)
+        rate = write_throughput(client, args.dbname, args.documents)
+        print(f"{rate:.0f} readings/s over {len(cluster_shards(client))} shards")
+        print_chunk_balance(client, args.dbname, ["sensor_data"])
@@ -0,0 +1,214 @@
+"""
+Query benchmarks for the Smart-Building database.
+
+Every registered query is run
+
+- with EXPLAIN (ANALYZE, BUFFERS), for the server side execution and planning
+  time, the shared buffer hits and reads and the chosen plan
+- as plain execution, timed on the client including fetching every row
+
+in two variants. "warm" runs the query a few times first and then repeats it
+on one connection. "cold" runs every repetition on a new connection, so no
+plan or catalog cache of a backend is reused, after running
+PG_COLD_CACHE_COMMAND when it is set, e.g. a command that restarts PostgreSQL
+and drops the OS page cache. Without it shared buffers stay warm.
+
+Results are written as JSON, and compare_results shows how the p50 of every
+query changed between two runs, e.g. before and after creating indexes.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+import psycopg2
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.db import PSQL_TARGETS, psql_connection
+
+
+WARMUP_RUNS = 3
+REPETITIONS = 20
+PERCENTILES = (50, 95, 99)
+VARIANTS = ("warm", "cold")
+# Shell command run before every cold repetition, e.g. to restart the server
+PG_COLD_CACHE_COMMAND = os.environ.get("PG_COLD_CACHE_COMMAND")
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+QUERIES = {}
+
+
+def register_query(name, query, params=None):
+    QUERIES[name] = {"query": query, "params": params}
+
+
+register_query("buildings_with_busy_floors", """
+    SELECT DISTINCT b.building_id, b.building_name
+    FROM buildings b
+    JOIN floors f ON b.building_id = f.building_id
+    JOIN rooms r ON f.floor_id = r.floor_id
+    GROUP BY b.building_id, b.building_name
+    HAVING COUNT(DISTINCT f.floor_id) > 0 AND COUNT(DISTINCT r.room_id) > 4;
+""")
+register_query("rooms_of_floor", "SELECT room_id, room_name, room_type FROM rooms WHERE floor_id = %s;", (1,))
+register_query("floors_of_building", "SELECT floor_id, floor_number FROM floors WHERE building_id = %s;", (1,))
+register_query("room_by_id", "SELECT * FROM rooms WHERE room_id = %s;", (1,))
+
+
+def plan_summary(plan):
+    # Node types of the plan, depth first, with the relation and index they use
+    node = plan["Node Type"]
+    if "Index Name" in plan:
+        node += f" using {plan['Index Name']}"
+    if "Relation Name" in plan:
+        node += f" on {plan['Relation Name']}"
+    children = [plan_summary(child) for child in plan.get("Plans", [])]
+    return f"{node} ({', '.join(children)})" if children else node
+
+
+def plan_indexes(plan):
+    indexes = {plan["Index Name"]} if "Index Name" in plan else set()
+    for child in plan.get("Plans", []):
+        indexes |= plan_indexes(child)
+    return indexes
+
+
+def explain_analyze(cur, query, params):
+    cur.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query}", params)
+    explained = cur.fetchone()[0][0]
+    plan = explained["Plan"]
+    return {
+        "execution_ms": explained["Execution Time"],
+        "planning_ms": explained["Planning Time"],
+        "shared_hit_blocks": plan.get("Shared Hit Blocks", 0),
+        "shared_read_blocks": plan.get("Shared Read Blocks", 0),
+        "plan": plan_summary(plan),
+        "indexes": sorted(plan_indexes(plan)),
+    }
+
+
+def execute(cur, query, params):
+    t1 = time.perf_counter()
+    cur.execute(query, params)
+    cur.fetchall()
+    return (time.perf_counter() - t1) * 1000
+
+
+def cold_connection(dbname, target):
+    if PG_COLD_CACHE_COMMAND:
+        subprocess.run(PG_COLD_CACHE_COMMAND, shell=True, check=True)
+    # A new backend, not one from the pool
+    return psycopg2.connect(dbname=dbname, **PSQL_TARGETS[target])
+
+
+def summarize(samples):
+    summary = {}
+    for metric in ("execution_ms", "planning_ms", "plain_ms", "shared_hit_blocks", "shared_read_blocks"):
+        values = [sample[metric] for sample in samples]
+        summary[metric] = {f"p{p}": float(np.percentile(values, p)) for p in PERCENTILES}
+    plans = {}
+    for sample in samples:
+        plans[sample["plan"]] = plans.get(sample["plan"], 0) + 1
+    summary["plans"] = plans
+    summary["indexes"] = sorted({index for sample in samples for index in sample["indexes"]})
+    return summary
+
+
+def benchmark_query(name, dbname="smart_building", target="psql", variant="warm", repetitions=REPETITIONS,
+                    warmup=WARMUP_RUNS):
+    """
+    Repeat one registered query in a variant and summarize its samples:
+    percentiles of the execution, planning and plain times and of the buffer
+    hits and reads, the plans chosen and the indexes they use.
+    """
+    query, params = QUERIES[name]["query"], QUERIES[name]["params"]
+    samples = []
+    if variant == "warm":
+        with psql_connection(dbname, target) as conn:
+            cur = conn.cursor()
+            for _ in range(warmup):
+                execute(cur, query, params)
+            for _ in range(repetitions):
+                sample = explain_analyze(cur, query, params)
+                sample["plain_ms"] = execute(cur, query, params)
+                samples.append(sample)
+            cur.close()
+    else:
+        for _ in range(repetitions):
+            # The plain run gets a cold backend of its own too
+            conn = cold_connection(dbname, target)
+            cur = conn.cursor()
+            sample = explain_analyze(cur, query, params)
+            conn.close()
+            conn = cold_connection(dbname, target)
+            cur = conn.cursor()
+            sample["plain_ms"] = execute(cur, query, params)
+            conn.close()
+            samples.append(sample)
+    return summarize(samples)
+
+
+def run_benchmarks(label, names=None, dbname="smart_building", target="psql", variants=VARIANTS,
+                   repetitions=REPETITIONS, warmup=WARMUP_RUNS, results_dir=RESULTS_DIR, verbose=True):
+    """
+    Benchmark the queries (every registered one by default) in every variant
+    and write the results to results_dir/<label>.json. Returns the results.
+    """
+    results = {"label": label, "at": datetime.now().isoformat(timespec="seconds"), "repetitions": repetitions,
+               "cold_cache_command": PG_COLD_CACHE_COMMAND, "queries": {}}
+    for name in names or QUERIES:
+        results["queries"][name] = {}
+        for variant in variants:
+            summary = benchmark_query(name, dbname, target, variant, repetitions, warmup)
+            results["queries"][name][variant] = summary
+            if verbose:
+                print(f"{label} {name} ({variant}): "
+                      f"execution p50 {summary['execution_ms']['p50']:.2f}ms p95 {summary['execution_ms']['p95']:.2f}ms "
+                      f"p99 {summary['execution_ms']['p99']:.2f}ms, plain p50 {summary['plain_ms']['p50']:.2f}ms, "
+                      f"buffers hit {summary['shared_hit_blocks']['p50']:.0f} read {summary['shared_read_blocks']['p50']:.0f}, "
+                      f"indexes {', '.join(summary['indexes']) or 'none'}")
+
+    os.makedirs(results_dir, exist_ok=True)
+    with open(os.path.join(results_dir, f"{label}.json"), "w") as file:
+        json.dump(results, file, indent=2)
+    return results
+
+
+def compare_results(before, after):
+    # p50 execution time of every query and variant, before and after
+    for name, variants in after["queries"].items():
+        for variant, summary in variants.items():
+            if variant not in before["queries"].get(name, {}):
+                continue
+            old = before["queries"][name][variant]["execution_ms"]["p50"]
+            new = summary["execution_ms"]["p50"]
+            change = (new - old) / old * 100 if old else 0.0
+            print(f"{name} ({variant}): {old:.2f}ms -> {new:.2f}ms ({change:+.0f}%), "
+                  f"indexes {', '.join(summary['indexes']) or 'none'}")
+
+
+def load_results(label, results_dir=RESULTS_DIR):
+    with open(os.path.join(results_dir, f"{label}.json")) as file:
+        return json.load(file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the registered queries")
+    parser.add_argument("label", help="name of the results file, e.g. before or after")
+    parser.add_argument("--dbname", default="smart_building")
+    parser.add_argument("--queries", nargs="+", choices=list(QUERIES), help="defaults to every query")
+    parser.add_argument("--variants", nargs="+", choices=VARIANTS, default=list(VARIANTS))
+    parser.add_argument("--repetitions", type=int, default=REPETITIONS)
+    parser.add_argument("--warmup", type=int, default=WARMUP_RUNS)
+    parser.add_argument("--compare", metavar="LABEL", help="compare with the results of an earlier label")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.label, args.queries, args.dbname, variants=args.variants,
+                             repetitions=args.repetitions, warmup=args.warmup)
+    if args.compare:
+        compare_results(load_results(args.compare), results)
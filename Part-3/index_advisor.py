@@ -0,0 +1,652 @@
+"""
+Workload-based index advice for the Smart-Building database.
+
+The workload is a count of statements as executed: read from
+pg_stat_statements, from a file of ;-separated statements, or recorded with
+common.workload.record_workload(conn, WorkloadRecorder(normalize=False)).
+Every statement is planned with EXPLAIN, with GENERIC_PLAN for the $n
+parameters of pg_stat_statements (PostgreSQL 16 and later), and its plan is
+reduced to the columns each table is compared on by equality, by a range, or
+sorted and grouped on. Candidates are generated from those columns:
+
+- single column indexes on each of them
+- composite indexes on the equality columns, most distinct values first,
+  followed by a range or sort column
+- covering indexes, a composite one with the other columns the statement
+  reads as INCLUDE columns, for index only scans
+- partial indexes for equality with a constant on a column with few values,
+  e.g. WHERE access_status = 'Denied'
+
+Candidates are costed with HypoPG hypothetical indexes when the extension is
+available, otherwise by building them on copies of the tables in
+SCRATCH_SCHEMA, which comes first on the search path while the advisor runs.
+Neither touches the tables themselves. Statements that name public.<table>
+are planned against the real tables and gain nothing from the copies.
+
+Indexes are picked greedily, the largest net benefit first: the planner cost
+the index saves the workload, weighted by calls, less the cost of keeping it
+up to date for the workload's inserts, deletes and updates of its columns, a
+row per call. Picking stops when no candidate saves anything within the
+storage budget (MB of new indexes) and the write budget (maintenance as a
+fraction of the workload cost). Existing indexes that repeat another, are the
+leading columns of another, lead with a unique key without being used, or
+were never used at all are listed to be dropped.
+"""
+
+import argparse
+import os
+import re
+import sys
+
+import psycopg2
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.db import psql_connection
+from common.workload import (STRING_LITERAL, normalize_statement, statement_columns, workload_from_file,
+                             workload_from_pg_stat_statements)
+
+
+SCRATCH_SCHEMA = "index_advisor_scratch"
+COSTING = ("auto", "hypothetical", "scratch")
+STORAGE_BUDGET_MB = 256
+# Maintenance cost of the new indexes as a fraction of the workload cost
+WRITE_BUDGET = 0.1
+MAX_INDEXES = 10
+MAX_KEY_COLUMNS = 3
+MAX_INCLUDE_COLUMNS = 3
+# Equality with a constant on a column with at most this many values gives a partial index
+PARTIAL_MAX_VALUES = 20
+# Random pages per index and written row: its leaf page read and written back
+INDEX_WRITE_PAGES = 2
+
+PLANNABLE = re.compile(r"^\s*(select|with|insert|update|delete)\b", re.IGNORECASE)
+WRITE = re.compile(r"^\s*(insert\s+into|update|delete\s+from)\s+(?:only\s+)?(\w+)", re.IGNORECASE)
+UPDATE_SET = re.compile(r"\bset\s+(.*?)(?:\s+from\s|\s+where\s|\s+returning\s|$)", re.IGNORECASE)
+# Casts as EXPLAIN prints them, e.g. ::text, ::character varying(255), ::timestamp without time zone
+CAST = re.compile(r"::\"?\w+\"?(?: (?:without|with) time zone| varying| precision)?(?:\(\d+(?:,\d+)?\))?(?:\[\])?")
+COLUMN = re.compile(r"^\(*(?:(\w+)\.)?([A-Za-z_]\w*)\)*$")
+CONSTANT = re.compile(r"^\(*('(?:[^']|'')*'|-?\d+(?:\.\d+)?)\)*$")
+COMPARISON = re.compile(r"\s(=|<=|>=|<|>)\s(ANY\s)?")
+ORDERING_SUFFIX = re.compile(r"\s+(?:ASC|DESC|NULLS FIRST|NULLS LAST|USING \S+)")
+CONDITIONS = ("Index Cond", "Recheck Cond", "Filter", "Hash Cond", "Merge Cond", "Join Filter")
+ORDERINGS = ("Sort Key", "Group Key", "Presorted Key")
+
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+def explain(cur, statement):
+    # The plan of statement, or None when it cannot be planned here
+    options = "VERBOSE, FORMAT JSON" + (", GENERIC_PLAN" if re.search(r"\$\d+", statement) else "")
+    try:
+        cur.execute(f"EXPLAIN ({options}) {statement}")
+    except psycopg2.Error:
+        return None
+    return cur.fetchone()[0][0]["Plan"]
+
+
+def statement_cost(cur, statement):
+    plan = explain(cur, statement)
+    return plan["Total Cost"] if plan else None
+
+
+def closing_parenthesis(expression):
+    # Position of the parenthesis closing the one expression starts with
+    depth, quoted = 0, False
+    for i, char in enumerate(expression):
+        if char == "'":
+            quoted = not quoted
+        elif not quoted and char == "(":
+            depth += 1
+        elif not quoted and char == ")":
+            depth -= 1
+            if depth == 0:
+                return i
+    return None
+
+
+def unwrap(expression):
+    # Without the parentheses around the whole expression
+    expression = expression.strip()
+    while expression.startswith("(") and closing_parenthesis(expression) == len(expression) - 1:
+        expression = expression[1:-1].strip()
+    return expression
+
+
+def split_top_level(expression, separator):
+    # Parts of expression between separators outside parentheses and literals
+    parts, depth, quoted, start, i = [], 0, False, 0, 0
+    while i < len(expression):
+        char = expression[i]
+        if char == "'":
+            quoted = not quoted
+        elif not quoted and char in "()":
+            depth += 1 if char == "(" else -1
+        elif not quoted and depth == 0 and expression.startswith(separator, i):
+            parts.append(expression[start:i])
+            start = i = i + len(separator)
+            continue
+        i += 1
+    parts.append(expression[start:])
+    return parts
+
+
+def clean_expression(expression):
+    return unwrap(CAST.sub("", expression).replace('"', ""))
+
+
+def conjuncts(condition):
+    return [unwrap(part) for part in split_top_level(clean_expression(condition), " AND ")]
+
+
+def compared_columns(conjunct, default_alias):
+    """
+    (alias, column, kind, constant) for each side of a comparison that is a
+    plain column and is not compared with a column of the same alias. kind is
+    "equality" or "range", constant the literal it is equal to, if any.
+    """
+    if len(split_top_level(conjunct, " OR ")) > 1:
+        return []
+    match = COMPARISON.search(conjunct)
+    if match is None:
+        return []
+    lhs, rhs = unwrap(conjunct[:match.start()]), unwrap(conjunct[match.end():])
+    kind = "equality" if match.group(1) == "=" else "range"
+
+    compared = []
+    for side, other in ((lhs, rhs), (rhs, lhs)):
+        column = COLUMN.match(side)
+        if column is None or (column.group(1) or default_alias) is None:
+            continue
+        alias = column.group(1) or default_alias
+        other_column = COLUMN.match(other)
+        if other_column and (other_column.group(1) or default_alias) == alias:
+            continue
+        constant = CONSTANT.match(other)
+        compared.append((alias, column.group(2), kind,
+                         constant.group(1) if constant and kind == "equality" and not match.group(2) else None))
+    return compared
+
+
+def plan_usage(plan, table_columns):
+    """
+    alias -> the table and its columns the plan of one statement compares by
+    equality ("equality") or by a range ("range"), or sorts or groups on
+    ("order"), with the constants its columns are equal to. Only tables in
+    table_columns are included.
+    """
+    nodes = list(plan_nodes(plan))
+    usage = {}
+    for node in nodes:
+        if node.get("Relation Name") in table_columns and node.get("Alias") not in usage:
+            usage[node["Alias"]] = {"table": node["Relation Name"], "equality": [], "range": [], "order": [],
+                                    "constants": {}}
+    only = next(iter(usage)) if len(usage) == 1 else None
+
+    def add(alias, column, kind):
+        use = usage.get(alias)
+        if use is None or column not in table_columns[use["table"]]:
+            return False
+        if column not in use[kind]:
+            use[kind].append(column)
+        return True
+
+    for node in nodes:
+        default = node.get("Alias", only)
+        for key in CONDITIONS:
+            if key not in node:
+                continue
+            for conjunct in conjuncts(node[key]):
+                for alias, column, kind, constant in compared_columns(conjunct, default):
+                    if add(alias, column, kind) and constant is not None:
+                        usage[alias]["constants"].setdefault(column, constant)
+        for key in ORDERINGS:
+            for expression in node.get(key, []):
+                column = COLUMN.match(ORDERING_SUFFIX.sub("", clean_expression(expression)))
+                if column:
+                    add(column.group(1) or default, column.group(2), "order")
+    return usage
+
+
+def table_columns(cur, tables):
+    # table -> columns of the plain public tables among tables, partitioned ones and partitions left out
+    cur.execute("""
+        SELECT c.relname, a.attname
+        FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+        WHERE n.nspname = 'public' AND c.relkind = 'r' AND NOT c.relispartition AND c.relname = ANY(%s)
+        ORDER BY c.relname, a.attnum;
+    """, (list(tables),))
+    columns = {}
+    for table, column in cur.fetchall():
+        columns.setdefault(table, []).append(column)
+    return columns
+
+
+def distinct_values(cur, table):
+    # column -> estimated distinct values, from the planner statistics
+    cur.execute("""
+        SELECT s.attname, CASE WHEN s.n_distinct < 0 THEN -s.n_distinct * c.reltuples ELSE s.n_distinct END
+        FROM pg_stats s
+        JOIN pg_namespace n ON n.nspname = s.schemaname
+        JOIN pg_class c ON c.relnamespace = n.oid AND c.relname = s.tablename
+        WHERE s.schemaname = 'public' AND s.tablename = %s;
+    """, (table,))
+    return dict(cur.fetchall())
+
+
+def existing_indexes(cur, tables):
+    cur.execute("""
+        SELECT ic.relname, c.relname, i.indisunique, i.indisprimary, i.indnkeyatts,
+               ARRAY(SELECT a.attname FROM unnest(i.indkey::int2[]) WITH ORDINALITY AS k(attnum, n)
+                     JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum ORDER BY k.n),
+               pg_get_expr(i.indpred, i.indrelid), i.indexprs IS NOT NULL, am.amname,
+               EXISTS (SELECT 1 FROM pg_constraint WHERE conindid = i.indexrelid),
+               pg_relation_size(i.indexrelid), COALESCE(s.idx_scan, 0), pg_get_indexdef(i.indexrelid)
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        JOIN pg_class ic ON ic.oid = i.indexrelid
+        JOIN pg_am am ON am.oid = ic.relam
+        LEFT JOIN pg_stat_user_indexes s ON s.indexrelid = i.indexrelid
+        WHERE n.nspname = 'public' AND c.relname = ANY(%s)
+        ORDER BY c.relname, ic.relname;
+    """, (list(tables),))
+    indexes = []
+    for (name, table, unique, primary, key_columns, columns, where, expressions, method, constraint, size,
+         scans, definition) in cur.fetchall():
+        indexes.append({
+            "name": name, "table": table, "unique": unique, "primary": primary,
+            "columns": columns[:key_columns], "include": columns[key_columns:],
+            "where": clean_expression(where) if where else None, "expressions": expressions, "method": method,
+            "constraint": constraint, "size": size, "scans": scans, "definition": definition,
+        })
+    return indexes
+
+
+def reserved_keywords(cur):
+    # Keywords that cannot name a column of an index without quotes
+    cur.execute("SELECT word FROM pg_get_keywords() WHERE catcode IN ('R', 'T');")
+    return {word for word, in cur.fetchall()}
+
+
+def quoted(name, reserved):
+    if re.fullmatch(r"[a-z_][a-z0-9_$]*", name) and name not in reserved:
+        return name
+    return '"' + name.replace('"', '""') + '"'
+
+
+def index_name(candidate):
+    table, columns, include, where = candidate
+    parts = [table, *columns]
+    if include:
+        parts.append("covering")
+    if where:
+        parts.append(re.sub(r"\W+", "_", where).strip("_").lower())
+    return "_".join(parts)[:59] + "_idx"
+
+
+def index_ddl(name, table, candidate, reserved):
+    _, columns, include, where = candidate
+    ddl = f"CREATE INDEX {name} ON {table} ({', '.join(quoted(column, reserved) for column in columns)})"
+    if include:
+        ddl += f" INCLUDE ({', '.join(quoted(column, reserved) for column in include)})"
+    if where:
+        column, rest = where.split(" ", 1)
+        ddl += f" WHERE {quoted(column, reserved)} {rest}"
+    return ddl + ";"
+
+
+def use_candidates(use, used_columns, distinct, primary_key):
+    """
+    Candidates (table, key columns, include columns, predicate) for one use of
+    a table by a statement, as described in the module docstring.
+    """
+    table = use["table"]
+    candidates = {(table, (column,), (), None) for column in use["equality"] + use["range"] + use["order"]}
+    selective = sorted(use["equality"], key=lambda column: -distinct.get(column, 0))
+    if use["range"]:
+        key = selective[:MAX_KEY_COLUMNS - 1] + use["range"][:1]
+    else:
+        key = (selective + [column for column in use["order"] if column not in selective])[:MAX_KEY_COLUMNS]
+
+    def add(key, where=None, where_column=None):
+        if not key:
+            return
+        candidates.add((table, tuple(key), (), where))
+        include = [column for column in used_columns or () if column not in key and column != where_column]
+        if used_columns is not None and 0 < len(include) <= MAX_INCLUDE_COLUMNS:
+            candidates.add((table, tuple(key), tuple(include), where))
+
+    add(key)
+    for column, constant in use["constants"].items():
+        if 0 < distinct.get(column, 0) <= PARTIAL_MAX_VALUES:
+            rest = [other for other in key if other != column] or use["order"][:1] or primary_key[:1]
+            add(rest, f"{column} = {constant}", column)
+    return candidates
+
+
+def served_by(candidate, indexes):
+    # Name of an existing index with the candidate's columns as its leading ones
+    table, columns, include, where = candidate
+    for index in indexes:
+        if (index["table"] == table and index["method"] == "btree" and not index["expressions"]
+                and index["where"] == where and tuple(index["columns"][:len(columns)]) == columns
+                and set(include) <= set(index["columns"] + index["include"])):
+            return index["name"]
+    return None
+
+
+def workload_writes(statements):
+    # table -> [(columns written, calls)], None for inserts and deletes, which write every column
+    writes = {}
+    for statement, calls in statements.items():
+        match = WRITE.match(statement)
+        if match is None:
+            continue
+        written = None
+        if match.group(1).lower() == "update":
+            set_clause = UPDATE_SET.search(STRING_LITERAL.sub("?", statement))
+            if set_clause:
+                written = {column.lower() for column in re.findall(r"(\w+)\s*=", set_clause.group(1))}
+        writes.setdefault(match.group(2).lower(), []).append((written, calls))
+    return writes
+
+
+def maintained_rows(candidate, writes):
+    # Written rows that change the index, updates of other columns can be HOT and skip it
+    table, columns, include, where = candidate
+    indexed = set(columns) | set(include) | ({where.split(" ", 1)[0]} if where else set())
+    return sum(calls for written, calls in writes.get(table, []) if written is None or written & indexed)
+
+
+class HypotheticalIndexes:
+    # Candidates as HypoPG hypothetical indexes, which only EXPLAIN in this session sees
+    name = "hypothetical"
+
+    def __init__(self, cur, reserved):
+        self.cur = cur
+        self.reserved = reserved
+        cur.execute("CREATE EXTENSION IF NOT EXISTS hypopg;")
+
+    def create(self, candidate):
+        ddl = index_ddl("", candidate[0], candidate, self.reserved).replace("CREATE INDEX  ON", "CREATE INDEX ON")
+        self.cur.execute("SELECT indexrelid FROM hypopg_create_index(%s);", (ddl,))
+        return self.cur.fetchone()[0]
+
+    def size(self, index):
+        self.cur.execute("SELECT hypopg_relation_size(%s);", (index,))
+        return self.cur.fetchone()[0]
+
+    def drop(self, index):
+        self.cur.execute("SELECT hypopg_drop_index(%s);", (index,))
+
+    def close(self):
+        self.cur.execute("SELECT hypopg_reset();")
+
+
+class ScratchIndexes:
+    """
+    Candidates built on copies of the tables in SCRATCH_SCHEMA. The copies
+    carry the rows and the indexes of the tables, under the same names, and
+    the schema comes first on the search path until close.
+    """
+    name = "scratch"
+
+    def __init__(self, cur, reserved, tables, indexes):
+        self.cur = cur
+        self.reserved = reserved
+        self.built = 0
+        cur.execute(f"DROP SCHEMA IF EXISTS {SCRATCH_SCHEMA} CASCADE;")
+        cur.execute(f"CREATE SCHEMA {SCRATCH_SCHEMA};")
+        for table in tables:
+            cur.execute(f"CREATE TABLE {SCRATCH_SCHEMA}.{table} (LIKE public.{table} INCLUDING DEFAULTS);")
+            cur.execute(f"INSERT INTO {SCRATCH_SCHEMA}.{table} SELECT * FROM public.{table};")
+        for index in indexes:
+            if index["table"] in tables:
+                cur.execute(index["definition"].replace(f" ON public.{index['table']} ",
+                                                        f" ON {SCRATCH_SCHEMA}.{index['table']} ", 1) + ";")
+        if tables:
+            cur.execute(f"ANALYZE {', '.join(f'{SCRATCH_SCHEMA}.{table}' for table in tables)};")
+        cur.execute(f"SET search_path = {SCRATCH_SCHEMA}, public;")
+
+    def create(self, candidate):
+        self.built += 1
+        name = f"advisor_candidate_{self.built}"
+        self.cur.execute(index_ddl(name, f"{SCRATCH_SCHEMA}.{candidate[0]}", candidate, self.reserved))
+        return name
+
+    def size(self, index):
+        self.cur.execute("SELECT pg_relation_size(%s::regclass);", (f"{SCRATCH_SCHEMA}.{index}",))
+        return self.cur.fetchone()[0]
+
+    def drop(self, index):
+        self.cur.execute(f"DROP INDEX {SCRATCH_SCHEMA}.{index};")
+
+    def close(self):
+        self.cur.execute("RESET search_path;")
+        self.cur.execute(f"DROP SCHEMA IF EXISTS {SCRATCH_SCHEMA} CASCADE;")
+
+
+def index_coster(cur, costing, reserved, tables, indexes):
+    if costing == "auto":
+        cur.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'hypopg';")
+        costing = "hypothetical" if cur.fetchone() else "scratch"
+    if costing == "hypothetical":
+        return HypotheticalIndexes(cur, reserved)
+    return ScratchIndexes(cur, reserved, tables, indexes)
+
+
+def evaluate(cur, coster, candidate, statements):
+    # Size of the candidate and the cost of statements with it, or None when it cannot be built
+    try:
+        index = coster.create(candidate)
+    except psycopg2.Error:
+        return None
+    size = coster.size(index)
+    costs = {}
+    for statement in statements:
+        cost = statement_cost(cur, statement)
+        if cost is not None:
+            costs[statement] = cost
+    coster.drop(index)
+    return size, costs
+
+
+def redundant_indexes(indexes, recommended, used):
+    """
+    Existing indexes to drop, with the reason. Indexes backing a constraint
+    are kept, as are unique ones that only repeat the columns of another.
+    """
+    others = indexes + recommended
+    dropped = []
+    for index in indexes:
+        if index["constraint"] or index["expressions"] or index["method"] != "btree":
+            continue
+        covered = set(index["columns"] + index["include"])
+        reason = None
+        for other in others:
+            if (other is index or other["table"] != index["table"] or other["name"] in dropped
+                    or other.get("expressions") or other.get("method", "btree") != "btree"):
+                continue
+            other_columns = set(other["columns"] + other["include"])
+            same_predicate = other["where"] == index["where"]
+            if (same_predicate and other["columns"] == index["columns"] and covered <= other_columns
+                    and (not index["unique"] or other["unique"])):
+                reason = f"same columns as {other['name']}"
+            elif (same_predicate and not index["unique"] and len(index["columns"]) < len(other["columns"])
+                  and other["columns"][:len(index["columns"])] == index["columns"] and covered <= other_columns):
+                reason = f"leading columns of {other['name']}"
+            elif (other["unique"] and other["where"] is None and index["name"] not in used
+                  and len(other["columns"]) < len(index["columns"])
+                  and index["columns"][:len(other["columns"])] == other["columns"]):
+                reason = (f"leads with the unique key of {other['name']}, the columns after it never narrow "
+                          f"a lookup and the workload does not use it")
+            if reason:
+                break
+        if reason is None and not index["unique"] and index["name"] not in used and index["scans"] == 0:
+            reason = "not used by the workload and never scanned since the statistics were reset"
+        if reason:
+            dropped.append(index["name"])
+            yield {"index": index["name"], "table": index["table"], "size": index["size"], "reason": reason,
+                   "ddl": f"DROP INDEX {index['name']};"}
+
+
+def advise_indexes(conn, workload, storage_budget_mb=STORAGE_BUDGET_MB, write_budget=WRITE_BUDGET,
+                   max_indexes=MAX_INDEXES, costing="auto"):
+    """
+    Recommend indexes for workload, a Counter of statements as executed, and
+    list the existing indexes to drop. The statements keep their literals or
+    $n parameters, normalised ones cannot be planned.
+    """
+    autocommit = conn.autocommit
+    if not autocommit:
+        conn.commit()
+        conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        statements = {statement: calls for statement, calls in workload.items() if PLANNABLE.match(statement)}
+        plans = {statement: explain(cur, statement) for statement in statements}
+        skipped = [statement for statement, plan in plans.items() if plan is None]
+        plans = {statement: plan for statement, plan in plans.items() if plan is not None}
+
+        relations = {node["Relation Name"] for plan in plans.values() for node in plan_nodes(plan)
+                     if node.get("Schema") == "public" and "Relation Name" in node}
+        columns = table_columns(cur, relations)
+        indexes = existing_indexes(cur, columns)
+        reserved = reserved_keywords(cur)
+        writes = workload_writes(statements)
+        distinct = {table: distinct_values(cur, table) for table in columns}
+        primary_keys = {index["table"]: index["columns"] for index in indexes if index["primary"]}
+
+        statements_of = {table: set() for table in columns}
+        candidates = set()
+        for statement, plan in plans.items():
+            normalized = normalize_statement(statement)
+            for use in plan_usage(plan, columns).values():
+                table = use["table"]
+                statements_of[table].add(statement)
+                used_columns = statement_columns(normalized, table, columns[table])
+                for candidate in use_candidates(use, used_columns, distinct[table], primary_keys.get(table, [])):
+                    if served_by(candidate, indexes) is None:
+                        candidates.add(candidate)
+
+        coster = index_coster(cur, costing, reserved, sorted({candidate[0] for candidate in candidates}), indexes)
+        try:
+            # Costs on the copies, or on the tables for statements that cannot be planned there
+            cost = {}
+            for statement, plan in plans.items():
+                cost[statement] = statement_cost(cur, statement)
+                if cost[statement] is None:
+                    cost[statement] = plan["Total Cost"]
+            before = dict(cost)
+            workload_cost = sum(statements[statement] * cost[statement] for statement in cost)
+            cur.execute("SELECT current_setting('random_page_cost')::float;")
+            index_write_cost = INDEX_WRITE_PAGES * cur.fetchone()[0]
+            storage_left = storage_budget_mb * 2**20
+            write_left = write_budget * workload_cost
+
+            evaluated = {}
+            recommended = []
+            while candidates and len(recommended) < max_indexes:
+                best = None
+                for candidate in sorted(candidates, key=index_name):
+                    if candidate not in evaluated:
+                        evaluated[candidate] = evaluate(cur, coster, candidate, statements_of[candidate[0]])
+                    if evaluated[candidate] is None:
+                        candidates.discard(candidate)
+                        continue
+                    size, costs = evaluated[candidate]
+                    benefit = sum(statements[statement] * (cost[statement] - new) for statement, new in costs.items())
+                    maintenance = index_write_cost * maintained_rows(candidate, writes)
+                    # The budgets only shrink, a candidate that does not fit now never will
+                    if benefit - maintenance <= 0 or size > storage_left or maintenance > write_left:
+                        candidates.discard(candidate)
+                        continue
+                    if best is None or benefit - maintenance > best[1] - best[2]:
+                        best = (candidate, benefit, maintenance, size)
+                if best is None:
+                    break
+
+                candidate, benefit, maintenance, size = best
+                coster.create(candidate)
+                storage_left -= size
+                write_left -= maintenance
+                table = candidate[0]
+                cost.update(evaluated[candidate][1])
+                candidates.discard(candidate)
+                name = index_name(candidate)
+                recommended.append({
+                    "name": name, "table": table, "columns": list(candidate[1]), "include": list(candidate[2]),
+                    "where": candidate[3], "unique": False, "ddl": index_ddl(name, table, candidate, reserved),
+                    "size": size, "benefit": benefit, "maintenance": maintenance,
+                })
+                # Their statements cost less now, so the benefit of every candidate sharing one changes
+                for other in list(evaluated):
+                    if statements_of[other[0]] & statements_of[table]:
+                        del evaluated[other]
+
+            used = {node["Index Name"] for statement in plans for node in plan_nodes(explain(cur, statement) or {})
+                    if "Index Name" in node}
+        finally:
+            coster.close()
+
+        return {
+            "costing": coster.name,
+            "cost_before": workload_cost,
+            "cost_after": sum(statements[statement] * cost[statement] for statement in cost),
+            "recommended": recommended,
+            "redundant": list(redundant_indexes(indexes, recommended, used)),
+            "statements": sorted(({"statement": statement, "calls": statements[statement],
+                                   "cost_before": before[statement], "cost_after": cost[statement]}
+                                  for statement in cost), key=lambda entry: -entry["calls"] * entry["cost_before"]),
+            "skipped": skipped,
+        }
+    finally:
+        cur.close()
+        conn.autocommit = autocommit
+
+
+def print_advice(advice):
+    mb = 2**20
+    saved = advice["cost_before"] - advice["cost_after"]
+    print(f"Index advice ({advice['costing']} indexes): workload cost {advice['cost_before']:,.0f} -> "
+          f"{advice['cost_after']:,.0f}" + (f" ({-saved / advice['cost_before'] * 100:+.0f}%)"
+                                            if advice["cost_before"] else ""))
+    if not advice["recommended"]:
+        print("  No new index saves enough for this workload within the budgets")
+    for index in advice["recommended"]:
+        print(f"  {index['ddl']}  -- {index['size'] / mb:.1f} MB, saves {index['benefit']:,.0f}, "
+              f"maintenance {index['maintenance']:,.0f}")
+    for index in advice["redundant"]:
+        print(f"  {index['ddl']}  -- {index['size'] / mb:.1f} MB, {index['reason']}")
+    print("  Per statement (calls, cost per call before -> after):")
+    for entry in advice["statements"]:
+        print(f"    {entry['calls']:>8} x {entry['cost_before']:>12,.2f} -> {entry['cost_after']:>12,.2f}  "
+              f"{entry['statement'][:100]}")
+    if advice["skipped"]:
+        print(f"  {len(advice['skipped'])} statements could not be planned and were left out")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recommend indexes for the executed workload")
+    parser.add_argument("--dbname", default="smart_building")
+    parser.add_argument("--queries", help="file of ;-separated statements instead of pg_stat_statements")
+    parser.add_argument("--storage-budget-mb", type=float, default=STORAGE_BUDGET_MB)
+    parser.add_argument("--write-budget", type=float, default=WRITE_BUDGET,
+                        help="maintenance cost of the new indexes as a fraction of the workload cost")
+    parser.add_argument("--max-indexes", type=int, default=MAX_INDEXES)
+    parser.add_argument("--costing", choices=COSTING, default="auto")
+    args = parser.parse_args()
+
+    with psql_connection(args.dbname) as conn:
+        if args.queries:
+            workload = workload_from_file(args.queries, normalize=False)
+        else:
+            workload = workload_from_pg_stat_statements(conn, normalize=False)
+        print_advice(advise_indexes(conn, workload, args.storage_budget_mb, args.write_budget, args.max_indexes,
+                                    args.costing))
@@ -1,23 +1,37 @@
 import psycopg2 
-import time
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.db import connect_psql_db, release_psql_db, close_all
+from common.workload import WorkloadRecorder, record_workload
+from benchmark import QUERIES, compare_results, run_benchmarks
+from index_advisor import advise_indexes, print_advice
+from rollup import drop_rollup, install_rollup, register_rollup_queries, rollup_mismatches
 
 DB_NAME = "smart_building"
 
 
-def connect_psql_db(dbname="postgres"):
-    print(f"Connecting to {dbname}....")
+INDEXES = {
+    "room_index": "rooms(room_id,floor_id)",
+    "floor_index": "floors(floor_id,building_id)",
+    "building_index": "buildings(building_id)",
+}
+
+
+def building_rollup(conn):
     try:
-        connection = psycopg2.connect(  user="postgres",
-                                        password="Password",
-                                        host="127.0.0.1",
-                                        port="5432",
-                                        database=dbname)
-        connection.set_session(autocommit=True)
-        print(f"Connected to {dbname}")
-        return connection
-    except (Exception, psycopg2.Error) as error:
-        print("Error while connecting to PostgreSQL", error)
+        # Counts per building kept current by triggers, instead of joining the three tables on every query
+        print("Building the rollup of floors and rooms per building....")
+        install_rollup(conn.info.dbname)
+        print(f"Rollup built, {len(rollup_mismatches(conn))} counts differ from a full join")
+        register_rollup_queries()
 
+        print("Benchmarking the join against the rollup....")
+        run_benchmarks("rollup", ["buildings_with_busy_floors", "buildings_with_busy_floors_rollup"],
+                       dbname=conn.info.dbname, variants=("warm",))
+
+    except (Exception, psycopg2.Error) as error:
+        print("Error while building the rollup: ", error)
 
 
 def indexing(conn):
@@ -26,48 +40,34 @@ def indexing(conn):
         # Create a new cursor object
         cur = conn.cursor()
 
-        # Calulating time taken to run query "Query all buildings containing at least one floor with more than 4 rooms"
-        t1 = time.time()
-        cur.execute('''
-            EXPLAIN SELECT DISTINCT b.building_id, b.building_name
-            FROM buildings b
-            JOIN floors f ON b.building_id = f.building_id
-            JOIN rooms r ON f.floor_id = r.floor_id
-            GROUP BY b.building_id, b.building_name
-            HAVING COUNT(DISTINCT f.floor_id) > 0 AND COUNT(DISTINCT r.room_id) > 4;
-        ''')
-        rows = cur.fetchall()
-        t2 = time.time()
-        print("Time taken to run query 'Query all buildings containing at least one floor with more than 4 rooms': ",  (t2-t1)*1000, "ms")
-            
-        
+        # Start from the tables without the indexes, so the first run measures them without.
+        # The rollup of an earlier run goes too, with its index on rooms(floor_id).
+        for index in INDEXES:
+            cur.execute(f"DROP INDEX IF EXISTS {index};")
+        drop_rollup(conn.info.dbname)
+
+        # Benchmarking every registered query, e.g. "Query all buildings containing at least one floor with more than 4 rooms"
+        print("Benchmarking queries before creating indexes....")
+        before = run_benchmarks("before_indexing", dbname=conn.info.dbname)
+
         print("Creating Indexes on Rooms Table....")
         # Create index on rooms table
-        cur.execute("CREATE INDEX room_index on rooms(room_id,floor_id);")
+        cur.execute(f"CREATE INDEX room_index on {INDEXES['room_index']};")
 
         print("Creating Indexes on Floors Table....")
         # Create index on floors table
-        cur.execute("CREATE INDEX floor_index on floors(floor_id,building_id);")
+        cur.execute(f"CREATE INDEX floor_index on {INDEXES['floor_index']};")
 
         print("Creating Indexes on Buildings Table....")
         # Create index on buildings table
-        cur.execute("CREATE INDEX building_index on buildings(building_id);")
+        cur.execute(f"CREATE INDEX building_index on {INDEXES['building_index']};")
+        cur.execute("ANALYZE rooms, floors, buildings;")
 
-        # Calulating time taken to run query "Query all buildings containing at least one floor with more than 4 rooms"
+        print("Benchmarking queries after creating indexes....")
+        after = run_benchmarks("after_indexing", dbname=conn.info.dbname)
 
-        t1 = time.time()
-        cur.execute('''
-            EXPLAIN SELECT DISTINCT b.building_id, b.building_name
-            FROM buildings b
-            JOIN floors f ON b.building_id = f.building_id
-            JOIN rooms r ON f.floor_id = r.floor_id
-            GROUP BY b.building_id, b.building_name
-            HAVING COUNT(DISTINCT f.floor_id) > 0 AND COUNT(DISTINCT r.room_id) > 4;
-        ''')
-
-        rows = cur.fetchall()
-        t2 = time.time()
-        print("Time taken to run query 'Query all buildings containing at least one floor with more than 4 rooms': ", (t2-t1)*1000, "ms")
+        print("p50 execution time before and after creating indexes")
+        compare_results(before, after)
 
         # Close the cursor and the connection
         cur.close()
@@ -76,7 +76,25 @@ def indexing(conn):
         print("Error while creating indexes: ", error)
 
 
+def index_advice(conn):
+    try:
+        # Record the registered queries as executed and ask the advisor about the indexes for them
+        with record_workload(conn, WorkloadRecorder(normalize=False)) as recorder:
+            cur = conn.cursor()
+            for query in QUERIES.values():
+                cur.execute(query["query"], query["params"])
+                cur.fetchall()
+            cur.close()
+        print_advice(advise_indexes(conn, recorder.statements))
+
+    except (Exception, psycopg2.Error) as error:
+        print("Error while advising indexes: ", error)
+
+
 if __name__ == "__main__":
     conn = connect_psql_db(DB_NAME)
     indexing(conn)
-    conn.close()
\ No newline at end of file
+    index_advice(conn)
+    building_rollup(conn)
+    release_psql_db(conn)
+    close_all()
\ No newline at end of file
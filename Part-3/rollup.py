@@ -0,0 +1,370 @@
+"""
+Incrementally maintained rollup of rooms and floors per building.
+
+building_rollup holds the name and the floor and room counts of every
+building. building_room_status_counts and building_room_type_counts split
+the room count by room_status and room_type. Queries that joined buildings,
+floors and rooms only to count, like buildings_with_busy_floors of the
+benchmarks, read one row per building instead.
+
+Statement level triggers with transition tables keep the rollup current.
+Every insert, update and delete on rooms, floors or buildings turns the rows
+it changed into count deltas per building, status and type, and applies them
+in the same transaction. A room counts for the building of its floor at the
+time of the statement. A floor moving to another building takes the counts of
+its rooms along. Rows an update left unchanged in the rolled up columns are
+skipped. TRUNCATE rebuilds the whole rollup.
+
+The rollup needs PostgreSQL 15 or later, for UNIQUE NULLS NOT DISTINCT.
+install_rollup creates the tables, the triggers and an index on
+rooms(floor_id) for the floor triggers. It then builds the rollup while
+writes to the three tables are locked out. rollup_mismatches compares every
+count with a full join.
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.db import psql_connection
+from benchmark import register_query
+
+
+ROLLUP_TABLE = "building_rollup"
+STATUS_TABLE = "building_room_status_counts"
+TYPE_TABLE = "building_room_type_counts"
+ROLLUP_SOURCES = ("buildings", "floors", "rooms")
+
+ROLLUP_DDL = f"""
+    CREATE TABLE IF NOT EXISTS {ROLLUP_TABLE} (
+        building_id INT PRIMARY KEY,
+        building_name VARCHAR(255),
+        floor_count INT NOT NULL DEFAULT 0,
+        room_count INT NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS {ROLLUP_TABLE}_room_count_idx ON {ROLLUP_TABLE} (room_count);
+
+    -- NULL is a status or type of its own
+    CREATE TABLE IF NOT EXISTS {STATUS_TABLE} (
+        building_id INT NOT NULL,
+        room_status VARCHAR(50),
+        room_count INT NOT NULL,
+        UNIQUE NULLS NOT DISTINCT (building_id, room_status)
+    );
+    CREATE TABLE IF NOT EXISTS {TYPE_TABLE} (
+        building_id INT NOT NULL,
+        room_type VARCHAR(50),
+        room_count INT NOT NULL,
+        UNIQUE NULLS NOT DISTINCT (building_id, room_type)
+    );
+
+    -- The floor triggers look up the rooms of the changed floors
+    CREATE INDEX IF NOT EXISTS rooms_floor_id_rollup_idx ON rooms (floor_id);
+
+    DO $$ BEGIN
+        CREATE TYPE building_rollup_delta AS (
+            building_id INT, room_status VARCHAR(50), room_type VARCHAR(50), floors INT, rooms INT
+        );
+    EXCEPTION WHEN duplicate_object THEN NULL;
+    END $$;
+
+    CREATE OR REPLACE FUNCTION apply_building_rollup(deltas building_rollup_delta[]) RETURNS void AS $$
+        INSERT INTO {ROLLUP_TABLE} AS r (building_id, floor_count, room_count)
+        SELECT building_id, sum(floors), sum(rooms) FROM unnest(deltas) WHERE building_id IS NOT NULL
+        GROUP BY building_id HAVING sum(floors) <> 0 OR sum(rooms) <> 0
+        ORDER BY building_id
+        ON CONFLICT (building_id) DO UPDATE
+        SET floor_count = r.floor_count + EXCLUDED.floor_count, room_count = r.room_count + EXCLUDED.room_count;
+
+        INSERT INTO {STATUS_TABLE} AS s (building_id, room_status, room_count)
+        SELECT building_id, room_status, sum(rooms) FROM unnest(deltas) WHERE building_id IS NOT NULL
+        GROUP BY building_id, room_status HAVING sum(rooms) <> 0
+        ORDER BY building_id, room_status
+        ON CONFLICT (building_id, room_status) DO UPDATE SET room_count = s.room_count + EXCLUDED.room_count;
+
+        INSERT INTO {TYPE_TABLE} AS t (building_id, room_type, room_count)
+        SELECT building_id, room_type, sum(rooms) FROM unnest(deltas) WHERE building_id IS NOT NULL
+        GROUP BY building_id, room_type HAVING sum(rooms) <> 0
+        ORDER BY building_id, room_type
+        ON CONFLICT (building_id, room_type) DO UPDATE SET room_count = t.room_count + EXCLUDED.room_count;
+
+        DELETE FROM {STATUS_TABLE}
+        WHERE room_count = 0 AND building_id IN (SELECT building_id FROM unnest(deltas));
+        DELETE FROM {TYPE_TABLE}
+        WHERE room_count = 0 AND building_id IN (SELECT building_id FROM unnest(deltas));
+        -- Counts of floors whose building does not exist, kept only while there are any
+        DELETE FROM {ROLLUP_TABLE} r
+        WHERE r.floor_count = 0 AND r.room_count = 0 AND r.building_id IN (SELECT building_id FROM unnest(deltas))
+          AND NOT EXISTS (SELECT 1 FROM buildings b WHERE b.building_id = r.building_id);
+    $$ LANGUAGE sql;
+
+    CREATE OR REPLACE FUNCTION rollup_rooms_changed() RETURNS trigger AS $$
+    DECLARE
+        deltas building_rollup_delta[];
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            deltas := ARRAY(
+                SELECT ROW(f.building_id, n.room_status, n.room_type, 0, 1)::building_rollup_delta
+                FROM new_rows n JOIN floors f ON f.floor_id = n.floor_id);
+        ELSIF TG_OP = 'DELETE' THEN
+            deltas := ARRAY(
+                SELECT ROW(f.building_id, o.room_status, o.room_type, 0, -1)::building_rollup_delta
+                FROM old_rows o JOIN floors f ON f.floor_id = o.floor_id);
+        ELSE
+            -- Only rooms whose floor, status or type changed
+            deltas := ARRAY(
+                WITH changed AS (
+                    SELECT o.floor_id AS old_floor_id, o.room_status AS old_status, o.room_type AS old_type,
+                           n.floor_id AS new_floor_id, n.room_status AS new_status, n.room_type AS new_type
+                    FROM old_rows o FULL JOIN new_rows n ON n.room_id = o.room_id
+                    WHERE (o.floor_id, o.room_status, o.room_type)
+                          IS DISTINCT FROM (n.floor_id, n.room_status, n.room_type)
+                )
+                SELECT ROW(f.building_id, c.old_status, c.old_type, 0, -1)::building_rollup_delta
+                FROM changed c JOIN floors f ON f.floor_id = c.old_floor_id
+                UNION ALL
+                SELECT ROW(f.building_id, c.new_status, c.new_type, 0, 1)::building_rollup_delta
+                FROM changed c JOIN floors f ON f.floor_id = c.new_floor_id);
+        END IF;
+        PERFORM apply_building_rollup(deltas);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    -- A floor and the rooms on it count for the building of the floor
+    CREATE OR REPLACE FUNCTION rollup_floors_changed() RETURNS trigger AS $$
+    DECLARE
+        deltas building_rollup_delta[];
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            deltas := ARRAY(
+                SELECT ROW(n.building_id, NULL, NULL, 1, 0)::building_rollup_delta FROM new_rows n
+                UNION ALL
+                SELECT ROW(n.building_id, r.room_status, r.room_type, 0, 1)::building_rollup_delta
+                FROM new_rows n JOIN rooms r ON r.floor_id = n.floor_id);
+        ELSIF TG_OP = 'DELETE' THEN
+            deltas := ARRAY(
+                SELECT ROW(o.building_id, NULL, NULL, -1, 0)::building_rollup_delta FROM old_rows o
+                UNION ALL
+                SELECT ROW(o.building_id, r.room_status, r.room_type, 0, -1)::building_rollup_delta
+                FROM old_rows o JOIN rooms r ON r.floor_id = o.floor_id);
+        ELSE
+            -- Only floors that moved to another building, with their rooms
+            deltas := ARRAY(
+                WITH changed AS (
+                    SELECT o.floor_id AS old_floor_id, o.building_id AS old_building_id,
+                           n.floor_id AS new_floor_id, n.building_id AS new_building_id
+                    FROM old_rows o FULL JOIN new_rows n ON n.floor_id = o.floor_id
+                    WHERE o.building_id IS DISTINCT FROM n.building_id OR o.floor_id IS NULL OR n.floor_id IS NULL
+                )
+                SELECT ROW(old_building_id, NULL, NULL, -1, 0)::building_rollup_delta
+                FROM changed WHERE old_floor_id IS NOT NULL
+                UNION ALL
+                SELECT ROW(c.old_building_id, r.room_status, r.room_type, 0, -1)::building_rollup_delta
+                FROM changed c JOIN rooms r ON r.floor_id = c.old_floor_id
+                UNION ALL
+                SELECT ROW(new_building_id, NULL, NULL, 1, 0)::building_rollup_delta
+                FROM changed WHERE new_floor_id IS NOT NULL
+                UNION ALL
+                SELECT ROW(c.new_building_id, r.room_status, r.room_type, 0, 1)::building_rollup_delta
+                FROM changed c JOIN rooms r ON r.floor_id = c.new_floor_id);
+        END IF;
+        PERFORM apply_building_rollup(deltas);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION rollup_buildings_changed() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            UPDATE {ROLLUP_TABLE} SET building_name = NULL
+            WHERE building_id IN (SELECT building_id FROM old_rows);
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO {ROLLUP_TABLE} AS r (building_id, building_name)
+            SELECT building_id, building_name FROM new_rows ORDER BY building_id
+            ON CONFLICT (building_id) DO UPDATE SET building_name = EXCLUDED.building_name;
+        END IF;
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            DELETE FROM {ROLLUP_TABLE} r
+            WHERE r.floor_count = 0 AND r.room_count = 0 AND r.building_id IN (SELECT building_id FROM old_rows)
+              AND NOT EXISTS (SELECT 1 FROM buildings b WHERE b.building_id = r.building_id);
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION refresh_building_rollup() RETURNS void AS $$
+    BEGIN
+        DELETE FROM {STATUS_TABLE};
+        DELETE FROM {TYPE_TABLE};
+        DELETE FROM {ROLLUP_TABLE};
+        INSERT INTO {ROLLUP_TABLE} (building_id, building_name)
+        SELECT building_id, building_name FROM buildings;
+        PERFORM apply_building_rollup(ARRAY(
+            SELECT ROW(building_id, NULL, NULL, 1, 0)::building_rollup_delta FROM floors
+            UNION ALL
+            SELECT ROW(f.building_id, r.room_status, r.room_type, 0, 1)::building_rollup_delta
+            FROM rooms r JOIN floors f ON f.floor_id = r.floor_id));
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION rollup_truncated() RETURNS trigger AS $$
+    BEGIN
+        PERFORM refresh_building_rollup();
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+"""
+
+# Transition tables need one trigger per event
+ROLLUP_EVENTS = {
+    "insert": "NEW TABLE AS new_rows",
+    "update": "OLD TABLE AS old_rows NEW TABLE AS new_rows",
+    "delete": "OLD TABLE AS old_rows",
+}
+
+# Per building totals, and room counts by status and by type, of the rollup
+# and of a full join of the tables it is built from
+ROLLUP_QUERIES = {
+    "rollup": (
+        f"SELECT building_id, building_name, floor_count, room_count FROM {ROLLUP_TABLE};",
+        f"SELECT building_id, room_status, room_count FROM {STATUS_TABLE};",
+        f"SELECT building_id, room_type, room_count FROM {TYPE_TABLE};",
+    ),
+    "joined": (
+        """
+        SELECT b.building_id, b.building_name, count(DISTINCT f.floor_id), count(r.room_id)
+        FROM buildings b
+        LEFT JOIN floors f ON f.building_id = b.building_id
+        LEFT JOIN rooms r ON r.floor_id = f.floor_id
+        GROUP BY b.building_id, b.building_name;
+        """,
+        """
+        SELECT f.building_id, r.room_status, count(*)
+        FROM rooms r JOIN floors f ON f.floor_id = r.floor_id
+        GROUP BY f.building_id, r.room_status;
+        """,
+        """
+        SELECT f.building_id, r.room_type, count(*)
+        FROM rooms r JOIN floors f ON f.floor_id = r.floor_id
+        GROUP BY f.building_id, r.room_type;
+        """,
+    ),
+}
+
+BUSY_BUILDINGS_QUERY = f"""
+    SELECT building_id, building_name
+    FROM {ROLLUP_TABLE}
+    WHERE floor_count > 0 AND room_count > 4;
+"""
+
+
+def register_rollup_queries():
+    # Registered once the rollup exists, so benchmarks of the plain tables do not run it
+    register_query("buildings_with_busy_floors_rollup", BUSY_BUILDINGS_QUERY)
+
+
+def install_rollup(dbname="smart_building", target="psql"):
+    """
+    Create the rollup tables and their triggers on buildings, floors and
+    rooms, and build the rollup from the current rows. Installing again
+    rebuilds it.
+    """
+    with psql_connection(dbname, target, autocommit=False) as conn:
+        if conn.server_version < 150000:
+            raise RuntimeError(f"The rollup needs PostgreSQL 15 or later (UNIQUE NULLS NOT DISTINCT), "
+                               f"{dbname} runs {conn.info.parameter_status('server_version')}")
+        cur = conn.cursor()
+        cur.execute(ROLLUP_DDL)
+        # Writes that would be missed between the rebuild and the triggers wait
+        cur.execute(f"LOCK TABLE {', '.join(ROLLUP_SOURCES)} IN SHARE ROW EXCLUSIVE MODE;")
+        for source in ROLLUP_SOURCES:
+            for event, transition in ROLLUP_EVENTS.items():
+                trigger = f"{source}_rollup_{event}"
+                cur.execute(f"DROP TRIGGER IF EXISTS {trigger} ON {source};")
+                cur.execute(f"""
+                    CREATE TRIGGER {trigger} AFTER {event.upper()} ON {source} REFERENCING {transition}
+                    FOR EACH STATEMENT EXECUTE FUNCTION rollup_{source}_changed();
+                """)
+            cur.execute(f"DROP TRIGGER IF EXISTS {source}_rollup_truncate ON {source};")
+            cur.execute(f"""
+                CREATE TRIGGER {source}_rollup_truncate AFTER TRUNCATE ON {source}
+                FOR EACH STATEMENT EXECUTE FUNCTION rollup_truncated();
+            """)
+        cur.execute("SELECT refresh_building_rollup();")
+        cur.execute(f"ANALYZE {ROLLUP_TABLE}, {STATUS_TABLE}, {TYPE_TABLE};")
+        conn.commit()
+        cur.close()
+
+
+def drop_rollup(dbname="smart_building", target="psql"):
+    with psql_connection(dbname, target, autocommit=False) as conn:
+        cur = conn.cursor()
+        for source in ROLLUP_SOURCES:
+            for event in (*ROLLUP_EVENTS, "truncate"):
+                cur.execute(f"DROP TRIGGER IF EXISTS {source}_rollup_{event} ON {source};")
+        cur.execute(f"DROP TABLE IF EXISTS {ROLLUP_TABLE}, {STATUS_TABLE}, {TYPE_TABLE};")
+        cur.execute("DROP INDEX IF EXISTS rooms_floor_id_rollup_idx;")
+        cur.execute("""
+            DROP FUNCTION IF EXISTS rollup_truncated(), refresh_building_rollup(), rollup_buildings_changed(),
+                rollup_floors_changed(), rollup_rooms_changed(), apply_building_rollup(building_rollup_delta[]);
+        """)
+        cur.execute("DROP TYPE IF EXISTS building_rollup_delta;")
+        conn.commit()
+        cur.close()
+
+
+def building_counts(cur, queries):
+    # building_id -> {"name", "floors", "rooms", ("room_status", value), ("room_type", value)}
+    totals, by_status, by_type = queries
+    counts = {}
+    cur.execute(totals)
+    for building_id, name, floors, rooms in cur.fetchall():
+        counts[building_id] = {"name": name, "floors": floors, "rooms": rooms}
+    for column, query in (("room_status", by_status), ("room_type", by_type)):
+        cur.execute(query)
+        for building_id, value, rooms in cur.fetchall():
+            counts.setdefault(building_id, {})[(column, value)] = rooms
+    return counts
+
+
+def rollup_mismatches(conn):
+    """
+    Every count of the rollup that differs from a full join of buildings,
+    floors and rooms, as (building_id, count, rollup value, joined value).
+    Counts are "name", "floors", "rooms" and (column, value) pairs for the
+    rooms by status and type. Missing counts are None.
+    """
+    cur = conn.cursor()
+    rollup = building_counts(cur, ROLLUP_QUERIES["rollup"])
+    joined = building_counts(cur, ROLLUP_QUERIES["joined"])
+    cur.close()
+    mismatches = []
+    for building_id in sorted(rollup.keys() | joined.keys()):
+        ours, theirs = rollup.get(building_id, {}), joined.get(building_id, {})
+        for count in ours.keys() | theirs.keys():
+            if ours.get(count) != theirs.get(count):
+                mismatches.append((building_id, count, ours.get(count), theirs.get(count)))
+    return mismatches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain room and floor counts per building")
+    parser.add_argument("--dbname", default="smart_building")
+    parser.add_argument("--install", action="store_true", help="create the rollup and its triggers, or rebuild it")
+    parser.add_argument("--drop", action="store_true", help="drop the rollup and its triggers")
+    parser.add_argument("--verify", action="store_true", help="compare the rollup with the counts of a full join")
+    args = parser.parse_args()
+
+    if args.drop:
+        drop_rollup(args.dbname)
+    if args.install:
+        install_rollup(args.dbname)
+    if args.verify:
+        with psql_connection(args.dbname) as conn:
+            mismatches = rollup_mismatches(conn)
+        for building_id, count, rollup, joined in mismatches:
+            print(f"building {building_id} {count}: rollup {rollup}, joined {joined}")
+        print(f"{len(mismatches)} counts differ")
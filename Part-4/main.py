@@ -2,34 +2,71 @@ import psycopg2
 import time
 from datetime import date, timedelta
 from multiprocessing import Process
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.db import connect_psql_db, release_psql_db, close_all
+from common.statements import execute_prepared, register_statement, report_statement_metrics
 
 
 DB_NAME = "smart_building"
 
+# Rows copied from psql into pgpool one INSERT at a time
+register_statement("replicate_building", """
+    INSERT INTO buildings (
+        building_name, address, total_floors,
+        construction_year, building_type, emergency_contact,
+        maintenance_contact, energy_rating, building_status
+    )
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s);
+""")
+register_statement("replicate_floor", """
+    INSERT INTO floors (
+        building_id, floor_number, description, total_rooms,
+        floor_area, fire_escape_plan, access_control_level
+    )
+    VALUES (%s, %s, %s, %s, %s, %s, %s);
+""")
+register_statement("replicate_room", """
+    INSERT INTO rooms (
+        floor_id, room_name, room_type, room_size,
+        occupancy_limit, accessibility_features, room_status
+    )
+    VALUES (%s, %s, %s, %s, %s, %s, %s);
+""")
+register_statement("replicate_user", """
+    INSERT INTO users (
+        user_name, email, role, password_hash,
+        date_joined, last_login_date, phone_number,
+        emergency_contact, access_level
+    )
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s);
+""")
+register_statement("replicate_access_log", """
+    INSERT INTO access_logs (
+        user_id, room_id, timestamp, access_type,
+        access_method, access_status
+    )
+    VALUES (%s, %s, %s, %s, %s, %s);
+""")
+
+# Statements of the room move transactions
+register_statement("room_with_status", "SELECT room_id FROM rooms WHERE room_status = %s;")
+register_statement("latest_room_users", "SELECT user_id FROM access_logs WHERE room_id = %s ORDER BY timestamp DESC;")
+register_statement("set_room_status", "UPDATE rooms SET room_status = %s WHERE room_id = %s;")
+register_statement("room_status", "SELECT room_status FROM rooms WHERE room_id = %s;")
+register_statement("log_room_access", """
+    INSERT INTO access_logs (
+        user_id, room_id, timestamp, access_type,
+        access_method, access_status
+    )
+    VALUES (%s, %s, %s, %s, %s, %s);
+""")
+
 def connect_pgpool_db(dbname="postgres"):
-    print(f"Connecting to {dbname}....")
-    try:
-        connection = psycopg2.connect(  user="postgres",
-                                        host="localhost",
-                                        port="9999",
-                                        database=dbname)
-        print(f"Connected to {dbname}")
-        return connection
-    except (Exception, psycopg2.Error) as error:
-        print("Error while connecting to PostgreSQL", error)
+    # Pgpool-II front end, transactions are committed explicitly
+    return connect_psql_db(dbname, target="pgpool", autocommit=False)
 
-def connect_psql_db(dbname="postgres"):
-    print(f"Connecting to {dbname}....")
-    try:
-        connection = psycopg2.connect(  user="postgres",
-                                        password="Password",
-                                        host="localhost",
-                                        port="5432",
-                                        database=dbname)
-        print(f"Connected to {dbname}")
-        return connection
-    except (Exception, psycopg2.Error) as error:
-        print("Error while connecting to PostgreSQL", error)
 
 def create_pgpool_SB_db(conn):
     print("Creating Smart-Building database in pgpool....")
@@ -135,64 +172,27 @@ def insert_psql_data(conn,conn_psql):
         cur_psql.execute("SELECT * FROM buildings;")
         buildings = cur_psql.fetchall()
         for building in buildings:
-            cur.execute("""
-                INSERT INTO buildings (
-                    building_name, address, total_floors,
-                    construction_year, building_type, emergency_contact,
-                    maintenance_contact, energy_rating, building_status
-                )
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s);
-            """, (building[1], building[2], building[3], building[4],
-                building[5], building[6], building[7], building[8], building[9]))
+            execute_prepared(cur, "replicate_building", building[1:10])
         
         cur_psql.execute("SELECT * FROM floors;")
         floors = cur_psql.fetchall()
         for floor in floors:
-            cur.execute("""
-                INSERT INTO floors (
-                    building_id, floor_number, description, total_rooms,
-                    floor_area, fire_escape_plan, access_control_level
-                )
-                VALUES (%s, %s, %s, %s, %s, %s, %s);
-            """, (floor[1], floor[2], floor[3], floor[4],
-                floor[5], floor[6], floor[7]))
+            execute_prepared(cur, "replicate_floor", floor[1:8])
         
         cur_psql.execute("SELECT * FROM rooms;")
         rooms = cur_psql.fetchall()
         for room in rooms:
-            cur.execute("""
-                INSERT INTO rooms (
-                    floor_id, room_name, room_type, room_size,
-                    occupancy_limit, accessibility_features, room_status
-                )
-                VALUES (%s, %s, %s, %s, %s, %s, %s);
-            """, (room[1], room[2], room[3], room[4],
-                room[5], room[6], room[7]))
+            execute_prepared(cur, "replicate_room", room[1:8])
         
         cur_psql.execute("SELECT * FROM users;")
         users = cur_psql.fetchall()
         for user in users:
-            cur.execute("""
-                INSERT INTO users (
-                    user_name, email, role, password_hash,
-                    date_joined, last_login_date, phone_number,
-                    emergency_contact, access_level
-                )
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s);
-            """, (user[1], user[2], user[3], user[4],
-                user[5], user[6], user[7], user[8], user[9]))
+            execute_prepared(cur, "replicate_user", user[1:10])
             
         cur_psql.execute("SELECT * FROM access_logs;")
         access_logs = cur_psql.fetchall()
         for access_log in access_logs:
-            cur.execute("""
-                INSERT INTO access_logs (
-                    user_id, room_id, timestamp, access_type,
-                    access_method, access_status
-                )
-                VALUES (%s, %s, %s, %s, %s, %s);
-            """, (access_log[1], access_log[2], access_log[3], access_log[4],
-                access_log[5], access_log[6]))
+            execute_prepared(cur, "replicate_access_log", access_log[1:7])
         
         conn.commit()
         cur.close()
@@ -239,32 +239,20 @@ def distributed_transaction_acid_rollback(conn):
     try:
         cur = conn.cursor()
         cur.execute("BEGIN;")
-        cur.execute("SELECT room_id FROM rooms WHERE room_status='Occupied';")
+        execute_prepared(cur, "room_with_status", ('Occupied',))
         occupied_room_id = cur.fetchall()[0][0]
-        cur.execute("SELECT room_id FROM rooms WHERE room_status='Available';")
+        execute_prepared(cur, "room_with_status", ('Available',))
         available_room_id =  cur.fetchall()[0][0]
-        cur.execute(f"SELECT user_id FROM access_logs WHERE room_id={occupied_room_id} ORDER BY timestamp DESC;")
+        execute_prepared(cur, "latest_room_users", (occupied_room_id,))
         user_id = cur.fetchall()[0][0]
         print(f"user with user_id {user_id} moving from room {occupied_room_id} to room {available_room_id}")
-        cur.execute(f"UPDATE rooms SET room_status='Available' WHERE room_id={occupied_room_id};")
-        cur.execute(f"UPDATE rooms SET room_status='Occupied' WHERE room_id={available_room_id};")
+        execute_prepared(cur, "set_room_status", ('Available', occupied_room_id))
+        execute_prepared(cur, "set_room_status", ('Occupied', available_room_id))
 
-        cur.execute("""
-            INSERT INTO access_logs (
-                user_id, room_id, timestamp, access_type,
-                access_method, access_status
-            )
-            VALUES (%s, %s, %s, %s, %s, %s);
-        """, (user_id, occupied_room_id, date.today(), 'Exit',
+        execute_prepared(cur, "log_room_access", (user_id, occupied_room_id, date.today(), 'Exit',
             'Card', 'Granted'))
         raise Exception("Exception during transaction")
-        cur.execute("""
-            INSERT INTO access_logs (
-                user_id, room_id, timestamp, access_type,
-                access_method, access_status
-            )
-            VALUES (%s, %s, %s, %s, %s, %s);
-        """, (user_id, available_room_id, date.today(), 'Entry',
+        execute_prepared(cur, "log_room_access", (user_id, available_room_id, date.today(), 'Entry',
             'Card', 'Granted'))
         
         cur.execute("COMMIT;")
@@ -272,9 +260,9 @@ def distributed_transaction_acid_rollback(conn):
         print(f"An error occurred: {e}")
         print("This transaction is being rolled back")
         cur.execute("ROLLBACK;")
-    cur.execute(f"SELECT room_status FROM rooms WHERE room_id={occupied_room_id};")
+    execute_prepared(cur, "room_status", (occupied_room_id,))
     print(f"Room status of {occupied_room_id} is {cur.fetchall()[0][0]}")
-    cur.execute(f"SELECT room_status FROM rooms WHERE room_id={available_room_id};")
+    execute_prepared(cur, "room_status", (available_room_id,))
     print(f"Room status of {available_room_id} is {cur.fetchall()[0][0]}")
     cur.close()  
     
@@ -283,32 +271,20 @@ def distributed_transaction_acid_successful(conn):
     try:
         cur = conn.cursor()
         cur.execute("BEGIN;")
-        cur.execute("SELECT room_id FROM rooms WHERE room_status='Occupied';")
+        execute_prepared(cur, "room_with_status", ('Occupied',))
         occupied_room_id = cur.fetchall()[0][0]
-        cur.execute("SELECT room_id FROM rooms WHERE room_status='Available';")
+        execute_prepared(cur, "room_with_status", ('Available',))
         available_room_id =  cur.fetchall()[0][0]
-        cur.execute(f"SELECT user_id FROM access_logs WHERE room_id={occupied_room_id} ORDER BY timestamp DESC;")
+        execute_prepared(cur, "latest_room_users", (occupied_room_id,))
         user_id = cur.fetchall()[0][0]
         print(f"user with user_id {user_id} moving from room {occupied_room_id} to room {available_room_id}")
-        cur.execute(f"UPDATE rooms SET room_status='Available' WHERE room_id={occupied_room_id};")
-        cur.execute(f"UPDATE rooms SET room_status='Occupied' WHERE room_id={available_room_id};")
+        execute_prepared(cur, "set_room_status", ('Available', occupied_room_id))
+        execute_prepared(cur, "set_room_status", ('Occupied', available_room_id))
 
-        cur.execute("""
-            INSERT INTO access_logs (
-                user_id, room_id, timestamp, access_type,
-                access_method, access_status
-            )
-            VALUES (%s, %s, %s, %s, %s, %s);
-        """, (user_id, occupied_room_id, date.today(), 'Exit',
+        execute_prepared(cur, "log_room_access", (user_id, occupied_room_id, date.today(), 'Exit',
             'Card', 'Granted'))
         
-        cur.execute("""
-            INSERT INTO access_logs (
-                user_id, room_id, timestamp, access_type,
-                access_method, access_status
-            )
-            VALUES (%s, %s, %s, %s, %s, %s);
-        """, (user_id, available_room_id, date.today(), 'Entry',
+        execute_prepared(cur, "log_room_access", (user_id, available_room_id, date.today(), 'Entry',
             'Card', 'Granted'))
         
         cur.execute("COMMIT;")
@@ -316,15 +292,15 @@ def distributed_transaction_acid_successful(conn):
         print(f"An error occurred: {e}")
         print("this transaction is being rolled back")
         cur.execute("ROLLBACK;")
-    cur.execute(f"SELECT room_status FROM rooms WHERE room_id={occupied_room_id};")
+    execute_prepared(cur, "room_status", (occupied_room_id,))
     print(f"Room status of {occupied_room_id} is {cur.fetchall()[0][0]}")
-    cur.execute(f"SELECT room_status FROM rooms WHERE room_id={available_room_id};")
+    execute_prepared(cur, "room_status", (available_room_id,))
     print(f"Room status of {available_room_id} is {cur.fetchall()[0][0]}")
     cur.close()
 
 if __name__ == "__main__":
     conn = connect_pgpool_db(DB_NAME)
-    conn_psql = connect_psql_db(DB_NAME)
+    conn_psql = connect_psql_db(DB_NAME, autocommit=False)
     conn2 = connect_pgpool_db(DB_NAME)
 
     create_psql_tables(conn)
@@ -335,8 +311,12 @@ if __name__ == "__main__":
     conn.autocommit = False
     distributed_transaction_acid_rollback(conn)
     distributed_transaction_acid_successful(conn)
+    report_statement_metrics(conn)
     print("Showcasing Race Conditions without lock during concurrent transactions")
     distributed_transaction_with_lock(conn, conn2, False)
     print("Showcasing resolved Race Conditions by serialization with lock during concurrent transactions")
     distributed_transaction_with_lock(conn, conn2, True)
-    conn.close()
\ No newline at end of file
+    release_psql_db(conn)
+    release_psql_db(conn2)
+    release_psql_db(conn_psql)
+    close_all()
\ No newline at end of file
@@ -9,9 +9,15 @@
 # showcase the functionality of your NoSQL database for your
 # chosen topic.
 
-from pymongo import MongoClient
 from faker import Faker
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.db import get_mongo_client, close_all
+from common.cache import cached_count_documents, report_cache_metrics, watch_mongo_changes, watch_mongo_writes
+from common.sensor_data import is_timeseries, sensor_data_query, timeseries_writes_supported, to_timeseries_document
 import random
+import time
 from pprint import pprint
 
 
@@ -45,6 +51,8 @@ def create(db):
         'data_quality': random.choice(['good', 'bad']),
         'data_status': random.choice(['confirmed', 'unconfirmed'])
     }
+    if is_timeseries(db):
+        sensor_data_data = to_timeseries_document(sensor_data_data)
     db['sensor_data'].insert_one(sensor_data_data)
 
     pprint(sensor_data_data)
@@ -73,7 +81,8 @@ def read(db):
         pprint(data)
     print()
     print("Sensor Data: ")
-    for i,data in enumerate(db['sensor_data'].find({'data_id':1001,'sensor_id': 1001})):
+    sensor_data_filter = sensor_data_query({'data_id':1001,'sensor_id': 1001}, is_timeseries(db))
+    for i,data in enumerate(db['sensor_data'].find(sensor_data_filter)):
         pprint(data)
     print()
     print("Device Control: ")
@@ -84,18 +93,48 @@ def update(db):
     print("Updating data in Sensor, Sensor Data, and Device Control collections that were inserted")
     print("Updating sensor status to inactive, sensor data quality to bad, and device status to not functioning")
     db['sensors'].update_one({'sensor_id': 1001}, {'$set': {'sensor_status': 'inactive'}})
-    db['sensor_data'].update_one({'data_id': 1001}, {'$set': {'data_quality': 'bad'}})
+    # A time-series collection takes no update_one, and filters on data_id or
+    # sets data_quality only from MongoDB 7.0. update_many also works on a
+    # plain sensor_data, where data_id is unique.
+    timeseries = is_timeseries(db)
+    if timeseries and not timeseries_writes_supported(db):
+        print("Sensor data quality not updated, time-series updates on data_id need MongoDB 7.0+")
+    else:
+        sensor_data_filter = sensor_data_query({'data_id':1001,'sensor_id': 1001}, timeseries)
+        db['sensor_data'].update_many(sensor_data_filter, {'$set': {'data_quality': 'bad'}})
     db['device_controls'].update_one({'device_id': 101}, {'$set': {'device_status': 'not functioning'}})
     print("Data updated successfully")
 
 def delete(db):
     print("Deleting data in Sensor, Sensor Data, and Device Control collections that were inserted")
     db['sensors'].delete_one({'sensor_id': 1001,'room_id': 500})
-    db['sensor_data'].delete_one({'data_id':1001,'sensor_id': 1001})
+    timeseries = is_timeseries(db)
+    if timeseries and not timeseries_writes_supported(db):
+        # Before MongoDB 7.0 only filters on the meta field can delete, these are the readings of sensor 1001
+        db['sensor_data'].delete_many(sensor_data_query({'sensor_id': 1001}, timeseries))
+    else:
+        sensor_data_filter = sensor_data_query({'data_id':1001,'sensor_id': 1001}, timeseries)
+        db['sensor_data'].delete_many(sensor_data_filter)
     db['device_controls'].delete_one({'device_id':101,'room_id': 500})
     print("Data deleted successfully")
 
 
+def inactive_sensor_count(db):
+    return cached_count_documents(db['sensors'], {'sensor_status': 'inactive'})
+
+
+def cache_latency(db, repetitions=1000):
+    # Average latency of the cached count, the first call fills the cache
+    t1 = time.perf_counter()
+    inactive_sensor_count(db)
+    first = time.perf_counter() - t1
+    t1 = time.perf_counter()
+    for _ in range(repetitions):
+        inactive_sensor_count(db)
+    cached = (time.perf_counter() - t1) / repetitions
+    print(f"  inactive sensors: first call {first * 1000:.2f}ms, cached {cached * 1e6:.1f}us")
+
+
 def run_queries(db):
     # Find all sensors with sensor type 'Temperature' and model 'T3000
     print("All sensors with sensor type temperature and model T3000: ")
@@ -104,12 +143,12 @@ def run_queries(db):
         print(f"{i}. {sensor}")
 
     # Count all inactive sensors
-    print("Number of inactive sensors: ", sensors.count_documents({'sensor_status': 'inactive'}))
+    print("Number of inactive sensors: ", inactive_sensor_count(db))
 
     # Find Sensor Data with id = 158
     print("Sensor Data with id = 158: ")
     sensor_data = db['sensor_data']
-    for i,data in enumerate(sensor_data.find({'sensor_id': 158})):
+    for i,data in enumerate(sensor_data.find(sensor_data_query({'sensor_id': 158}, is_timeseries(db)))):
         print(f"{i}. {data}")
     
 
@@ -192,13 +231,19 @@ if __name__ == '__main__':
     }
 
     DB_NAME = "smart_building"
-    
+
+    # Our own writes invalidate the cached counts, registered before the client is created
+    watch_mongo_writes()
+
     # Connect to MongoDB
-    client = MongoClient('mongodb://127.0.0.1:27017/')
+    client = get_mongo_client()
 
     # Connect to Smart-Building database
     db = client[DB_NAME]
 
+    # Writes of other clients invalidate the cached counts too, on a replica set
+    change_listener = watch_mongo_changes(db, ["sensors"])
+
     # CRUD Operations
 
     create(db)
@@ -210,4 +255,10 @@ if __name__ == '__main__':
     
     run_queries(db)
 
-    client.close()
\ No newline at end of file
+    print("Latency of the repeated cached query:")
+    cache_latency(db)
+    report_cache_metrics()
+    if change_listener is not None:
+        change_listener.stop()
+
+    close_all()
\ No newline at end of file
@@ -0,0 +1,439 @@
+"""
+Result cache for the hot PostgreSQL and MongoDB retrieval queries.
+
+Entries are keyed on the server, the statement (comments and whitespace
+normalised, literals kept) and its parameters, or for Mongo on the database,
+collection, operation and filter. Every entry is tagged with the tables or
+collections it was read from. Entries expire after their TTL, and the least
+recently used ones are evicted once the pickled size of all entries exceeds
+max_bytes.
+
+An entry is invalidated when one of its tables is written to, as seen by
+
+- our own PostgreSQL writes: cursors of invalidating_cursor, installed on a
+  connection with invalidate_on_write, invalidate right after every write,
+  so that a read after it never returns the result from before it
+- PostgreSQL: statement-level triggers on the tables that NOTIFY
+  INVALIDATION_CHANNEL with the table name, handled by PsqlInvalidationListener.
+  The notification arrives asynchronously once the writing transaction
+  commits, and covers writes from every client. When the listener loses its
+  connection, the watched tables are no longer cached.
+- MongoDB: a change stream on the database, handled by a
+  MongoInvalidationListener that watch_mongo_changes starts on replica sets
+  and sharded clusters, and for our own writes on any server a command
+  listener registered with watch_mongo_writes
+
+Cached rows and documents are shared between callers and must not be
+modified. Hit rate, evictions, expirations and invalidations are counted per
+cache, see report_cache_metrics.
+"""
+
+import json
+import os
+import pickle
+import re
+import select
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+from pymongo import monitoring
+from pymongo.errors import PyMongoError
+
+from common.db import PSQL_TARGETS
+from common.statements import STATEMENTS
+from common.workload import TABLE_REFERENCE, clean_statement, normalize_statement
+
+
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", str(64 * 2**20)))
+RESULT_CACHE_TTL = float(os.environ.get("RESULT_CACHE_TTL", "60"))
+INVALIDATION_CHANNEL = "result_cache_invalidation"
+INVALIDATION_TRIGGER = "result_cache_invalidation"
+# Seconds a listener waits for a notification or change before checking whether it was stopped
+LISTEN_TIMEOUT = 1.0
+
+WRITTEN_TABLE = re.compile(r"^\s*(?:insert\s+into|update|delete\s+from|truncate(?:\s+table)?)\s+(?:only\s+)?(\w+)"
+                           r"|^\s*copy\s+(\w+)(?:\s*\([^)]*\))?\s+from\b", re.IGNORECASE)
+EXECUTED_STATEMENT = re.compile(r"^\s*execute\s+(\w+)", re.IGNORECASE)
+MONGO_WRITE_COMMANDS = {"insert", "update", "delete", "findAndModify", "drop"}
+
+
+class ResultCache:
+    """
+    Thread-safe LRU cache of query results with a TTL per entry and an index
+    from table to the keys of the entries read from it.
+    """
+
+    def __init__(self, max_bytes=RESULT_CACHE_MAX_BYTES, ttl=RESULT_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.tables = {}
+        # Invalidations per table, so results read before one are not stored after it
+        self.versions = {}
+        # Tables whose writes can no longer be seen, their results are not stored
+        self.uncacheable = set()
+        self.bytes = 0
+        self.metrics = {"hits": 0, "misses": 0, "stores": 0, "expirations": 0, "evictions": 0,
+                        "invalidations": 0, "too_large": 0, "stale": 0, "uncacheable": 0}
+
+    def get(self, key):
+        # (True, value) for a live entry, (False, None) otherwise
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.metrics["misses"] += 1
+                return False, None
+            value, _, expires_at, _ = entry
+            if expires_at < time.monotonic():
+                self._remove(key)
+                self.metrics["expirations"] += 1
+                self.metrics["misses"] += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.metrics["hits"] += 1
+            return True, value
+
+    def version(self, tables):
+        # Taken before reading a result and handed to put
+        with self.lock:
+            return tuple(self.versions.get(table, 0) for table in tables)
+
+    def put(self, key, value, tables, ttl=None, version=None):
+        size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            if version is not None and version != tuple(self.versions.get(table, 0) for table in tables):
+                # A table was written while the result was read
+                self.metrics["stale"] += 1
+                return
+            if self.uncacheable.intersection(tables):
+                self.metrics["uncacheable"] += 1
+                return
+            if size > self.max_bytes:
+                self.metrics["too_large"] += 1
+                return
+            self.entries[key] = (value, size, time.monotonic() + (self.ttl if ttl is None else ttl), tables)
+            self.bytes += size
+            for table in tables:
+                self.tables.setdefault(table, set()).add(key)
+            self.metrics["stores"] += 1
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.metrics["evictions"] += 1
+
+    def _remove(self, key):
+        _, size, _, tables = self.entries.pop(key)
+        self.bytes -= size
+        for table in tables:
+            keys = self.tables.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tables[table]
+
+    def invalidate(self, *tables):
+        # Drop every entry read from one of the tables. Returns how many were dropped.
+        with self.lock:
+            for table in tables:
+                self.versions[table] = self.versions.get(table, 0) + 1
+            keys = set().union(*(self.tables.get(table, ()) for table in tables))
+            for key in keys:
+                self._remove(key)
+            self.metrics["invalidations"] += len(keys)
+            return len(keys)
+
+    def disable(self, *tables):
+        # Drop the entries of the tables and stop storing results read from them
+        with self.lock:
+            self.uncacheable.update(tables)
+        return self.invalidate(*tables)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tables.clear()
+            self.bytes = 0
+
+    def snapshot(self):
+        with self.lock:
+            lookups = self.metrics["hits"] + self.metrics["misses"]
+            return dict(self.metrics, entries=len(self.entries), bytes=self.bytes,
+                        uncacheable_tables=sorted(self.uncacheable), hit_rate=self.metrics["hits"] / lookups if lookups else 0.0)
+
+
+RESULT_CACHE = ResultCache()
+
+
+def report_cache_metrics(cache=RESULT_CACHE):
+    metrics = cache.snapshot()
+    print(f"Result cache: {metrics['hits']} hits, {metrics['misses']} misses "
+          f"({metrics['hit_rate'] * 100:.1f}% hit rate), {metrics['entries']} entries, "
+          f"{metrics['bytes'] / 2**20:.2f} MB, {metrics['evictions']} evicted, {metrics['expirations']} expired, "
+          f"{metrics['invalidations']} invalidated")
+    if metrics["uncacheable_tables"]:
+        print(f"  Not cached, their writes are no longer seen: {', '.join(metrics['uncacheable_tables'])}")
+
+
+def read_tables(query):
+    return {name for _, name, _ in TABLE_REFERENCE.findall(normalize_statement(query))}
+
+
+def written_tables(query):
+    # Tables a statement writes, through the registered statement for an EXECUTE
+    executed = EXECUTED_STATEMENT.match(query)
+    if executed and executed.group(1) in STATEMENTS:
+        query = STATEMENTS[executed.group(1)]["query"]
+    return {(match.group(1) or match.group(2)).lower() for match in WRITTEN_TABLE.finditer(query)}
+
+
+def cached_query(conn, query, params=None, cache=RESULT_CACHE, ttl=None):
+    """
+    Every row of query, as a tuple of tuples, from the cache when it holds a
+    live result of the same statement and parameters on the same server.
+    """
+    key = ("psql", conn.info.host, conn.info.port, conn.info.dbname, clean_statement(query), repr(params))
+    hit, rows = cache.get(key)
+    if hit:
+        return rows
+    tables = sorted(read_tables(query))
+    version = cache.version(tables)
+    cur = conn.cursor()
+    cur.execute(query, params)
+    rows = tuple(cur.fetchall())
+    cur.close()
+    cache.put(key, rows, tables, ttl, version)
+    return rows
+
+
+def cached_count_documents(collection, filter, cache=RESULT_CACHE, ttl=None):
+    key = ("mongo", collection.database.name, collection.name, "count",
+           json.dumps(filter, sort_keys=True, default=str))
+    hit, count = cache.get(key)
+    if hit:
+        return count
+    version = cache.version([collection.name])
+    count = collection.count_documents(filter)
+    cache.put(key, count, [collection.name], ttl, version)
+    return count
+
+
+def invalidating_cursor(cache=RESULT_CACHE):
+    class InvalidatingCursor(psycopg2.extensions.cursor):
+        # Invalidates the tables a statement writes once it ran. Inside a
+        # transaction, the NOTIFY at commit invalidates them once more.
+
+        def _invalidate(self, query):
+            tables = written_tables(query if isinstance(query, str) else query.as_string(self))
+            if tables:
+                cache.invalidate(*tables)
+
+        def execute(self, query, vars=None):
+            result = super().execute(query, vars)
+            self._invalidate(query)
+            return result
+
+        def executemany(self, query, vars_list):
+            result = super().executemany(query, vars_list)
+            self._invalidate(query)
+            return result
+
+        def copy_expert(self, sql, file, size=8192):
+            result = super().copy_expert(sql, file, size)
+            self._invalidate(sql)
+            return result
+
+        def copy_from(self, file, table, *args, **kwargs):
+            result = super().copy_from(file, table, *args, **kwargs)
+            cache.invalidate(table)
+            return result
+
+    return InvalidatingCursor
+
+
+@contextmanager
+def invalidate_on_write(conn, cache=RESULT_CACHE):
+    # Writes through new cursors of conn invalidate the tables they write
+    previous = conn.cursor_factory
+    conn.cursor_factory = invalidating_cursor(cache)
+    try:
+        yield conn
+    finally:
+        conn.cursor_factory = previous
+
+
+def install_invalidation_triggers(conn, tables):
+    """
+    Statement-level triggers on the tables that NOTIFY INVALIDATION_CHANNEL
+    with the table name on every insert, update, delete and truncate. The
+    notification is delivered when the writing transaction commits.
+    """
+    cur = conn.cursor()
+    cur.execute(f"""
+        CREATE OR REPLACE FUNCTION {INVALIDATION_TRIGGER}() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('{INVALIDATION_CHANNEL}', TG_TABLE_NAME);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+    for table in tables:
+        cur.execute(f"DROP TRIGGER IF EXISTS {INVALIDATION_TRIGGER} ON {table};")
+        cur.execute(f"""
+            CREATE TRIGGER {INVALIDATION_TRIGGER}
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+            FOR EACH STATEMENT EXECUTE FUNCTION {INVALIDATION_TRIGGER}();
+        """)
+    if not conn.autocommit:
+        conn.commit()
+    cur.close()
+
+
+class PsqlInvalidationListener:
+    """
+    A thread that LISTENs on INVALIDATION_CHANNEL on a connection of its own,
+    outside the pool, and invalidates the table named by every notification.
+    When the connection fails, error is set and the watched tables, every
+    table with the invalidation trigger when none are given, are no longer
+    cached.
+    """
+
+    def __init__(self, dbname="smart_building", target="psql", cache=RESULT_CACHE, tables=None):
+        self.cache = cache
+        self.error = None
+        self.conn = psycopg2.connect(dbname=dbname, **PSQL_TARGETS[target])
+        self.conn.autocommit = True
+        cur = self.conn.cursor()
+        if tables:
+            self.tables = list(tables)
+        else:
+            cur.execute("SELECT DISTINCT tgrelid::regclass::text FROM pg_trigger WHERE tgname = %s;",
+                        (INVALIDATION_TRIGGER,))
+            self.tables = [table for table, in cur.fetchall()]
+        cur.execute(f"LISTEN {INVALIDATION_CHANNEL};")
+        cur.close()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        try:
+            while not self.stop_event.is_set():
+                if select.select([self.conn], [], [], LISTEN_TIMEOUT) == ([], [], []):
+                    continue
+                self.conn.poll()
+                tables = set()
+                while self.conn.notifies:
+                    tables.add(self.conn.notifies.pop(0).payload)
+                if tables:
+                    self.cache.invalidate(*tables)
+        except (psycopg2.Error, OSError, ValueError) as error:
+            # A closed connection fails select with ValueError, a dropped one poll
+            self.error = error
+            print("Error while listening for invalidations, no longer caching "
+                  f"{', '.join(self.tables)}: ", error)
+            self.cache.disable(*self.tables)
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.conn.close()
+
+
+class MongoInvalidationListener:
+    """
+    A thread that watches the change stream of a database and invalidates
+    the collection of every change. Change streams need a replica set or a
+    sharded cluster. When the stream fails, error is set and the watched
+    collections, every collection of db when none are given, are no longer
+    cached.
+    """
+
+    def __init__(self, db, collections=None, cache=RESULT_CACHE):
+        self.cache = cache
+        self.collections = list(collections) if collections else db.list_collection_names()
+        self.error = None
+        pipeline = [{"$match": {"ns.coll": {"$in": list(collections)}}}] if collections else []
+        # Opened here so that changes made right after start are not missed
+        self.stream = db.watch(pipeline, max_await_time_ms=int(LISTEN_TIMEOUT * 1000))
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        try:
+            while not self.stop_event.is_set() and self.stream.alive:
+                change = self.stream.try_next()
+                if change is not None and "ns" in change:
+                    self.cache.invalidate(change["ns"]["coll"])
+        except PyMongoError as error:
+            self.error = error
+            print("Error while watching changes, no longer caching "
+                  f"{', '.join(self.collections)}: ", error)
+            self.cache.disable(*self.collections)
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.stream.close()
+
+
+class MongoWriteListener(monitoring.CommandListener):
+    # Invalidates the collection of every write command this process sends, once it is answered
+
+    def __init__(self, cache=RESULT_CACHE):
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def started(self, event):
+        if event.command_name in MONGO_WRITE_COMMANDS:
+            with self.lock:
+                self.pending[(event.connection_id, event.request_id)] = event.command[event.command_name]
+
+    def _answered(self, event):
+        with self.lock:
+            collection = self.pending.pop((event.connection_id, event.request_id), None)
+        if collection is not None:
+            self.cache.invalidate(collection)
+
+    def succeeded(self, event):
+        self._answered(event)
+
+    def failed(self, event):
+        # A failed write may still have changed some documents
+        self._answered(event)
+
+
+def watch_mongo_writes(cache=RESULT_CACHE):
+    """
+    Register a MongoWriteListener for every MongoClient created from now on,
+    which covers standalone servers without change streams. Call it before
+    the first get_mongo_client.
+    """
+    listener = MongoWriteListener(cache)
+    monitoring.register(listener)
+    return listener
+
+
+def watch_mongo_changes(db, collections=None, cache=RESULT_CACHE):
+    """
+    Start a MongoInvalidationListener on db when its server has change
+    streams, i.e. a replica set member or mongos. Returns it, or None on a
+    standalone server, where only watch_mongo_writes invalidates.
+    """
+    hello = db.client.admin.command("hello")
+    if "setName" not in hello and hello.get("msg") != "isdbgrid":
+        return None
+    return MongoInvalidationListener(db, collections, cache).start()
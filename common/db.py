@@ -0,0 +1,420 @@
+"""
+Shared PostgreSQL and MongoDB access for every Part.
+
+PostgreSQL connections come from one thread-safe pool per (target, database),
+where a target names a server: "psql" is PostgreSQL itself and "pgpool" the
+Pgpool-II front end used in Part-4. Mongo clients are shared per URI. Hosts,
+ports, credentials and pool sizes are read from the environment and default to
+the local setup the Parts were written against.
+
+Pools are per process. A forked child starts with empty pools and never
+touches the connections it inherited from its parent.
+"""
+
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+from pymongo import MongoClient, monitoring
+
+
+PSQL_TARGETS = {
+    "psql": {
+        "user": os.environ.get("PSQL_USER", "postgres"),
+        "password": os.environ.get("PSQL_PASSWORD", "Password"),
+        "host": os.environ.get("PSQL_HOST", "127.0.0.1"),
+        "port": os.environ.get("PSQL_PORT", "5432"),
+    },
+    "pgpool": {
+        "user": os.environ.get("PGPOOL_USER", "postgres"),
+        "host": os.environ.get("PGPOOL_HOST", "localhost"),
+        "port": os.environ.get("PGPOOL_PORT", "9999"),
+    },
+}
+PSQL_POOL_MIN = int(os.environ.get("PSQL_POOL_MIN", "1"))
+PSQL_POOL_MAX = int(os.environ.get("PSQL_POOL_MAX", "10"))
+# Seconds to wait for a free connection before giving up
+PSQL_POOL_TIMEOUT = float(os.environ.get("PSQL_POOL_TIMEOUT", "30"))
+# Connections idle for longer than this are pinged before being handed out
+PSQL_HEALTH_CHECK_AFTER = float(os.environ.get("PSQL_HEALTH_CHECK_AFTER", "30"))
+# Rows fetched per round trip by stream_psql_rows
+PSQL_ITERSIZE = int(os.environ.get("PSQL_ITERSIZE", "2000"))
+
+MONGO_URI = os.environ.get("MONGO_URI", "mongodb://127.0.0.1:27017/")
+MONGO_MIN_POOL_SIZE = int(os.environ.get("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", "100"))
+# Documents per getMore of the retrieval cursors
+MONGO_FIND_BATCH_SIZE = int(os.environ.get("MONGO_FIND_BATCH_SIZE", "1000"))
+
+
+class PoolTimeout(psycopg2.OperationalError):
+    pass
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    # Remembers the pool it belongs to so release_psql_db can find it
+    pool = None
+
+
+class PsqlPool:
+    """
+    A blocking, thread-safe pool of connections to one database. getconn waits
+    up to timeout seconds for a free connection once maxconn connections are
+    open. Connections that were idle for more than health_check_after seconds
+    are pinged first and replaced when they no longer work.
+    """
+
+    def __init__(self, params, minconn=PSQL_POOL_MIN, maxconn=PSQL_POOL_MAX,
+                 timeout=PSQL_POOL_TIMEOUT, health_check_after=PSQL_HEALTH_CHECK_AFTER):
+        self.params = params
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.health_check_after = health_check_after
+        self.idle = deque()
+        self.size = 0
+        self.cond = threading.Condition()
+        self.metrics = {
+            "checkouts": 0,
+            "wait_seconds": 0.0,
+            "max_wait_seconds": 0.0,
+            "timeouts": 0,
+            "opened": 0,
+            "closed": 0,
+            "replaced": 0,
+            "health_checks": 0,
+        }
+        for _ in range(minconn):
+            self.size += 1
+            self.idle.append((self._open(), time.monotonic()))
+
+    def _open(self):
+        try:
+            conn = psycopg2.connect(connection_factory=PooledConnection, **self.params)
+        except Exception:
+            with self.cond:
+                self.size -= 1
+                self.cond.notify()
+            raise
+        conn.pool = self
+        with self.cond:
+            self.metrics["opened"] += 1
+        return conn
+
+    def _discard(self, conn, replace=False):
+        # Close conn and give its slot back, or keep the slot for its replacement
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self.cond:
+            self.metrics["closed"] += 1
+            if replace:
+                self.metrics["replaced"] += 1
+            else:
+                self.size -= 1
+                self.cond.notify()
+
+    def _healthy(self, conn, idle_since):
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.health_check_after:
+            return True
+        with self.cond:
+            self.metrics["health_checks"] += 1
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1;")
+            cur.close()
+            if not conn.autocommit:
+                conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self, autocommit=True):
+        t1 = time.monotonic()
+        deadline = t1 + self.timeout
+        with self.cond:
+            while True:
+                if self.idle:
+                    conn, idle_since = self.idle.pop()
+                    break
+                if self.size < self.maxconn:
+                    self.size += 1
+                    conn = idle_since = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.metrics["timeouts"] += 1
+                    raise PoolTimeout(f"No free connection after {self.timeout}s")
+                self.cond.wait(remaining)
+
+        if conn is None:
+            conn = self._open()
+        elif not self._healthy(conn, idle_since):
+            self._discard(conn, replace=True)
+            conn = self._open()
+        conn.autocommit = autocommit
+
+        waited = time.monotonic() - t1
+        with self.cond:
+            self.metrics["checkouts"] += 1
+            self.metrics["wait_seconds"] += waited
+            self.metrics["max_wait_seconds"] = max(self.metrics["max_wait_seconds"], waited)
+        return conn
+
+    def putconn(self, conn, close=False):
+        if not close and not conn.closed:
+            try:
+                # Never hand out a connection in the middle of a transaction
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                close = True
+        if close or conn.closed:
+            self._discard(conn)
+            return
+        with self.cond:
+            self.idle.append((conn, time.monotonic()))
+            self.cond.notify()
+
+    def closeall(self):
+        with self.cond:
+            idle, self.idle = list(self.idle), deque()
+        for conn, _ in idle:
+            self._discard(conn)
+
+
+_lock = threading.Lock()
+_pid = os.getpid()
+_pools = {}
+_mongo_clients = {}
+# Pools and clients a forked child inherited. They are kept referenced so they
+# are never garbage collected, which would close sockets the parent still uses.
+_inherited = []
+
+
+def _check_fork():
+    global _pid, _pools, _mongo_clients
+    if os.getpid() != _pid:
+        _inherited.append((_pools, _mongo_clients))
+        _pid, _pools, _mongo_clients = os.getpid(), {}, {}
+
+
+def get_psql_pool(dbname="postgres", target="psql"):
+    with _lock:
+        _check_fork()
+        key = (target, dbname)
+        if key not in _pools:
+            _pools[key] = PsqlPool({**PSQL_TARGETS[target], "database": dbname})
+        return _pools[key]
+
+
+def connect_psql_db(dbname="postgres", target="psql", autocommit=True):
+    """
+    Check a connection to dbname out of the shared pool of target. Return it
+    with release_psql_db. Like the per-Part helpers this replaces, errors are
+    printed and None is returned.
+    """
+    print(f"Connecting to {dbname}....")
+    try:
+        connection = get_psql_pool(dbname, target).getconn(autocommit)
+        print(f"Connected to {dbname}")
+        return connection
+    except (Exception, psycopg2.Error) as error:
+        print("Error while connecting to PostgreSQL", error)
+
+
+def release_psql_db(conn, close=False):
+    if conn is None:
+        return
+    if getattr(conn, "pool", None) is None or conn.pool not in _pools.values():
+        # Not from a pool of this process
+        conn.close()
+        return
+    conn.pool.putconn(conn, close)
+
+
+@contextmanager
+def psql_connection(dbname="postgres", target="psql", autocommit=True):
+    conn = get_psql_pool(dbname, target).getconn(autocommit)
+    try:
+        yield conn
+    finally:
+        release_psql_db(conn)
+
+
+def copy_value(value):
+    # Render a value in COPY text format
+    if value is None:
+        return '\\N'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+_cursor_ids = itertools.count(1)
+
+
+def stream_psql_rows(conn, query, params=None, itersize=PSQL_ITERSIZE):
+    """
+    Iterate over the rows of query through a named server-side cursor, which
+    fetches itersize rows per round trip, so client memory does not grow with
+    the result. A named cursor only lives in a transaction. On an autocommit
+    connection the rows are streamed in a transaction of their own, which
+    ends with the iteration, rather than through a cursor WITH HOLD: the
+    server materialises those whole before returning their first row.
+    """
+    own_transaction = conn.autocommit
+    if own_transaction:
+        conn.autocommit = False
+    try:
+        cur = conn.cursor(f"stream_{os.getpid()}_{next(_cursor_ids)}")
+        cur.itersize = itersize
+        # A cursor whose DECLARE failed does not exist server-side and is not closed
+        cur.execute(query, params)
+        try:
+            yield from cur
+        finally:
+            cur.close()
+    finally:
+        if own_transaction and not conn.closed:
+            # Statements the caller ran on conn meanwhile commit as they would have
+            if conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+                conn.rollback()
+            else:
+                conn.commit()
+            conn.autocommit = True
+
+
+class MongoPoolMetrics(monitoring.ConnectionPoolListener):
+    # Counts checkouts, checkout wait time and connection churn of a MongoClient
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = {}
+        self.metrics = {
+            "checkouts": 0,
+            "wait_seconds": 0.0,
+            "max_wait_seconds": 0.0,
+            "checkout_failures": 0,
+            "opened": 0,
+            "closed": 0,
+        }
+
+    def _count(self, key, amount=1):
+        with self.lock:
+            self.metrics[key] += amount
+
+    def connection_check_out_started(self, event):
+        self.started[threading.get_ident()] = time.monotonic()
+
+    def connection_checked_out(self, event):
+        waited = time.monotonic() - self.started.pop(threading.get_ident(), time.monotonic())
+        with self.lock:
+            self.metrics["checkouts"] += 1
+            self.metrics["wait_seconds"] += waited
+            self.metrics["max_wait_seconds"] = max(self.metrics["max_wait_seconds"], waited)
+
+    def connection_check_out_failed(self, event):
+        self.started.pop(threading.get_ident(), None)
+        self._count("checkout_failures")
+
+    def connection_created(self, event):
+        self._count("opened")
+
+    def connection_closed(self, event):
+        self._count("closed")
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_checked_in(self, event):
+        pass
+
+
+def get_mongo_client(uri=MONGO_URI, **options):
+    """
+    The shared MongoClient for uri and options, created on first use with the
+    configured pool sizes.
+    """
+    with _lock:
+        _check_fork()
+        key = (uri, tuple(sorted(options.items())))
+        if key not in _mongo_clients:
+            listener = MongoPoolMetrics()
+            options = {"minPoolSize": MONGO_MIN_POOL_SIZE, "maxPoolSize": MONGO_MAX_POOL_SIZE, **options}
+            client = MongoClient(uri, event_listeners=[listener], **options)
+            _mongo_clients[key] = (client, listener)
+        return _mongo_clients[key][0]
+
+
+def psql_health_check(dbname="postgres", target="psql"):
+    t1 = time.monotonic()
+    try:
+        with psql_connection(dbname, target) as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT 1;")
+            cur.close()
+        return {"ok": True, "latency_ms": (time.monotonic() - t1) * 1000}
+    except (Exception, psycopg2.Error) as error:
+        return {"ok": False, "error": str(error)}
+
+
+def mongo_health_check(client=None):
+    client = client or get_mongo_client()
+    t1 = time.monotonic()
+    try:
+        client.admin.command("ping")
+        return {"ok": True, "latency_ms": (time.monotonic() - t1) * 1000}
+    except Exception as error:
+        return {"ok": False, "error": str(error)}
+
+
+def pool_metrics():
+    metrics = {}
+    with _lock:
+        for (target, dbname), pool in _pools.items():
+            with pool.cond:
+                metrics[f"{target}/{dbname}"] = dict(pool.metrics, open=pool.size, idle=len(pool.idle))
+        for (uri, _), (client, listener) in _mongo_clients.items():
+            with listener.lock:
+                metrics[f"mongo/{uri}"] = dict(listener.metrics)
+    return metrics
+
+
+def report_pool_metrics():
+    print("Connection pool metrics:")
+    for name, metrics in pool_metrics().items():
+        checkouts = metrics["checkouts"]
+        average = metrics["wait_seconds"] / checkouts * 1000 if checkouts else 0.0
+        print(f"  {name}: {checkouts} checkouts, avg wait {average:.2f}ms, "
+              f"max wait {metrics['max_wait_seconds'] * 1000:.2f}ms, "
+              f"{metrics['opened']} opened, {metrics['closed']} closed")
+
+
+def close_all():
+    with _lock:
+        pools, clients = list(_pools.values()), list(_mongo_clients.values())
+        _pools.clear()
+        _mongo_clients.clear()
+    for pool in pools:
+        pool.closeall()
+    for client, _ in clients:
+        client.close()
@@ -0,0 +1,65 @@
+"""
+Layouts of the sensor_data collection.
+
+The plain layout stores flat documents with ISO-string timestamps. The
+time-series layout stores the readings in a MongoDB time-series collection
+with timestamp as a BSON date and sensor_id and data_type grouped in the meta
+field, which is what MongoDB buckets the readings by. Time-series collections
+exist from MongoDB 5.0, but updates and deletes that filter on or set fields
+other than the meta field need MongoDB 7.0, see timeseries_writes_supported.
+"""
+
+from datetime import datetime
+
+
+SENSOR_DATA = "sensor_data"
+TIME_FIELD = "timestamp"
+META_FIELD = "meta"
+META_FIELDS = ("sensor_id", "data_type")
+GRANULARITIES = ("seconds", "minutes", "hours")
+
+
+def create_sensor_data_collection(db, timeseries=False, granularity="minutes"):
+    if not timeseries:
+        return db[SENSOR_DATA]
+    return db.create_collection(SENSOR_DATA, timeseries={
+        "timeField": TIME_FIELD,
+        "metaField": META_FIELD,
+        "granularity": granularity,
+    })
+
+
+def timeseries_options(db, name=SENSOR_DATA):
+    # timeField, metaField and granularity of a time-series collection, None for any other
+    for info in db.list_collections(filter={"name": name}):
+        if info.get("type") != "timeseries":
+            return None
+        options = info["options"]["timeseries"]
+        return {key: options[key] for key in ("timeField", "metaField", "granularity") if key in options}
+    return None
+
+
+def is_timeseries(db, name=SENSOR_DATA):
+    return timeseries_options(db, name) is not None
+
+
+def timeseries_writes_supported(db):
+    # Whether updates and deletes on any field of a time-series collection work (MongoDB 7.0+)
+    return db.client.server_info()["versionArray"][0] >= 7
+
+
+def to_timeseries_document(document):
+    # Plain sensor_data document -> time-series layout
+    document = dict(document)
+    timestamp = document[TIME_FIELD]
+    if isinstance(timestamp, str):
+        document[TIME_FIELD] = datetime.fromisoformat(timestamp)
+    document[META_FIELD] = {field: document.pop(field) for field in META_FIELDS}
+    return document
+
+
+def sensor_data_query(query, timeseries):
+    # Point filters on sensor_id or data_type at the meta field of a time-series collection
+    if not timeseries:
+        return query
+    return {f"{META_FIELD}.{key}" if key in META_FIELDS else key: value for key, value in query.items()}
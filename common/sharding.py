@@ -0,0 +1,44 @@
+"""
+Shard keys of the Smart-Building collections.
+
+sensor_data is sharded on a hashed sensor_id and the timestamp, so the
+readings of a sensor, and hence of a room, stay together and in time order,
+while different sensors spread over the shards. Readings carry no room_id;
+the sensor decides the room. device_controls is sharded on a hashed room_id
+and last_updated.
+
+Collections are sharded once they exist in their final layout: dropping a
+collection drops its sharding as well, and a time-series sensor_data has to
+be created as one before it is sharded. Part-1 therefore shards them right
+after creating them when it is connected to a mongos.
+"""
+
+from common.sensor_data import is_timeseries, sensor_data_query
+
+
+SHARD_KEYS = {
+    "sensor_data": {"sensor_id": "hashed", "timestamp": 1},
+    "device_controls": {"room_id": "hashed", "last_updated": 1},
+}
+
+
+def is_mongos(client):
+    return client.admin.command("hello").get("msg") == "isdbgrid"
+
+
+def shard_collections(client, dbname="smart_building", keys=SHARD_KEYS):
+    """
+    Shard the collections on their keys. Keys on sensor_id of a time-series
+    sensor_data use the meta field. Collections that are sharded already are
+    left alone.
+    """
+    db = client[dbname]
+    client.admin.command("enableSharding", dbname)
+    sharded = {collection["_id"] for collection in client["config"]["collections"].find(
+        {"_id": {"$regex": f"^{dbname}\\."}, "dropped": {"$ne": True}}, {"_id": 1})}
+    for collection, key in keys.items():
+        if collection == "sensor_data":
+            key = sensor_data_query(key, is_timeseries(db))
+        if f"{dbname}.{collection}" in sharded or f"{dbname}.system.buckets.{collection}" in sharded:
+            continue
+        client.admin.command("shardCollection", f"{dbname}.{collection}", key=key)
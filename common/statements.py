@@ -0,0 +1,165 @@
+"""
+Named prepared statements for the hot PostgreSQL paths.
+
+A statement is registered once with register_statement, written with the %s
+parameters of psycopg2, and run with execute_prepared. Its first run on a
+connection PREPAREs it there, with $n parameters. Every later run only sends
+EXECUTE name (values), so the server skips parsing and analysis. Once it
+settles on a generic plan, the server skips planning as well.
+
+Prepared statements live as long as the server session. The registry
+remembers which statements each connection prepared, per backend process. A
+connection the pool opened to replace a broken one therefore prepares them
+again. When the server lost them anyway, e.g. after DISCARD ALL or a
+Pgpool-II backend reconnect, the failed EXECUTE prepares the statement again
+and is retried. The retry is skipped inside a transaction that had already
+done work, as the error aborted it; the error is raised instead.
+
+Runs, prepares and time are counted per statement, see statement_metrics.
+plan_cache_stats reads how many custom and generic plans the server built for
+the statements of a connection.
+"""
+
+import re
+import threading
+import time
+
+import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+
+
+NAME = re.compile(r"[a-z_][a-z0-9_]*")
+PLACEHOLDER = re.compile(r"%s|%%")
+
+STATEMENTS = {}
+
+_lock = threading.Lock()
+# id of a connection -> (backend pid, names prepared in that session)
+_prepared = {}
+_metrics = {}
+
+
+def register_statement(name, query, types=None):
+    """
+    Register query under name. Parameters are %s, one per value, and %% is a
+    literal %. types optionally gives the SQL type of every parameter where
+    the server cannot infer it from the statement.
+    """
+    if not NAME.fullmatch(name):
+        raise ValueError(f"Statement name {name!r} is not a lower case SQL identifier")
+    parameters = 0
+
+    def placeholder(match):
+        nonlocal parameters
+        if match.group() == "%%":
+            return "%"
+        parameters += 1
+        return f"${parameters}"
+
+    body = PLACEHOLDER.sub(placeholder, query.strip().rstrip(";"))
+    if types is not None and len(types) != parameters:
+        raise ValueError(f"Statement {name} has {parameters} parameters but {len(types)} types")
+    signature = f" ({', '.join(types)})" if types else ""
+    arguments = f" ({', '.join(['%s'] * parameters)})" if parameters else ""
+    STATEMENTS[name] = {
+        "query": body,
+        "prepare": f"PREPARE {name}{signature} AS {body};",
+        "execute": f"EXECUTE {name}{arguments};",
+        "parameters": parameters,
+    }
+    with _lock:
+        _metrics.setdefault(name, {"calls": 0, "prepares": 0, "reprepares": 0, "seconds": 0.0})
+
+
+def _session(conn):
+    # Names prepared in the current server session of conn
+    pid = conn.get_backend_pid()
+    with _lock:
+        session = _prepared.get(id(conn))
+        if session is None or session[0] != pid:
+            # A new connection, or this one reconnected to a new backend
+            session = _prepared[id(conn)] = (pid, set())
+        return session[1]
+
+
+def _prepare(cur, name, prepared, reprepare=False):
+    cur.execute(STATEMENTS[name]["prepare"])
+    prepared.add(name)
+    with _lock:
+        _metrics[name]["reprepares" if reprepare else "prepares"] += 1
+
+
+def execute_prepared(cur, name, params=()):
+    """
+    Run the registered statement name with params on cur, preparing it on
+    the connection first when needed. Rows are fetched from cur as usual.
+    """
+    statement = STATEMENTS[name]
+    if len(params) != statement["parameters"]:
+        raise ValueError(f"Statement {name} takes {statement['parameters']} parameters, got {len(params)}")
+    conn = cur.connection
+    t1 = time.perf_counter()
+    prepared = _session(conn)
+    # Nothing done yet in the transaction, so a failed EXECUTE can be retried
+    idle = conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    if name not in prepared:
+        _prepare(cur, name, prepared)
+    try:
+        cur.execute(statement["execute"], params or None)
+    except psycopg2.errors.InvalidSqlStatementName:
+        # The server session lost its prepared statements
+        prepared.clear()
+        if not idle:
+            raise
+        if not conn.autocommit:
+            conn.rollback()
+        _prepare(cur, name, prepared, reprepare=True)
+        cur.execute(statement["execute"], params or None)
+    with _lock:
+        _metrics[name]["calls"] += 1
+        _metrics[name]["seconds"] += time.perf_counter() - t1
+
+
+def statement_metrics():
+    with _lock:
+        return {name: dict(metrics) for name, metrics in _metrics.items()}
+
+
+def plan_cache_stats(conn):
+    """
+    Custom and generic plans built so far for the registered statements
+    prepared on conn, from pg_prepared_statements (PostgreSQL 14 and later).
+    The server plans the first five runs with the actual values and then
+    switches to a generic plan unless that is estimated to be more expensive.
+    """
+    if conn.server_version < 140000:
+        return {}
+    idle = conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT name, generic_plans, custom_plans
+        FROM pg_prepared_statements
+        WHERE name = ANY(%s);
+    """, (list(STATEMENTS),))
+    stats = {name: {"generic_plans": generic, "custom_plans": custom} for name, generic, custom in cur.fetchall()}
+    cur.close()
+    if idle and not conn.autocommit:
+        # Leave no transaction open that the caller did not start
+        conn.rollback()
+    return stats
+
+
+def report_statement_metrics(conn=None):
+    # Per statement runs and time, and the plans of the statements prepared on conn
+    plans = plan_cache_stats(conn) if conn is not None else {}
+    print("Prepared statement metrics:")
+    for name, metrics in statement_metrics().items():
+        if not metrics["calls"]:
+            continue
+        average = metrics["seconds"] / metrics["calls"] * 1e6
+        line = (f"  {name}: {metrics['calls']} runs, avg {average:.1f}us, "
+                f"{metrics['prepares']} prepared, {metrics['reprepares']} re-prepared")
+        if name in plans:
+            line += f", {plans[name]['custom_plans']} custom and {plans[name]['generic_plans']} generic plans"
+        print(line)
@@ -0,0 +1,142 @@
+"""
+The executed PostgreSQL workload, shared by the Part-2 fragmentation advisor
+and the Part-3 index advisor.
+
+A workload is a Counter of statement -> calls. It is recorded from the
+cursors of a connection with record_workload, read from pg_stat_statements,
+or read from a file of ";" separated statements. Statements are normalised
+by default: lower case with comments, literals and parameters replaced by ?,
+so that calls with different values count as one statement class. Advisors
+that plan the statements ask for them as executed instead (normalize=False):
+with their literals, or with the $n parameters of pg_stat_statements.
+statement_columns reduces a normalised statement to the columns of one table
+it touches.
+"""
+
+import re
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+import psycopg2.extensions
+
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+PARAMETER = re.compile(r"%\(\w+\)s|%s|\$\d+")
+TABLE_REFERENCE = re.compile(r"\b(from|join|update|into)\s+(\w+)(?:\s+(?:as\s+)?(\w+))?")
+# Names and stars, not the star of count(*). Names inside parentheses count,
+# as in max(room_name) or using (floor_id).
+IDENTIFIER = re.compile(r"(?<![\w.])(?:(\w+)\.)?(\w+|(?<!\()\*)")
+KEYWORDS = {"where", "join", "inner", "left", "right", "full", "cross", "on", "set", "group", "order",
+            "limit", "offset", "values", "select", "using", "natural", "union", "returning", "having",
+            "tablesample", "for", "window"}
+
+
+def normalize_statement(query):
+    # Lower case with comments, literals and parameters replaced, like pg_stat_statements
+    query = re.sub(r"--[^\n]*", " ", query)
+    query = STRING_LITERAL.sub("?", query)
+    query = PARAMETER.sub("?", query)
+    query = NUMBER_LITERAL.sub("?", query.lower())
+    return " ".join(query.split()).rstrip(";")
+
+
+def clean_statement(query):
+    # One line without comments or the trailing ";", literals kept
+    query = re.sub(r"--[^\n]*", " ", query)
+    return " ".join(query.split()).rstrip(";")
+
+
+class WorkloadRecorder:
+    # Thread-safe count of the statements executed through recording cursors
+
+    def __init__(self, normalize=True):
+        self.normalize = normalize
+        self.lock = threading.Lock()
+        self.statements = Counter()
+
+    def record(self, query):
+        statement = normalize_statement(query) if self.normalize else clean_statement(query)
+        with self.lock:
+            self.statements[statement] += 1
+
+
+def recording_cursor(recorder):
+    class RecordingCursor(psycopg2.extensions.cursor):
+        def execute(self, query, vars=None):
+            if recorder.normalize or vars is None:
+                recorder.record(query if isinstance(query, str) else query.as_string(self))
+            else:
+                # The statement with its values bound, as the server ran it
+                encoding = psycopg2.extensions.encodings[self.connection.encoding]
+                recorder.record(self.mogrify(query, vars).decode(encoding))
+            return super().execute(query, vars)
+
+    return RecordingCursor
+
+
+@contextmanager
+def record_workload(conn, recorder=None):
+    # Record every statement run through new cursors of conn, named ones included
+    recorder = recorder or WorkloadRecorder()
+    previous = conn.cursor_factory
+    conn.cursor_factory = recording_cursor(recorder)
+    try:
+        yield recorder
+    finally:
+        conn.cursor_factory = previous
+
+
+def workload_from_pg_stat_statements(conn, normalize=True):
+    cur = conn.cursor()
+    cur.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_stat_statements';")
+    if cur.fetchone() is None:
+        cur.close()
+        raise RuntimeError("pg_stat_statements is not installed in this database "
+                           "(shared_preload_libraries and CREATE EXTENSION pg_stat_statements)")
+    cur.execute("""
+        SELECT s.query, s.calls
+        FROM pg_stat_statements s JOIN pg_database d ON d.oid = s.dbid
+        WHERE d.datname = current_database();
+    """)
+    statements = Counter()
+    for query, calls in cur.fetchall():
+        statements[normalize_statement(query) if normalize else clean_statement(query)] += calls
+    cur.close()
+    return statements
+
+
+def workload_from_file(path, normalize=True):
+    with open(path) as statements_file:
+        text = statements_file.read()
+    clean = normalize_statement if normalize else clean_statement
+    return Counter(clean(query) for query in text.split(";") if query.strip())
+
+
+def statement_columns(statement, table, columns):
+    """
+    Columns of table a normalised statement touches, or None when it does not
+    use the table. Unqualified names count for the table, as they would be
+    ambiguous otherwise. Deletes touch every column.
+    """
+    aliases = set()
+    for _, name, alias in TABLE_REFERENCE.findall(statement):
+        if name == table:
+            aliases.add(table)
+            if alias and alias not in KEYWORDS:
+                aliases.add(alias)
+    if not aliases:
+        return None
+    if statement.startswith("delete"):
+        return set(columns)
+
+    used = set()
+    for qualifier, name in IDENTIFIER.findall(statement):
+        if qualifier and qualifier not in aliases:
+            continue
+        if name == "*":
+            used |= set(columns)
+        elif name in columns:
+            used.add(name)
+    return used